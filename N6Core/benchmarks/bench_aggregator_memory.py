@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+"""
+Benchmark: memory usage of the aggregator's open groups.
+
+Processes messages (decoded from JSON, as in the aggregator) of a
+high-frequency source -- each of them starting a new group -- and
+measures the memory usage (RSS) growth caused by keeping the groups.
+The result is compared with the former representation of groups
+(a `__dict__`-based object referring to the full payload dict).
+Each case is run in a separate (forked) process.
+
+Usage:
+
+    python bench_aggregator_memory.py [--groups N]
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import resource
+
+from n6.utils.aggregator import HiFreqEventData
+
+
+class FormerHiFreqEventData(object):
+
+    def __init__(self, payload):
+        self.group = payload.get("_group")
+        self.until = datetime.datetime.strptime(payload['time'], '%Y-%m-%d %H:%M:%S')
+        self.first = datetime.datetime.strptime(payload['time'], '%Y-%m-%d %H:%M:%S')
+        self.count = 1
+        self.payload = payload
+
+
+def iter_message_bodies(count):
+    base_time = datetime.datetime(2020, 1, 1)
+    for i in xrange(count):
+        ip = '10.{}.{}.{}'.format(i // 65536 % 256, i // 256 % 256, i % 256)
+        yield json.dumps({
+            'id': '{:032x}'.format(i),
+            'rid': '{:032x}'.format(i + 10 ** 9),
+            'source': 'hifreq-source.channel',
+            'restriction': 'public',
+            'confidence': 'low',
+            'category': 'scanning',
+            'proto': 'tcp',
+            'dport': 23,
+            'time': str(base_time + datetime.timedelta(seconds=i // 10)),
+            'address': [{'ip': ip, 'cc': 'PL', 'asn': 12345}],
+            '_group': 'hifreq-source.channel_{}_23'.format(ip),
+        })
+
+
+def keep_groups(group_class, group_count):
+    groups = collections.OrderedDict()
+    for body in iter_message_bodies(group_count):
+        data = json.loads(body)
+        groups[data['_group']] = group_class(data)
+    return groups
+
+
+def run_in_child(func, *args):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        max_rss_kb_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func(*args)
+        max_rss_kb_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, str(max_rss_kb_after - max_rss_kb_before))
+        os._exit(0)
+    os.close(write_fd)
+    result = os.read(read_fd, 1000)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return int(result)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--groups', type=int, default=300000)
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    print '{} open groups'.format(args.groups)
+    print '  {:<24} {:>16} {:>14}'.format('', 'RSS growth', 'per group')
+    for label, group_class in [('former representation', FormerHiFreqEventData),
+                               ('HiFreqEventData', HiFreqEventData)]:
+        max_rss_kb_growth = run_in_child(keep_groups, group_class, args.groups)
+        print '  {:<24} {:>12} KiB {:>8} bytes'.format(
+            label, max_rss_kb_growth, max_rss_kb_growth * 1024 // args.groups)
+
+
+if __name__ == '__main__':
+    main()
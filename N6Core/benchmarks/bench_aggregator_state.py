@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+"""
+Benchmark: storing and restoring the aggregator state.
+
+For each of the given state sizes (numbers of aggregated groups),
+builds the state by processing messages with AggregatorDataWrapper,
+and then measures: the time of stopping (the former way: dumping
+the whole state; the current way: closing the journal), the time of
+making a snapshot, and the time of restoring the state from a
+snapshot + a journal of the given length. Also the peak memory usage
+(RSS) growth while dumping the whole state is shown -- for the former
+(memoizing) pickler and for the one used to make snapshots.
+
+Usage:
+
+    python bench_aggregator_state.py [--sizes N,N,...] [--journal N]
+"""
+
+import argparse
+import cPickle
+import datetime
+import logging
+import os
+import os.path as osp
+import resource
+import shutil
+import tempfile
+import time
+
+from n6.utils.aggregator import AggregatorDataWrapper
+
+
+def make_messages(first_index, count, group_count):
+    base_time = datetime.datetime(2020, 1, 1)
+    for i in xrange(first_index, first_index + count):
+        yield {
+            'id': '{:032x}'.format(i),
+            'source': 'source{}.channel'.format(i % 10),
+            '_group': 'group{}'.format(i % group_count),
+            'time': str(base_time + datetime.timedelta(seconds=i // 100)),
+            'address': [{'ip': '10.0.{}.{}'.format(i % 256, i // 256 % 256)}],
+            'category': 'bots',
+            'name': 'some-bot',
+        }
+
+
+def process(wrapper, messages):
+    for data in messages:
+        wrapper.process_new_message(data)
+        list(wrapper.generate_suppresed_events_for_source(data))
+        wrapper.record_processed_message(data)
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def run_in_child(func, *args):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        max_rss_kb_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func(*args)
+        max_rss_kb_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, str(max_rss_kb_after - max_rss_kb_before))
+        os._exit(0)
+    os.close(write_fd)
+    result = os.read(read_fd, 1000)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return int(result)
+
+
+def legacy_dump(aggr_data, path):
+    with open(path, 'w') as f:
+        cPickle.dump(aggr_data, f)
+
+
+def bench(tmp_dir, size, journal_length):
+    dbpath = osp.join(tmp_dir, 'aggregator_db.pickle')
+    wrapper = AggregatorDataWrapper(dbpath, 600, snapshot_interval=10 ** 12)
+    process(wrapper, make_messages(0, size, size))
+    wrapper.store_state()
+    process(wrapper, make_messages(size, journal_length, size))
+    legacy_stop_time = timed(legacy_dump, wrapper.aggr_data, osp.join(tmp_dir, 'legacy.pickle'))
+    legacy_dump_rss = run_in_child(legacy_dump, wrapper.aggr_data,
+                                   osp.join(tmp_dir, 'legacy2.pickle'))
+    snapshot_rss = run_in_child(wrapper.store_state)
+    stop_time = timed(wrapper.close)
+    restore_time = timed(AggregatorDataWrapper, dbpath, 600)
+    snapshot_time = timed(AggregatorDataWrapper(dbpath, 600).store_state)
+    return (legacy_stop_time, stop_time, snapshot_time, restore_time,
+            legacy_dump_rss, snapshot_rss)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--sizes', default='10000,100000,500000')
+    arg_parser.add_argument('--journal', type=int, default=10000,
+                            help='number of journal records to be replayed on restore')
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    print 'journal records replayed on restore: {}'.format(args.journal)
+    print '  {:<8} {:>12} {:>10} {:>10} {:>10} {:>15} {:>15}'.format(
+        'groups', 'stop (dump)', 'stop', 'snapshot', 'restore',
+        'dump RSS+', 'snapshot RSS+')
+    for size in [int(s) for s in args.sizes.split(',')]:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            results = bench(tmp_dir, size, args.journal)
+        finally:
+            shutil.rmtree(tmp_dir)
+        print '  {:<8} {:>11.3f}s {:>9.3f}s {:>9.3f}s {:>9.3f}s {:>11} KiB {:>11} KiB'.format(
+            size, *results)
+
+
+if __name__ == '__main__':
+    main()
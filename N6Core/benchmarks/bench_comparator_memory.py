@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+"""
+Benchmark: memory usage of the comparator's state of a large blacklist.
+
+Processes one series of a synthetic URL blacklist (with messages
+decoded from JSON, as in the comparator) and then measures: the memory
+usage (RSS) growth caused by keeping the source's state, the size of
+the pickled state, and the time of processing the series again (when
+all entries already exist). The regular and the compact form of the
+blacklist entries (see: `SourceData.compact`) are compared. Each case
+is run in a separate (forked) process.
+
+Usage:
+
+    python bench_comparator_memory.py [--entries N]
+"""
+
+import argparse
+import cPickle
+import datetime
+import json
+import logging
+import os
+import resource
+import time
+
+from n6.utils.comparator import SourceData
+
+
+def iter_message_bodies(count):
+    bl_time = datetime.datetime(2020, 1, 1)
+    for i in xrange(count):
+        yield json.dumps({
+            'id': '{:032x}'.format(i),
+            'rid': '{:032x}'.format(i + 10 ** 9),
+            'source': 'large-blacklist.channel',
+            'restriction': 'public',
+            'confidence': 'medium',
+            'category': 'malurl',
+            'time': str(bl_time),
+            'expires': str(bl_time + datetime.timedelta(days=2)),
+            'url': 'http://host-{}.example.com/some/path/{:x}.php'.format(i // 10, i),
+            'address': [{'ip': '10.{}.{}.{}'.format(i // 65536 % 256, i // 256 % 256, i % 256)}],
+            '_bl-time': str(bl_time),
+            '_bl-series-id': 'series-id',
+            '_bl-series-no': i + 1,
+            '_bl-series-total': count,
+        })
+
+
+def keep_state(compact, entry_count, result_fd):
+    source_data = SourceData(compact=compact)
+    for body in iter_message_bodies(entry_count):
+        source_data.process_event(json.loads(body))
+    max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    pickle_size = len(cPickle.dumps(source_data, cPickle.HIGHEST_PROTOCOL))
+    bodies = list(iter_message_bodies(entry_count))
+    start = time.time()
+    for body in bodies:
+        source_data.process_event(json.loads(body))
+    duration = time.time() - start
+    os.write(result_fd, '{} {} {}'.format(max_rss_kb, pickle_size, duration))
+
+
+def run_in_child(func, *args):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        max_rss_kb_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, '{} '.format(max_rss_kb_before))
+        func(*args + (write_fd,))
+        os._exit(0)
+    os.close(write_fd)
+    result = ''
+    while True:
+        chunk = os.read(read_fd, 1000)
+        if not chunk:
+            break
+        result += chunk
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    max_rss_kb_before, max_rss_kb_after, pickle_size, duration = result.split()
+    return (int(max_rss_kb_after) - int(max_rss_kb_before),
+            int(pickle_size),
+            float(duration))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--entries', type=int, default=2000000)
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    print '{} blacklist entries'.format(args.entries)
+    print '  {:<10} {:>16} {:>12} {:>16} {:>16}'.format(
+        '', 'RSS growth', 'per entry', 'pickled state', 'series again')
+    for label, compact in [('regular', False),
+                           ('compact', True)]:
+        max_rss_kb_growth, pickle_size, duration = run_in_child(
+            keep_state, compact, args.entries)
+        print '  {:<10} {:>12} KiB {:>6} bytes {:>10} KiB {:>15.2f}s'.format(
+            label, max_rss_kb_growth, max_rss_kb_growth * 1024 // args.entries,
+            pickle_size // 1024, duration)
+
+
+if __name__ == '__main__':
+    main()
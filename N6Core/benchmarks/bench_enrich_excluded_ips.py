@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+"""
+Benchmark: the Enricher's `excluded_ips` membership tests.
+
+Generates the given numbers of random IPv4 ranges (networks and
+single addresses, like in long exclusion lists of internal and
+sinkhole networks) and measures the average time of checking whether
+an address belongs to any of them -- with `iptools.IpRangeList`
+(formerly used by the Enricher) and with `IPRangeIndex`. The time of
+building each structure is reported as well.
+
+Usage:
+
+    python bench_enrich_excluded_ips.py [--range-counts N,N,...] [--lookups N]
+"""
+
+import argparse
+import random
+import time
+
+import iptools
+
+from n6.utils.enrich import IPRangeIndex
+
+
+def make_ranges(count, rnd):
+    ranges = []
+    for _ in xrange(count):
+        ip = '{}.{}.{}.{}'.format(*(rnd.randrange(256) for _ in xrange(4)))
+        prefix_length = rnd.choice([None, 16, 20, 24, 28, 32])
+        ranges.append(ip if prefix_length is None else '{}/{}'.format(ip, prefix_length))
+    return ranges
+
+
+def bench(factory, ranges, ips):
+    start = time.time()
+    ip_ranges = factory(*ranges)
+    build_time = time.time() - start
+    start = time.time()
+    results = [ip in ip_ranges for ip in ips]
+    return build_time, (time.time() - start) / len(ips), results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--range-counts', default='10,100,1000,5000')
+    arg_parser.add_argument('--lookups', type=int, default=1000)
+    args = arg_parser.parse_args()
+
+    rnd = random.Random(42)
+    ips = ['{}.{}.{}.{}'.format(*(rnd.randrange(256) for _ in xrange(4)))
+           for _ in xrange(args.lookups)]
+    print '{} lookups of random IPv4 addresses'.format(args.lookups)
+    print '  {:<8} {:<16} {:>12} {:>16}'.format('ranges', '', 'build', 'per lookup')
+    for range_count in [int(s) for s in args.range_counts.split(',')]:
+        ranges = make_ranges(range_count, rnd)
+        all_results = []
+        for label, factory in [('IpRangeList', iptools.IpRangeList),
+                               ('IPRangeIndex', IPRangeIndex)]:
+            build_time, lookup_time, results = bench(factory, ranges, ips)
+            all_results.append(results)
+            print '  {:<8} {:<16} {:>11.4f}s {:>13.2f} us'.format(
+                range_count, label, build_time, lookup_time * 1e6)
+        assert all_results[0] == all_results[1]
+
+
+if __name__ == '__main__':
+    main()
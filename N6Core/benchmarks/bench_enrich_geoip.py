@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+"""
+Benchmark: GeoIP (ASN + CC) lookups of the Enricher, with the cache.
+
+Generates a stream of IP addresses whose frequencies follow the Zipf
+distribution (as the real traffic is skewed towards repeated addresses,
+such as those of botnet C&Cs and scanners), and measures the average
+time of getting the ASN and the CC of an address (as the Enricher does
+for each address of an event) -- for the given cache sizes (0 means
+no caching). The hit ratio is reported as well.
+
+The GeoIP databases can be specified with `--asn-db` and `--city-db`;
+otherwise, a synthetic reader is used, whose lookups take the given
+number of microseconds (see: `--synthetic-lookup-us`).
+
+Usage:
+
+    python bench_enrich_geoip.py [--lookups N] [--addresses N]
+        [--zipf-s X] [--cache-sizes N,N,...]
+        [--asn-db PATH --city-db PATH | --synthetic-lookup-us N]
+"""
+
+import argparse
+import bisect
+import logging
+import random
+import time
+
+import maxminddb.const
+from geoip2 import database
+
+from n6.utils.enrich import (
+    Enricher,
+    GeoIPCache,
+)
+
+
+class SyntheticReader(object):
+
+    def __init__(self, lookup_secs):
+        self._lookup_secs = lookup_secs
+
+    def _result(self, ip):
+        deadline = time.time() + self._lookup_secs
+        while time.time() < deadline:
+            pass
+        first_octet = int(ip.split('.')[0])
+        return _Result(autonomous_system_number=first_octet,
+                       country=_Result(iso_code='PL' if first_octet % 2 else 'DE'))
+
+    asn = city = _result
+
+
+class _Result(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def make_address_stream(lookup_count, address_count, zipf_s):
+    rnd = random.Random(42)
+    addresses = ['{}.{}.{}.{}'.format(rnd.randrange(1, 224), rnd.randrange(256),
+                                      rnd.randrange(256), rnd.randrange(1, 255))
+                 for _ in xrange(address_count)]
+    cumulative_weights = []
+    total = 0.0
+    for rank in xrange(1, address_count + 1):
+        total += 1.0 / rank ** zipf_s
+        cumulative_weights.append(total)
+    return [addresses[bisect.bisect(cumulative_weights, rnd.random() * total)]
+            for _ in xrange(lookup_count)]
+
+
+def make_enricher(gi_asn, gi_cc, cache_size):
+    enricher = Enricher.__new__(Enricher)
+    enricher.gi_asn = gi_asn
+    enricher.gi_cc = gi_cc
+    enricher._geoip_cache = GeoIPCache(enricher._lookup_asn_and_cc, cache_size)
+    return enricher
+
+
+def bench(enricher, stream):
+    start = time.time()
+    for ip in stream:
+        enricher.ip_to_asn(ip)
+        enricher.ip_to_cc(ip)
+    return (time.time() - start) / len(stream)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--lookups', type=int, default=200000)
+    arg_parser.add_argument('--addresses', type=int, default=100000)
+    arg_parser.add_argument('--zipf-s', type=float, default=1.1)
+    arg_parser.add_argument('--cache-sizes', default='0,1000,10000,100000')
+    arg_parser.add_argument('--asn-db')
+    arg_parser.add_argument('--city-db')
+    arg_parser.add_argument('--synthetic-lookup-us', type=float, default=20)
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.asn_db and args.city_db:
+        gi_asn = database.Reader(args.asn_db, mode=maxminddb.const.MODE_MEMORY)
+        gi_cc = database.Reader(args.city_db, mode=maxminddb.const.MODE_MEMORY)
+        readers_label = 'GeoIP databases: {}, {}'.format(args.asn_db, args.city_db)
+    else:
+        gi_asn = gi_cc = SyntheticReader(args.synthetic_lookup_us / 1e6)
+        readers_label = 'synthetic GeoIP reader ({} us per lookup)'.format(
+            args.synthetic_lookup_us)
+    stream = make_address_stream(args.lookups, args.addresses, args.zipf_s)
+    print readers_label
+    print '{} lookups of {} distinct addresses (Zipf s={})'.format(
+        args.lookups, len(set(stream)), args.zipf_s)
+    print '  {:<12} {:>18} {:>10}'.format('cache size', 'time per address', 'hit ratio')
+    for cache_size in [int(s) for s in args.cache_sizes.split(',')]:
+        enricher = make_enricher(gi_asn, gi_cc, cache_size)
+        duration = bench(enricher, stream)
+        print '  {:<12} {:>15.2f} us {:>10.3f}'.format(
+            cache_size, duration * 1e6, enricher._geoip_cache.hit_ratio)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+"""
+Benchmark: GeoIP lookups of enricher workers -- databases vs. the range table.
+
+Compiles the GeoIP ASN and City databases into a range table (see:
+`n6.utils.geoip_range_table`), and then compares the geoip2 database
+readers (in `MODE_MEMORY`, as used by the Enricher) with the memory-
+mapped range table: the average time of getting the ASN and the CC of
+a random IPv4 address, and the memory usage of the given number of
+worker processes (each making lookups) -- measured as the total growth
+of their proportional set sizes (PSS), so that the memory shared
+between the processes is counted once.
+
+The GeoIP databases can be specified with `--asn-db` and `--city-db`;
+otherwise, synthetic ones (with the given number of random networks)
+are generated.
+
+Usage:
+
+    python bench_enrich_geoip_range_table.py [--workers N] [--lookups N]
+        [--asn-db PATH --city-db PATH | --networks N]
+"""
+
+import argparse
+import os
+import os.path as osp
+import random
+import shutil
+import socket
+import struct
+import tempfile
+import time
+
+import maxminddb.const
+from geoip2 import database, errors
+
+from n6.tests.utils._geoip_test_helpers import (
+    make_random_asn_record,
+    make_random_city_record,
+    make_random_networks,
+    write_mmdb,
+)
+from n6.utils.geoip_range_table import (
+    GeoIPRangeTable,
+    compile_range_table,
+)
+
+
+def write_synthetic_databases(tmp_dir, network_count):
+    rnd = random.Random(42)
+    asn_records = [make_random_asn_record(rnd) for _ in xrange(network_count // 20 + 1)]
+    city_records = [make_random_city_record(rnd) for _ in xrange(network_count // 5 + 1)]
+    asn_db_path = osp.join(tmp_dir, 'asn.mmdb')
+    city_db_path = osp.join(tmp_dir, 'city.mmdb')
+    # (networks not larger than /20 -- so that they rarely overlap)
+    write_mmdb(asn_db_path, 'GeoLite2-ASN',
+               [(net, rnd.choice(asn_records))
+                for net in make_random_networks(network_count, rnd, min_prefix_length=20)])
+    write_mmdb(city_db_path, 'GeoLite2-City',
+               [(net, rnd.choice(city_records))
+                for net in make_random_networks(network_count, rnd, min_prefix_length=20)])
+    return asn_db_path, city_db_path
+
+
+def make_geoip2_lookup(asn_db_path, city_db_path):
+    gi_asn = database.Reader(asn_db_path, mode=maxminddb.const.MODE_MEMORY)
+    gi_cc = database.Reader(city_db_path, mode=maxminddb.const.MODE_MEMORY)
+    def lookup(ip):
+        try:
+            asn = gi_asn.asn(ip).autonomous_system_number
+        except errors.GeoIP2Error:
+            asn = None
+        try:
+            cc = gi_cc.city(ip).country.iso_code
+        except errors.GeoIP2Error:
+            cc = None
+        return asn, cc
+    return lookup
+
+
+def make_range_table_lookup(table_path):
+    return GeoIPRangeTable(table_path).lookup
+
+
+def make_no_lookup():
+    return lambda ip: None
+
+
+def get_pss_kb(pid):
+    path = '/proc/{}/smaps_rollup'.format(pid)
+    if not osp.exists(path):
+        path = '/proc/{}/smaps'.format(pid)
+    with open(path) as f:
+        return sum(int(line.split()[1]) for line in f if line.startswith('Pss:'))
+
+
+def run_workers(make_lookup, ips, worker_count):
+    """Get the total PSS (in KiB) of the workers, all alive at the same time."""
+    ready_read_fd, ready_write_fd = os.pipe()
+    exit_read_fd, exit_write_fd = os.pipe()
+    pids = []
+    for _ in xrange(worker_count):
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read_fd)
+            os.close(exit_write_fd)
+            lookup = make_lookup()
+            for ip in ips:
+                lookup(ip)
+            os.write(ready_write_fd, '.')
+            os.read(exit_read_fd, 1)  # (waiting until the parent closes the pipe)
+            os._exit(0)
+        pids.append(pid)
+    os.close(ready_write_fd)
+    os.close(exit_read_fd)
+    for _ in pids:
+        os.read(ready_read_fd, 1)
+    total_pss_kb = sum(get_pss_kb(pid) for pid in pids)
+    os.close(exit_write_fd)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    os.close(ready_read_fd)
+    return total_pss_kb
+
+
+def bench_lookups(lookup, ips):
+    start = time.time()
+    results = [lookup(ip) for ip in ips]
+    return (time.time() - start) / len(ips), results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--workers', type=int, default=4)
+    arg_parser.add_argument('--lookups', type=int, default=20000)
+    arg_parser.add_argument('--asn-db')
+    arg_parser.add_argument('--city-db')
+    arg_parser.add_argument('--networks', type=int, default=50000)
+    args = arg_parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        if args.asn_db and args.city_db:
+            asn_db_path, city_db_path = args.asn_db, args.city_db
+        else:
+            asn_db_path, city_db_path = write_synthetic_databases(tmp_dir, args.networks)
+            print 'synthetic GeoIP databases ({} random networks each)'.format(args.networks)
+        table_path = osp.join(tmp_dir, 'ranges.bin')
+        start = time.time()
+        range_count = compile_range_table(asn_db_path, city_db_path, table_path)
+        print 'database sizes: {} + {} bytes'.format(osp.getsize(asn_db_path),
+                                                     osp.getsize(city_db_path))
+        print 'range table: {} ranges, {} bytes, compiled in {:.1f}s'.format(
+            range_count, osp.getsize(table_path), time.time() - start)
+
+        rnd = random.Random(42)
+        ips = [socket.inet_ntoa(struct.pack('!I', rnd.getrandbits(32)))
+               for _ in xrange(args.lookups)]
+        baseline_pss_kb = run_workers(make_no_lookup, ips, args.workers)
+        print '{} lookups of random IPv4 addresses, {} worker processes'.format(
+            args.lookups, args.workers)
+        print '  {:<20} {:>16} {:>22}'.format('', 'time per lookup', 'PSS growth (total)')
+        all_results = []
+        for label, make_lookup in [
+                ('geoip2 databases', lambda: make_geoip2_lookup(asn_db_path, city_db_path)),
+                ('range table', lambda: make_range_table_lookup(table_path))]:
+            lookup_time, results = bench_lookups(make_lookup(), ips)
+            all_results.append(results)
+            pss_growth_kb = run_workers(make_lookup, ips, args.workers) - baseline_pss_kb
+            print '  {:<20} {:>13.2f} us {:>18} KiB'.format(
+                label, lookup_time * 1e6, pss_growth_kb)
+        assert all_results[0] == all_results[1]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
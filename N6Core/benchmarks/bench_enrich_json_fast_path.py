@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+"""
+Benchmark: the Enricher's processing of messages, with the JSON-level fast path.
+
+Generates messages (as produced by parsers, i.e., from `RecordDict`s)
+of a few kinds -- events without any address/FQDN/URL (passing through
+the Enricher unchanged, except for the `enriched` item), events with
+addresses (getting ASNs and CCs) and events with URLs (getting FQDNs
+and addresses) -- and measures the average time of processing a
+message by `Enricher.input_callback()` (the DNS and GeoIP lookups
+are stubbed out) with the regular path and with the fast path (see:
+the `json_fast_path` config option). The outputs are checked to be
+the same.
+
+Usage:
+
+    python bench_enrich_json_fast_path.py [--messages N]
+"""
+
+import argparse
+import logging
+import random
+import time
+
+from n6.utils.enrich import (
+    Enricher,
+    GeoIPCache,
+    IPRangeIndex,
+)
+from n6lib.record_dict import RecordDict
+
+
+def make_bodies(kind, count):
+    rnd = random.Random(42)
+    bodies = []
+    for i in xrange(count):
+        data = RecordDict({
+            'id': '{:032x}'.format(i),
+            'rid': '{:032x}'.format(i + 10 ** 9),
+            'source': 'some-source.channel',
+            'restriction': 'public',
+            'confidence': 'medium',
+            'category': 'bots',
+            'time': '2020-01-01 00:00:{:02}'.format(i % 60),
+            'name': 'some-botnet',
+            'dport': rnd.randrange(1, 65536),
+            'proto': 'tcp',
+        })
+        if kind == 'address':
+            data['address'] = [{'ip': '{}.{}.{}.{}'.format(rnd.randrange(1, 224),
+                                                           rnd.randrange(256),
+                                                           rnd.randrange(256),
+                                                           rnd.randrange(1, 255))}]
+        elif kind == 'url':
+            data['url'] = 'http://host-{}.example.com/path/{}'.format(i % 100, i)
+        bodies.append(data.get_ready_json())
+    return bodies
+
+
+def make_enricher(json_fast_path, outputs):
+    enricher = Enricher.__new__(Enricher)
+    enricher._json_fast_path = json_fast_path
+    enricher.excluded_ips = IPRangeIndex('10.0.0.0/8', '127.0.0.0/8')
+    enricher._geoip_cache = GeoIPCache(lambda ip: (int(ip.split('.')[0]), 'PL'))
+    enricher.fqdn_to_ip = lambda fqdn: ['192.0.2.{}'.format(len(fqdn))]
+    enricher.publish_output = lambda routing_key, body: outputs.append(body)
+    return enricher
+
+
+def bench(enricher, bodies):
+    start = time.time()
+    for body in bodies:
+        enricher.input_callback('event.parsed.some-source.channel', body, None)
+    return (time.time() - start) / len(bodies)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--messages', type=int, default=20000)
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    print '{} messages of each kind'.format(args.messages)
+    print '  {:<16} {:>16} {:>16} {:>10}'.format('', 'regular path', 'fast path', 'speedup')
+    for kind in ('no address', 'address', 'url'):
+        bodies = make_bodies(kind, args.messages)
+        durations = []
+        all_outputs = []
+        for json_fast_path in (False, True):
+            outputs = []
+            durations.append(bench(make_enricher(json_fast_path, outputs), bodies))
+            all_outputs.append(outputs)
+        assert all_outputs[0] == all_outputs[1]
+        print '  {:<16} {:>13.1f} us {:>13.1f} us {:>9.2f}x'.format(
+            kind, durations[0] * 1e6, durations[1] * 1e6, durations[0] / durations[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -37,6 +37,7 @@ from n6.collectors.generic import (
     entry_point_factory,
 )
 from n6lib.common_helpers import (
+    iter_results_concurrently,
     make_exc_ascii_str,
     read_file,
     reduce_indent,
@@ -45,6 +46,10 @@ from n6lib.csv_helpers import split_csv_row
 from n6lib.datetime_helpers import parse_iso_datetime_to_utc
 from n6lib.http_helpers import RequestPerformer
 from n6lib.log_helpers import get_logger
+from n6lib.unpacking_helpers import (
+    UnpackedDataTooLargeError,
+    iter_unzip_from_file,
+)
 
 
 
@@ -459,23 +464,39 @@ class AbuseChUrlhausUrlsCollector(_BaseAbuseChDownloadingTimeOrderedRowsCollecto
         reduce_indent('''
             api_url :: str
             api_retries = 3 :: int
+            api_concurrency = 8 :: int  ; max number of concurrent API requests
         '''))
 
     time_field_index = 1
 
+    def __init__(self, **kwargs):
+        super(AbuseChUrlhausUrlsCollector, self).__init__(**kwargs)
+        self._url_info_cache = {}   # {<url_id>: <url info (str) fetched from API>}
+
     def get_source_channel(self, **processed_data):
         return 'urlhaus-urls'
 
     def prepare_selected_data(self, fresh_rows):
-        abuse_info_dicts = [self._make_abuse_info_dict(row) for row in fresh_rows]
+        abuse_info_dicts = [self._convert_row_to_info_dict(row) for row in fresh_rows]
+        self._fetch_missing_url_infos(abuse_info_dict['url_id']
+                                      for abuse_info_dict in abuse_info_dicts)
+        for abuse_info_dict in abuse_info_dicts:
+            url_info = self._url_info_cache[abuse_info_dict['url_id']]
+            abuse_info_dict['url_info_from_api'] = json.loads(url_info)
         return json.dumps(abuse_info_dicts)
 
-    def _make_abuse_info_dict(self, row):
-        abuse_info_dict = self._convert_row_to_info_dict(row)
-        url_id = abuse_info_dict['url_id']
-        url_info = self._fetch_url_info_from_api(url_id)
-        abuse_info_dict['url_info_from_api'] = json.loads(url_info)
-        return abuse_info_dict
+    def _fetch_missing_url_infos(self, url_ids):
+        missing_url_ids = []
+        for url_id in url_ids:
+            if url_id not in self._url_info_cache:
+                self._url_info_cache[url_id] = None
+                missing_url_ids.append(url_id)
+        fetched_url_infos = list(iter_results_concurrently(
+            self._fetch_url_info_from_api,
+            missing_url_ids,
+            max_workers=self.config['api_concurrency']))
+        for url_id, url_info in zip(missing_url_ids, fetched_url_infos):
+            self._url_info_cache[url_id] = url_info
 
     def _convert_row_to_info_dict(self, row):
         row_fields = split_csv_row(row)
@@ -535,6 +556,11 @@ class AbuseChUrlhausPayloadsCollector(CollectorWithStateMixin,
         ignored_zip_filenames = :: list_of_zip_filenames
         oldest_zip_filename_to_collect = 2019-03-01.zip :: zip_filename
         newest_zip_filename_to_collect = "" :: zip_filename
+        api_concurrency = 8 :: int  ; max number of concurrent API requests
+        state_store = pickle :: str  ; "pickle" or "sqlite"
+        state_retention_days = 0 :: int  ; for "sqlite" (0 means: no limit)
+        payload_max_size = 0 :: int  ; in bytes (0 means: no limit)
+        unpacked_archive_max_size = 0 :: int  ; in bytes (0 means: no limit)
     '''
 
     @property
@@ -569,6 +595,7 @@ class AbuseChUrlhausPayloadsCollector(CollectorWithStateMixin,
     ARCHIVE_FILE_EXTENSION = '.zip'
     HTTP_RETRIES = 5
     TEMP_DIR_NAME_PREFIX = 'n6collector_abusechurlhauspayloads_'
+    UNZIP_CHUNK_SIZE = 2 ** 20
     VALID_ZIP_FILENAME_REGEX = re.compile(r'\A\d{4}-\d{2}-\d{2}%s\Z'
                                           % re.escape(ARCHIVE_FILE_EXTENSION))
     VALID_PAYLOAD_FILENAME_REGEX = re.compile(r'\A[0-9a-f]{32}\Z')
@@ -593,6 +620,7 @@ class AbuseChUrlhausPayloadsCollector(CollectorWithStateMixin,
         self._oldest_zip_filename_to_collect = self.config['oldest_zip_filename_to_collect']
         self._newest_zip_filename_to_collect = self.config['newest_zip_filename_to_collect']
         self._state = None                              # to be set in run_handling()
+        self._payload_info_cache = {}                   # {<payload filename>: <payload info>}
         self._clear_attributes_per_single_zip()
 
     def _clear_attributes_per_single_zip(self):         # We will set them, respectively:
@@ -729,20 +757,37 @@ class AbuseChUrlhausPayloadsCollector(CollectorWithStateMixin,
     def _unzip_file(self, zip_filepath, unpacked_dir):
         at_least_one_extracted = False
         with contextlib.closing(ZipFile(zip_filepath, 'r')) as zipped_file:
-            os.mkdir(unpacked_dir)
-            for payload_filename in zipped_file.namelist():
-                if self.VALID_PAYLOAD_FILENAME_REGEX.search(payload_filename):
-                    zipped_file.extract(member=payload_filename,
-                                        path=unpacked_dir,
-                                        pwd=self.config['zip_file_password'])
-                    at_least_one_extracted = True
-                    LOGGER.debug('Payload whose filename is %r -- extracted '
-                                 'from ZIP archive %r -- into directory %r',
-                                 payload_filename, zip_filepath, unpacked_dir)
-                else:
-                    LOGGER.warning('Payload filename: %r - does not match the required '
-                                   'pattern. Containing ZIP file\'s path: %r',
-                                   payload_filename, zip_filepath)
+            all_payload_filenames = zipped_file.namelist()
+        valid_payload_filenames = set()
+        for payload_filename in all_payload_filenames:
+            if self.VALID_PAYLOAD_FILENAME_REGEX.search(payload_filename):
+                valid_payload_filenames.add(payload_filename)
+            else:
+                LOGGER.warning('Payload filename: %r - does not match the required '
+                               'pattern. Containing ZIP file\'s path: %r',
+                               payload_filename, zip_filepath)
+        os.mkdir(unpacked_dir)
+        for payload_filename, payload_file in iter_unzip_from_file(
+                zip_filepath,
+                password=self.config['zip_file_password'],
+                filenames=valid_payload_filenames,
+                max_member_size=(self.config['payload_max_size'] or None),
+                max_total_size=(self.config['unpacked_archive_max_size'] or None),
+                zipfile_class=ZipFile):
+            payload_filepath = os.path.join(unpacked_dir, payload_filename)
+            try:
+                with open(payload_filepath, 'wb') as f:
+                    shutil.copyfileobj(payload_file, f, self.UNZIP_CHUNK_SIZE)
+            except UnpackedDataTooLargeError as exc:
+                self._try_to_remove_file(payload_filepath)
+                LOGGER.warning('Payload whose filename is %r -- from ZIP archive '
+                               '%r -- skipped (%s)',
+                               payload_filename, zip_filepath, make_exc_ascii_str(exc))
+                continue
+            at_least_one_extracted = True
+            LOGGER.debug('Payload whose filename is %r -- extracted '
+                         'from ZIP archive %r -- into directory %r',
+                         payload_filename, zip_filepath, unpacked_dir)
         if not at_least_one_extracted:
             raise ValueError(
                 'no payload extracted from the {!r} archive (something '
@@ -758,8 +803,17 @@ class AbuseChUrlhausPayloadsCollector(CollectorWithStateMixin,
 
     def _get_payload_filename_and_info_pairs(self, unpacked_dir):
         filenames = os.listdir(unpacked_dir)
+        missing_filenames = [payload_filename
+                             for payload_filename in sorted(set(filenames))
+                             if payload_filename not in self._payload_info_cache]
+        fetched_payload_infos = list(iter_results_concurrently(
+            self._get_payload_info,
+            missing_filenames,
+            max_workers=self.config['api_concurrency']))
+        for payload_filename, payload_info in zip(missing_filenames, fetched_payload_infos):
+            self._payload_info_cache[payload_filename] = payload_info
         payload_filename_and_info_pairs = [(payload_filename,
-                                            self._get_payload_info(payload_filename))
+                                            self._payload_info_cache[payload_filename])
                                            for payload_filename in filenames]
         return payload_filename_and_info_pairs
 
@@ -6,11 +6,13 @@
 Collector base classes + auxiliary tools.
 """
 
+import contextlib
 import cPickle
 import datetime
 import hashlib
 import json
 import os
+import sqlite3
 import sys
 import time
 import urllib
@@ -36,12 +38,28 @@ from n6lib.log_helpers import (
     get_logger,
     logging_configured,
 )
+from n6lib.state_store import (
+    SQLiteStateStore,
+    StateNotFoundError,
+)
 
 
 
 LOGGER = get_logger(__name__)
 
 
+# names of HTTP response headers whose values (if present) are stored
+# -- so that, for the next download, they can be used in the headers
+# of a conditional request (see: `make_conditional_request_headers()`)
+HTTP_CACHE_VALIDATOR_HEADERS = ('ETag', 'Last-Modified')
+
+# {<validator response header>: <corresponding conditional request header>}
+_CONDITIONAL_REQUEST_HEADERS = {
+    'ETag': 'If-None-Match',
+    'Last-Modified': 'If-Modified-Since',
+}
+
+
 
 #
 # Exceptions
@@ -128,12 +146,34 @@ class CollectorWithStateMixin(object):
 
     Any picklable object can be saved as a state and then be retrieved
     as an object of the same type.
+
+    By default, the state is pickled (as a whole) to a file in the
+    cache directory. If the `state_store` config option is set to
+    "sqlite", the state is kept in an SQLite database file instead
+    (see: n6lib.state_store.SQLiteStateStore) -- then saving a `dict`
+    state causes writes only for its items (and members of its `set`
+    values) that have changed; also, if the `state_retention_days`
+    option is set to a positive number, items of a `dict` state that
+    have not been changed for that many days are dropped. An existing
+    pickle file is migrated to the database on the first load (and
+    then it is renamed, by appending the ".migrated" suffix).
     """
 
+    PICKLE_STATE_STORE = 'pickle'
+    SQLITE_STATE_STORE = 'sqlite'
+
     def __init__(self, *args, **kwargs):
         super(CollectorWithStateMixin, self).__init__(*args, **kwargs)
         self._cache_file_path = os.path.join(os.path.expanduser(
             self.config['cache_dir']), self.get_cache_file_name())
+        self._state_store_kind = self.config.get('state_store', self.PICKLE_STATE_STORE)
+        if self._state_store_kind not in (self.PICKLE_STATE_STORE, self.SQLITE_STATE_STORE):
+            raise ConfigError('illegal value of the `state_store` option: {!r} '
+                              '(should be "{}" or "{}")'.format(self._state_store_kind,
+                                                                self.PICKLE_STATE_STORE,
+                                                                self.SQLITE_STATE_STORE))
+        self._state_retention_days = int(self.config.get('state_retention_days', 0))
+        self._sqlite_state_store = None   # to be set in _get_sqlite_state_store()
 
     def load_state(self):
         """
@@ -143,9 +183,12 @@ class CollectorWithStateMixin(object):
             Unpickled object of its original type.
         """
         try:
-            with open(self._cache_file_path, 'rb') as cache_file:
-                state = cPickle.load(cache_file)
-        except (EnvironmentError, ValueError, EOFError) as exc:
+            if self._state_store_kind == self.SQLITE_STATE_STORE:
+                state = self._load_state_from_sqlite_store()
+            else:
+                state = self._load_state_from_pickle_file()
+        except (EnvironmentError, ValueError, EOFError,
+                StateNotFoundError, sqlite3.Error) as exc:
             state = self.make_default_state()
             LOGGER.warning(
                 "Could not load state (%s), returning: %r",
@@ -167,10 +210,40 @@ class CollectorWithStateMixin(object):
             os.makedirs(cache_dir, 0700)
         except OSError:
             pass
-        with open(self._cache_file_path, 'wb') as cache_file:
-            cPickle.dump(state, cache_file, cPickle.HIGHEST_PROTOCOL)
+        if self._state_store_kind == self.SQLITE_STATE_STORE:
+            self._get_sqlite_state_store().save(state)
+        else:
+            with open(self._cache_file_path, 'wb') as cache_file:
+                cPickle.dump(state, cache_file, cPickle.HIGHEST_PROTOCOL)
         LOGGER.info("Saved state: %r", state)
 
+    def _load_state_from_pickle_file(self):
+        with open(self._cache_file_path, 'rb') as cache_file:
+            return cPickle.load(cache_file)
+
+    def _load_state_from_sqlite_store(self):
+        store = self._get_sqlite_state_store()
+        if store.is_empty() and os.path.exists(self._cache_file_path):
+            state = self._load_state_from_pickle_file()
+            store.save(state)
+            os.rename(self._cache_file_path, self._cache_file_path + '.migrated')
+            LOGGER.info("Migrated state from %r to %r",
+                        self._cache_file_path, self._get_sqlite_state_store_path())
+            return state
+        return store.load()
+
+    def _get_sqlite_state_store(self):
+        if self._sqlite_state_store is None:
+            retention_period = (self._state_retention_days * 24 * 3600
+                                if self._state_retention_days > 0
+                                else None)
+            self._sqlite_state_store = SQLiteStateStore(self._get_sqlite_state_store_path(),
+                                                        retention_period=retention_period)
+        return self._sqlite_state_store
+
+    def _get_sqlite_state_store_path(self):
+        return os.path.splitext(self._cache_file_path)[0] + '.sqlite'
+
     def get_cache_file_name(self):
         source_channel = self.get_source_channel()
         source = self.get_source(source_channel=source_channel)
@@ -667,6 +740,8 @@ class BaseUrlDownloaderCollector(BaseCollector):
     def __init__(self, **kwargs):
         self._output_components = None
         self._http_last_modified = None
+        self._http_validators = None    # to be set in _download_retry(url, conditional=True)
+        self._http_not_modified = False
         super(BaseUrlDownloaderCollector, self).__init__(**kwargs)
 
     def run_handling(self):
@@ -677,6 +752,7 @@ class BaseUrlDownloaderCollector(BaseCollector):
         if body:
             self._output_components = rk, body, props
             self.run()
+            self._save_http_validators()
         else:
             LOGGER.info('No data')
         LOGGER.info('Stopped')
@@ -687,13 +763,17 @@ class BaseUrlDownloaderCollector(BaseCollector):
         the parent method.
         """
         self._http_last_modified = None
+        self._http_not_modified = False
         return super(BaseUrlDownloaderCollector, self).get_output_components(**kwargs)
 
     def get_source_channel(self, **kwargs):
         raise NotImplementedError
 
     def get_output_data_body(self, **kwargs):
-        result = self._download_retry(self.config['url'])
+        result = self._download_retry(self.config['url'], conditional=True)
+        if self._http_not_modified:
+            LOGGER.info('Data at %r not modified since the previous download', self.config['url'])
+            return ''
         if result is not None:
             return self.process_data(result)
         else:
@@ -711,12 +791,19 @@ class BaseUrlDownloaderCollector(BaseCollector):
     def process_data(self, data):
         raise NotImplementedError
 
-    def _download_retry(self, url):
+    def _download_retry(self, url, conditional=False):
         """
         Try downloading URL until succes or timeout.
 
         Args:
             url: Url to download from
+            conditional (default: False):
+                If true *and* the `cache_dir` config option is set,
+                a conditional request is made -- based on the `ETag`
+                and `Last-Modified` response headers stored for this
+                URL during a previous run (if any); if the server
+                replies with *304 Not Modified*, `None` is returned and
+                the `_http_not_modified` attribute is set to `True`.
 
         Returns:
             data read from url
@@ -734,8 +821,14 @@ class BaseUrlDownloaderCollector(BaseCollector):
             else:
                 data_dict = None
 
-            result = self._download_url(url, data_dict, auth_user, auth_passwd)
+            request_headers = (self._get_conditional_request_headers(url) if conditional
+                               else None)
+            result = self._download_url(url, data_dict, auth_user, auth_passwd,
+                                        request_headers=request_headers)
 
+            if result is not None and result.code == 304:
+                self._http_not_modified = True
+                return None
             if result is None:
                 now = datetime.datetime.utcnow()
                 duration = (now - start).seconds
@@ -747,6 +840,8 @@ class BaseUrlDownloaderCollector(BaseCollector):
                 time.sleep(int(self.config["retry_timeout"]))
             else:
                 self._try_to_set_http_last_modified(result.headers)
+                if conditional:
+                    self._http_validators = (url, get_http_validators(result.headers))
                 downloaded = True
         return result.read()
 
@@ -778,7 +873,8 @@ class BaseUrlDownloaderCollector(BaseCollector):
         return result.read()
 
     @classmethod
-    def _download_url(cls, url, data_dict=None, auth_user=None, auth_passwd=None):
+    def _download_url(cls, url, data_dict=None, auth_user=None, auth_passwd=None,
+                      request_headers=None):
         """Download data from given URL
 
         Args:
@@ -786,10 +882,13 @@ class BaseUrlDownloaderCollector(BaseCollector):
             data_dict: optional dictionary to pass in POST request
             auth_user: optional user identifier
             auth_passwd: optional user password
+            request_headers: optional dictionary of additional headers
 
         Returns:
             urllib2.urlopen: data downloaded from URL
                 or None when error occures
+                (for a *304 Not Modified* response: the
+                urllib2.HTTPError instance, whose `code` is 304)
         """
         if auth_user is not None and auth_passwd is not None:
             password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
@@ -804,9 +903,14 @@ class BaseUrlDownloaderCollector(BaseCollector):
             req = urllib2.Request(url, data_string)
         else:
             req = urllib2.Request(url)
+        for key, value in (request_headers or {}).iteritems():
+            req.add_header(key, value)
         data = None
         try:
             data = opener.open(req, timeout=60)
+        except urllib2.HTTPError as exc:
+            if exc.code == 304:
+                data = exc
         except urllib2.URLError:
             pass
 
@@ -824,6 +928,45 @@ class BaseUrlDownloaderCollector(BaseCollector):
                     self._http_last_modified = parsed_datetime
                     break
 
+    def _get_conditional_request_headers(self, url):
+        stored_url, http_validators = self._load_http_validators() or (None, None)
+        if stored_url != url:
+            return None
+        return make_conditional_request_headers(http_validators)
+
+    def _get_http_validators_file_path(self):
+        cache_dir = self.config.get('cache_dir')
+        if not cache_dir:
+            # (the conditional requests feature is not enabled)
+            return None
+        source_channel = self.get_source_channel()
+        source = self.get_source(source_channel=source_channel)
+        return os.path.join(os.path.expanduser(cache_dir),
+                            '{}.{}.http_validators.pickle'.format(source,
+                                                                  self.__class__.__name__))
+
+    def _load_http_validators(self):
+        file_path = self._get_http_validators_file_path()
+        if file_path is None:
+            return None
+        try:
+            with open(file_path, 'rb') as f:
+                return cPickle.load(f)
+        except (EnvironmentError, ValueError, EOFError) as exc:
+            LOGGER.info("Could not load HTTP cache validators (%s)", make_exc_ascii_str(exc))
+            return None
+
+    def _save_http_validators(self):
+        file_path = self._get_http_validators_file_path()
+        if file_path is None or self._http_validators is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(file_path), 0700)
+        except OSError:
+            pass
+        with open(file_path, 'wb') as f:
+            cPickle.dump(self._http_validators, f, cPickle.HIGHEST_PROTOCOL)
+
 
 class BaseRSSCollector(BaseOneShotCollector, BaseUrlDownloaderCollector):
 
@@ -927,8 +1070,18 @@ class BaseTimeOrderedRowsCollector(CollectorWithStateMixin, BaseCollector):
     def run_handling(self):
         self._state = self.load_state()
         orig_data = self.obtain_orig_data()
+        if orig_data is None:
+            LOGGER.info('No new data')
+            return
         all_rows = self.split_orig_data_into_rows(orig_data)
-        fresh_rows = self.get_fresh_rows_only(all_rows)
+        try:
+            fresh_rows = self.get_fresh_rows_only(all_rows)
+        finally:
+            # if `all_rows` is a lazy iterator (e.g., yielding rows as
+            # they are being downloaded) -- stop reading the rest of it
+            close = getattr(all_rows, 'close', None)
+            if close is not None:
+                close()
         if fresh_rows:
             self._selected_data = self.prepare_selected_data(fresh_rows)
             super(BaseTimeOrderedRowsCollector, self).run_handling()
@@ -991,7 +1144,10 @@ class BaseTimeOrderedRowsCollector(CollectorWithStateMixin, BaseCollector):
 
     def obtain_orig_data(self):
         """
-        Abstract method: obtain the original raw data and return it.
+        Abstract method: obtain the original raw data and return it
+        (or return `None` -- if it is known in advance that there is
+        no new data, e.g., because a *304 Not Modified* HTTP response
+        has been received).
 
         Example implementation:
 
@@ -1010,7 +1166,19 @@ class BaseTimeOrderedRowsCollector(CollectorWithStateMixin, BaseCollector):
     # * splitting original data and re-joining/preparing selected data:
 
     def split_orig_data_into_rows(self, orig_data):
-        return orig_data.split('\n')
+        """
+        Split the original data into rows.
+
+        The default implementation splits `orig_data` by newline
+        characters -- if it is a string; otherwise, `orig_data` is
+        expected to be an iterable of rows already (e.g., an iterator
+        that yields lines as they are being downloaded -- see:
+        `BaseDownloadingTimeOrderedRowsCollector.obtain_orig_data()`),
+        so it is returned intact.
+        """
+        if isinstance(orig_data, basestring):
+            return orig_data.split('\n')
+        return orig_data
 
     def prepare_selected_data(self, fresh_rows):
         return '\n'.join(fresh_rows)
@@ -1018,6 +1186,14 @@ class BaseTimeOrderedRowsCollector(CollectorWithStateMixin, BaseCollector):
     # * selection of fresh rows:
 
     def get_fresh_rows_only(self, all_rows):
+        """
+        Select the rows that have not been collected yet.
+
+        `all_rows` is iterated over only until the first row older
+        than the newest row time recorded in the state is encountered
+        (so if `all_rows` is a lazy iterator, the rest of the rows are
+        not even obtained).
+        """
         prev_newest_row_time = self._state[self._NEWEST_ROW_TIME_STATE_KEY]
         prev_newest_rows = self._state[self._NEWEST_ROWS_STATE_KEY]
 
@@ -1230,10 +1406,16 @@ class BaseDownloadingCollector(BaseCollector):
     # of the `download_retries` option.
     DEFAULT_DOWNLOAD_RETRIES_IF_NOT_SPECIFIED = 10
 
+    # This constant is used only if neither config files nor
+    # defaults in the config spec (if any) provide the value
+    # of the `download_max_size` option (0 means: no limit).
+    DEFAULT_DOWNLOAD_MAX_SIZE_IF_NOT_SPECIFIED = 0
+
     def __init__(self):
         super(BaseDownloadingCollector, self).__init__()
         self._http_response = None          # to be set in download()
         self._http_last_modified = None     # to be set in download()
+        self._http_not_modified = False     # to be set in download()
 
     @property
     def http_response(self):
@@ -1243,22 +1425,91 @@ class BaseDownloadingCollector(BaseCollector):
     def http_last_modified(self):
         return self._http_last_modified
 
+    @property
+    def http_not_modified(self):
+        """
+        Whether the response to the last request was *304 Not Modified*
+        (then no content is returned/yielded by `download*()`).
+        """
+        return self._http_not_modified
+
+    @property
+    def http_validators(self):
+        """
+        A dict of the `ETag`/`Last-Modified` headers of the response to
+        the last request (see: `make_conditional_request_headers()`).
+        """
+        if self._http_response is None:
+            return {}
+        return get_http_validators(self._http_response.headers)
+
     def download(self,
                  url,
                  method='GET',
                  retries=None,
                  custom_request_headers=None,
+                 max_size=None,
                  **rest_performer_constructor_kwargs):
+        """
+        Download all content at once and return it (as a str).
+
+        The content is read in chunks, so that the size limit (see:
+        the `max_size` argument and the `download_max_size` config
+        option) is enforced as soon as it is exceeded (then
+        `n6lib.http_helpers.ResponseTooLargeError` is raised).
+        """
+        with self._performing_request(url, method, retries, custom_request_headers,
+                                      max_size, rest_performer_constructor_kwargs) as perf:
+            return ''.join(perf)
+
+    def download_incrementally(self,
+                               url,
+                               method='GET',
+                               retries=None,
+                               custom_request_headers=None,
+                               max_size=None,
+                               split_into_lines=False,
+                               **rest_performer_constructor_kwargs):
+        """
+        Download the content, yielding it chunk by chunk (or line by line).
+
+        Args/kwargs: the same as for `download()`, plus:
+            `split_into_lines` (default: False):
+                If true, consecutive lines (without the trailing newline
+                characters) are yielded -- instead of raw data chunks.
+
+        Returns:
+            A generator; the request is made when its first item is
+            requested, and the underlying HTTP session is closed when
+            the generator is exhausted or closed.
+        """
+        with self._performing_request(url, method, retries, custom_request_headers,
+                                      max_size, rest_performer_constructor_kwargs) as perf:
+            if self._http_not_modified:
+                return
+            for item in (perf.iter_lines() if split_into_lines else perf):
+                yield item
+
+    def _performing_request(self, url, method, retries, custom_request_headers, max_size,
+                            rest_performer_constructor_kwargs):
         retries = self._get_request_retries(retries)
         headers = self._get_request_headers(custom_request_headers)
-        with RequestPerformer(method=method,
-                              url=url,
-                              retries=retries,
-                              headers=headers,
-                              **rest_performer_constructor_kwargs) as perf:
+        max_size = self._get_request_max_size(max_size)
+        perf = RequestPerformer(method=method,
+                                url=url,
+                                retries=retries,
+                                headers=headers,
+                                max_size=max_size,
+                                **rest_performer_constructor_kwargs)
+        return self._http_response_recorded(perf)
+
+    @contextlib.contextmanager
+    def _http_response_recorded(self, perf):
+        with perf:
             self._http_response = perf.response
             self._http_last_modified = perf.get_dt_header('Last-Modified')
-            return perf.response.content
+            self._http_not_modified = (perf.response.status_code == 304)
+            yield perf
 
     def _get_request_retries(self, retries):
         if retries is None:
@@ -1266,6 +1517,12 @@ class BaseDownloadingCollector(BaseCollector):
                                       self.DEFAULT_DOWNLOAD_RETRIES_IF_NOT_SPECIFIED)
         return retries
 
+    def _get_request_max_size(self, max_size):
+        if max_size is None:
+            max_size = self.config.get('download_max_size',
+                                       self.DEFAULT_DOWNLOAD_MAX_SIZE_IF_NOT_SPECIFIED)
+        return max_size or None
+
     def _get_request_headers(self, custom_request_headers):
         base_request_headers = self.config.get('base_request_headers', {})
         if not isinstance(base_request_headers, dict):
@@ -1296,15 +1553,100 @@ class BaseDownloadingTimeOrderedRowsCollector(BaseDownloadingCollector,
         cache_dir :: str
         url :: str
         download_retries = 10 :: int
+        download_max_size = 0 :: int  ; in bytes (0 means: no limit)
         base_request_headers = {{}} :: py
+        state_store = pickle :: str  ; "pickle" or "sqlite"
+        state_retention_days = 0 :: int  ; for "sqlite" (0 means: no limit)
     '''
 
+    _HTTP_VALIDATORS_STATE_KEY = 'http_validators'
+
+    _http_validators_changed = False   # to be set in obtain_orig_data() if needed
+
     @attr_required('source_config_section')
     def get_config_spec_format_kwargs(self):
         return {'source_config_section': self.source_config_section}
 
+    def run_handling(self):
+        super(BaseDownloadingTimeOrderedRowsCollector, self).run_handling()
+        if self._selected_data is None and self._http_validators_changed:
+            # there were no fresh rows -- yet the new validators need to
+            # be stored (to avoid downloading the same data next time)
+            self.save_state(self._state)
+
     def obtain_orig_data(self):
-        return self.download(self.config['url'])
+        url = self.config['url']
+        lines = self.download_incrementally(
+            url,
+            custom_request_headers=self._get_conditional_request_headers(url),
+            split_into_lines=True)
+        first_line = next(lines, None)  # (<- here the request is made)
+        if self.http_not_modified:
+            return None
+        self._update_state_with_http_validators(url)
+        # the lines are yielded as the data is being downloaded
+        # (see: `BaseTimeOrderedRowsCollector.split_orig_data_into_rows()`
+        # and `BaseTimeOrderedRowsCollector.get_fresh_rows_only()`)
+        return self._iter_lines(first_line, lines)
+
+    @staticmethod
+    def _iter_lines(first_line, rest_lines):
+        try:
+            yield first_line
+            for line in rest_lines:
+                yield line
+        finally:
+            rest_lines.close()
+
+    def _get_conditional_request_headers(self, url):
+        stored_url, http_validators = self._state.get(self._HTTP_VALIDATORS_STATE_KEY,
+                                                      (None, None))
+        if stored_url != url:
+            return None
+        return make_conditional_request_headers(http_validators)
+
+    def _update_state_with_http_validators(self, url):
+        old = self._state.get(self._HTTP_VALIDATORS_STATE_KEY)
+        http_validators = self.http_validators
+        if http_validators:
+            new = (url, http_validators)
+            self._state[self._HTTP_VALIDATORS_STATE_KEY] = new
+        else:
+            new = None
+            self._state.pop(self._HTTP_VALIDATORS_STATE_KEY, None)
+        self._http_validators_changed = (new != old)
+
+
+
+#
+# Auxiliary functions
+
+def get_http_validators(response_headers):
+    """
+    Get a dict of cache validators from the given HTTP response headers.
+
+    >>> get_http_validators({'ETag': '"abc"', 'Content-Type': 'text/csv'})
+    {'ETag': '"abc"'}
+    >>> get_http_validators({'ETag': '', 'Content-Type': 'text/csv'})
+    {}
+    """
+    return {key: response_headers[key]
+            for key in HTTP_CACHE_VALIDATOR_HEADERS
+            if response_headers.get(key)}
+
+
+def make_conditional_request_headers(http_validators):
+    """
+    Make headers of a conditional HTTP request from the given dict
+    of cache validators (got with `get_http_validators()`).
+
+    >>> make_conditional_request_headers({'ETag': '"abc"'})
+    {'If-None-Match': '"abc"'}
+    >>> make_conditional_request_headers(None)
+    {}
+    """
+    return {_CONDITIONAL_REQUEST_HEADERS[key]: value
+            for key, value in (http_validators or {}).iteritems()}
 
 
 
@@ -7,6 +7,8 @@ Generic MISP collector.
 """
 
 import json
+import os
+import shutil
 import sys
 import time
 from collections import (
@@ -30,7 +32,10 @@ from n6.collectors.generic import (
     CollectorWithStateMixin,
     entry_point_factory,
 )
-from n6lib.common_helpers import exiting_on_exception
+from n6lib.common_helpers import (
+    exiting_on_exception,
+    iter_results_concurrently,
+)
 from n6lib.log_helpers import get_logger
 
 
@@ -81,6 +86,9 @@ class MispCollector(CollectorWithStateMixin, BaseCollector):
     ]
     # part of the MISP URL to the attributes' files
     default_sample_path = '/attributes/downloadAttachment/download/'
+    # max number of malware samples being downloaded concurrently
+    # (used if not specified in the config as `download_concurrency`)
+    default_download_concurrency = 4
 
     allowed_tlp_vals = (
         'red',
@@ -112,6 +120,10 @@ class MispCollector(CollectorWithStateMixin, BaseCollector):
         self._misp_raw_events = None
         self._output_components = None
         self._samples = None
+        self._fetched_samples = None
+        self._current_sample_body = None
+        self._download_concurrency = int(self.config.get('download_concurrency',
+                                                         self.default_download_concurrency))
         self._possible_attribute_types = ['malware-sample']
         sample_path = self.config.get('sample_path', self.default_sample_path)
         self._attributes_url = urljoin(self.config['misp_url'], sample_path)
@@ -157,6 +169,7 @@ class MispCollector(CollectorWithStateMixin, BaseCollector):
         self._state['samples_publishing_datetime'] = self._now
         del self._state['last_published_samples'][:]
         self.save_state(self._state)
+        self._remove_downloaded_samples_dir()
 
     def _convert_datetime_to_timestamp(self, datetime_):
         dif_time = (self._now - datetime_).total_seconds()/60+15
@@ -212,26 +225,22 @@ class MispCollector(CollectorWithStateMixin, BaseCollector):
     def _next_download(self):
         """
         If available, take details about the next malware sample
-        and try to download it.
-
-        Raises:
-            `SampleDownloadFailure` exception if a sample could not
-            be downloaded.
+        and its binary data (downloaded in the background by a pool
+        of worker threads -- see: `_fetch_sample()`).
         """
         try:
-            self._current_sample = self._samples.popleft()
-        except IndexError:
+            self._current_sample, self._current_sample_body = next(self._fetched_samples)
+        except StopIteration:
             # an empty list of the last published samples indicates,
             # that all of the samples have been published
             self._set_samples_state_to_completed()
             self.inner_stop()
         else:
-            try:
-                self._output_components = self.get_output_components()
-            except SampleDownloadFailure:
+            if self._current_sample_body is None:
                 LOGGER.warning("Cannot download sample with ID: %s.", self._current_sample['id'])
                 self._schedule(self._next_download)
             else:
+                self._output_components = self.get_output_components()
                 self._schedule(self._do_publish)
 
     def _do_publish_events(self):
@@ -250,8 +259,10 @@ class MispCollector(CollectorWithStateMixin, BaseCollector):
         """Publish a malware sample through the 'sample' exchange."""
         self.publish_output(*self._output_components, exchange=self.output_queue[1]['exchange'])
         self._output_components = None
+        self._current_sample_body = None
         self._state['last_published_samples'].append(int(self._current_sample['id']))
         self.save_state(self._state)
+        self._remove_downloaded_sample(self._current_sample['id'])
         self._schedule(self._next_download)
 
     def _prepare_and_schedule_samples_publishing(self):
@@ -278,6 +289,10 @@ class MispCollector(CollectorWithStateMixin, BaseCollector):
             else:
                 if self._samples:
                     self._set_attributes_for_samples()
+                    self._fetched_samples = iter_results_concurrently(
+                        self._fetch_sample,
+                        self._samples,
+                        max_workers=self._download_concurrency)
                     self._schedule(self._next_download)
                 else:
                     LOGGER.info('No malware samples to publish since: %s',
@@ -335,10 +350,42 @@ class MispCollector(CollectorWithStateMixin, BaseCollector):
         """
         if not self._publishing_samples:
             return self._get_misp_events(self._state['events_publishing_datetime'])
+        if self._current_sample_body is not None:
+            # already downloaded by `_fetch_sample()`
+            return self._current_sample_body
         sample_id = self._current_sample['id']
         sample_url = urljoin(self._attributes_url, sample_id)
         return self._download_sample(sample_url)
 
+    def _fetch_sample(self, sample):
+        """
+        Get the binary data of a malware sample -- either the data
+        downloaded (and stored in the `cache_dir`-based directory)
+        during a previous, interrupted, run; or just downloaded.
+
+        Note: this method is called in worker threads.
+
+        Args:
+            `sample`:
+                Details of a single malware sample.
+
+        Returns:
+            A pair: `(<the given sample details>, <binary data of the
+            sample or None if it could not be downloaded>)`.
+        """
+        sample_id = sample['id']
+        body = self._load_downloaded_sample(sample_id)
+        if body is not None:
+            LOGGER.debug('Sample with ID: %s has already been downloaded.', sample_id)
+        else:
+            sample_url = urljoin(self._attributes_url, sample_id)
+            try:
+                body = self._download_sample(sample_url)
+            except SampleDownloadFailure:
+                return sample, None
+            self._store_downloaded_sample(sample_id, body)
+        return sample, body
+
     def _download_sample(self, url):
         """
         Try to download a malware sample from an URL during
@@ -429,6 +476,50 @@ class MispCollector(CollectorWithStateMixin, BaseCollector):
                                 int(attr['id']) not in self._state['last_published_samples'])):
                         yield attr
 
+    def _get_downloaded_samples_dir(self):
+        cache_dir = self.config.get('cache_dir')
+        if not cache_dir:
+            return None
+        return os.path.join(os.path.expanduser(cache_dir),
+                            '{}.{}.samples'.format(self.config['source'],
+                                                   self.__class__.__name__))
+
+    def _get_downloaded_sample_path(self, sample_id):
+        samples_dir = self._get_downloaded_samples_dir()
+        if samples_dir is None:
+            return None
+        return os.path.join(samples_dir, str(int(sample_id)))
+
+    def _load_downloaded_sample(self, sample_id):
+        path = self._get_downloaded_sample_path(sample_id)
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _store_downloaded_sample(self, sample_id, body):
+        path = self._get_downloaded_sample_path(sample_id)
+        if path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), 0700)
+        except OSError:
+            pass
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.rename(tmp_path, path)
+
+    def _remove_downloaded_sample(self, sample_id):
+        path = self._get_downloaded_sample_path(sample_id)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def _remove_downloaded_samples_dir(self):
+        samples_dir = self._get_downloaded_samples_dir()
+        if samples_dir is not None:
+            shutil.rmtree(samples_dir, ignore_errors=True)
+
     def get_misp_verifycert(self):
         misp_verifycert = self.config.get('misp_verifycert')
         if not misp_verifycert or misp_verifycert.lower() not in ('false', 'f', 'no', 'n', 'off',
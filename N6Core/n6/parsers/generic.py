@@ -1060,9 +1060,20 @@ def generate_parser_main(parser_class):
     return parser_main
 
 
-def entry_point_factory(module):
+def iter_parser_classes():
+    """
+    Yield all concrete parser classes (the ones that get entry points).
+
+    Only the classes defined in the modules that have already been
+    imported are taken into account.
+    """
     for parser_class in all_subclasses(BaseParser):
         if (not parser_class.__module__.endswith('.generic') and
               not parser_class.__name__.startswith('_')):
-            setattr(module, "%s_main" % parser_class.__name__,
-                    generate_parser_main(parser_class))
+            yield parser_class
+
+
+def entry_point_factory(module):
+    for parser_class in iter_parser_classes():
+        setattr(module, "%s_main" % parser_class.__name__,
+                generate_parser_main(parser_class))
@@ -2,7 +2,14 @@
 
 # Copyright (c) 2019-2020 NASK. All rights reserved.
 
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
+import urlparse
+import zipfile
 
 from bson.json_util import loads
 from mock import (
@@ -23,10 +30,13 @@ from n6.collectors.abuse_ch import (
     AbuseChRansomwareTrackerCollector,
     AbuseChFeodoTrackerCollector,
     AbuseChSSLBlacklistCollector,
+    AbuseChUrlhausPayloadsCollector,
     AbuseChUrlhausPayloadsUrlsCollector,
+    AbuseChUrlhausUrlsCollector,
     AbuseChSSLBlacklistDyreCollector,
     NoNewDataException,
 )
+from n6lib.unit_test_helpers import LocalHTTPServer
 from n6.tests.collectors.test_generic import _BaseCollectorTestCase
 
 
@@ -524,6 +534,177 @@ class TestAbuseChUrlhausPayloadsUrlsCollector(_TestAbuseChDownloadingTimeOrdered
         self._perform_test(**kwargs)
 
 
+class _TestAbuseChUrlhausApiBase(_BaseCollectorTestCase):
+
+    API_LATENCY = 0.3
+
+    def setUp(self):
+        self.api_request_count = 0
+        self.server = LocalHTTPServer({
+            '/api/': self._provide_api_response,
+        })
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+    def _provide_api_response(self, request_headers, request_body):
+        self.api_request_count += 1
+        time.sleep(self.API_LATENCY)   # (artificial latency)
+        [(key, value)] = urlparse.parse_qsl(request_body)
+        return 200, {}, json.dumps({'query_status': 'ok', key: value})
+
+
+class TestAbuseChUrlhausUrlsCollector__api_enrichment(_TestAbuseChUrlhausApiBase):
+
+    ROWS = [
+        '"{0}","2020-01-0{1} 01:00:00","http://example.com/{0}","online","malware_download",'
+        '"exe","https://urlhaus.abuse.ch/url/{0}/","ExampleNick"'.format(url_id, 9 - i // 2)
+        for i, url_id in enumerate([112, 111, 110, 110, 108, 107, 106, 105, 104, 103, 102, 101])
+    ]
+
+    def test(self):
+        collector = self.prepare_collector(
+            AbuseChUrlhausUrlsCollector,
+            config_content='''
+                [abusech_urlhaus_urls]
+                source=abuse-ch
+                cache_dir=~/.n6cache
+                url=https://www.example.com
+                api_url={api_url}
+                api_retries=0
+                api_concurrency=8
+            '''.format(api_url=self.server.url('/api/')),
+            initial_state={
+                'newest_row_time': '2020-01-01 00:00:00',
+                'newest_rows': set(),
+            })
+        collector.obtain_orig_data = lambda: '\n'.join(self.ROWS)
+
+        start = time.time()
+        collector.run_handling()
+        duration = time.time() - start
+
+        # 11 distinct `url_id`s; 8 concurrent requests at most
+        self.assertEqual(self.api_request_count, 11)
+        self.assertLess(duration, 5 * self.API_LATENCY)
+        [publish_output_call] = self.publish_output_mock.mock_calls
+        output = json.loads(publish_output_call[1][1])
+        self.assertEqual([d['url_id'] for d in output],
+                         ['112', '111', '110', '110', '108', '107',
+                          '106', '105', '104', '103', '102', '101'])
+        self.assertEqual([d['url_info_from_api'] for d in output],
+                         [{'query_status': 'ok', 'urlid': d['url_id']} for d in output])
+        self.assertEqual(self.saved_state['newest_row_time'], '2020-01-09 01:00:00')
+
+
+class TestAbuseChUrlhausPayloadsCollector__api_enrichment(_TestAbuseChUrlhausApiBase):
+
+    def setUp(self):
+        super(TestAbuseChUrlhausPayloadsCollector__api_enrichment, self).setUp()
+        self.unpacked_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.unpacked_dir)
+        self.payload_filenames = ['{:032x}'.format(i) for i in xrange(10)]
+        for filename in self.payload_filenames:
+            open(os.path.join(self.unpacked_dir, filename), 'wb').close()
+
+    def test(self):
+        collector = self.prepare_collector(
+            AbuseChUrlhausPayloadsCollector,
+            config_content='''
+                [abusech_urlhaus_payloads]
+                source=abuse-ch
+                cache_dir=~/.n6cache
+                api_url={api_url}
+                zip_files_url=https://www.example.com/
+                zip_file_password=infected
+                api_concurrency=10
+            '''.format(api_url=self.server.url('/api/')))
+
+        start = time.time()
+        pairs = collector._get_payload_filename_and_info_pairs(self.unpacked_dir)
+        duration = time.time() - start
+
+        self.assertEqual(self.api_request_count, 10)
+        self.assertLess(duration, 5 * self.API_LATENCY)
+        self.assertEqual(sorted(filename for filename, _ in pairs), self.payload_filenames)
+        for filename, payload_info in pairs:
+            self.assertEqual(json.loads(payload_info),
+                             {'query_status': 'ok', 'md5_hash': filename})
+
+        # the results are cached
+        pairs_again = collector._get_payload_filename_and_info_pairs(self.unpacked_dir)
+        self.assertEqual(self.api_request_count, 10)
+        self.assertEqual(pairs_again, pairs)
+
+
+class TestAbuseChUrlhausPayloadsCollector__unzip_file(_BaseCollectorTestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.zip_filepath = os.path.join(self.temp_dir, '2020-01-01.zip')
+        self.unpacked_dir = os.path.join(self.temp_dir, '2020-01-01/')
+        large_filepath = os.path.join(self.temp_dir, 'large')
+        with open(large_filepath, 'wb') as f:
+            f.truncate(20 * 2 ** 20)   # (a sparse file)
+        with zipfile.ZipFile(self.zip_filepath, 'w', zipfile.ZIP_DEFLATED) as zfile:
+            zfile.writestr('{:032x}'.format(1), 'payload 1')
+            zfile.write(large_filepath, '{:032x}'.format(2))
+            zfile.writestr('{:032x}'.format(3), 'payload 3')
+            zfile.writestr('invalid-name', 'whatever')
+
+    def _make_collector(self, size_limit_opts=''):
+        return self.prepare_collector(
+            AbuseChUrlhausPayloadsCollector,
+            config_content='''
+                [abusech_urlhaus_payloads]
+                source=abuse-ch
+                cache_dir=~/.n6cache
+                api_url=https://www.example.com/api/
+                zip_files_url=https://www.example.com/
+                zip_file_password=infected
+                {}
+            '''.format(size_limit_opts))
+
+    def _get_unpacked(self):
+        unpacked = {}
+        for filename in os.listdir(self.unpacked_dir):
+            with open(os.path.join(self.unpacked_dir, filename), 'rb') as f:
+                unpacked[filename] = len(f.read())
+        return unpacked
+
+    def test_no_limits(self):
+        collector = self._make_collector()
+        collector._unzip_file(self.zip_filepath, self.unpacked_dir)
+        self.assertEqual(self._get_unpacked(), {
+            '{:032x}'.format(1): 9,
+            '{:032x}'.format(2): 20 * 2 ** 20,
+            '{:032x}'.format(3): 9,
+        })
+
+    def test_too_large_payload_skipped(self):
+        collector = self._make_collector('payload_max_size=1048576')
+        collector._unzip_file(self.zip_filepath, self.unpacked_dir)
+        self.assertEqual(self._get_unpacked(), {
+            '{:032x}'.format(1): 9,
+            '{:032x}'.format(3): 9,
+        })
+
+    def test_total_size_limit(self):
+        collector = self._make_collector('unpacked_archive_max_size=1048576')
+        collector._unzip_file(self.zip_filepath, self.unpacked_dir)
+        # (the large payload is skipped, as it would exceed the
+        # limit; the remaining ones still fit within it)
+        self.assertEqual(self._get_unpacked(), {
+            '{:032x}'.format(1): 9,
+            '{:032x}'.format(3): 9,
+        })
+
+    def test_nothing_extracted(self):
+        collector = self._make_collector('payload_max_size=5')
+        with self.assertRaises(ValueError):
+            collector._unzip_file(self.zip_filepath, self.unpacked_dir)
+
+
 @expand
 class TestAbuseChSSLBlacklistDyreCollector__get_output_data_body(unittest.TestCase):
 
@@ -2,8 +2,12 @@
 
 # Copyright (c) 2013-2019 NASK. All rights reserved.
 
+import cPickle
 import datetime
 import hashlib
+import os
+import shutil
+import tempfile
 import unittest
 
 from mock import (
@@ -26,17 +30,21 @@ from n6lib.config import (
 )
 from n6lib.csv_helpers import split_csv_row
 from n6lib.email_message import EmailMessage
+from n6lib.http_helpers import ResponseTooLargeError
 from n6lib.unit_test_helpers import (
     AnyDictIncluding,
+    LocalHTTPServer,
     patch_always,
 )
 from n6.base.queue import QueuedBase
 from n6.collectors.generic import (
     BaseCollector,
+    BaseDownloadingTimeOrderedRowsCollector,
     BaseOneShotCollector,
     BaseEmailSourceCollector,
     BaseTimeOrderedRowsCollector,
     BaseUrlDownloaderCollector,
+    CollectorWithStateMixin,
 )
 from n6.tests.collectors._collectors_test_helpers import _BaseCollectorTestCase
 
@@ -702,3 +710,393 @@ class TestXXX(_BaseCollectorTestCase):
 
         self.assertEqual(self.publish_output_mock.mock_calls, expected_publish_output_calls)
         self.assertEqual(self.saved_state, expected_saved_state)
+
+    def test_lazy_rows_consumed_only_until_old_ones(self):
+        config_content = '''
+            [xyz_my_channel]
+            source = xyz
+            cache_dir = /who/cares
+        '''
+        initial_state = {
+            'newest_row_time': '2019-07-02',
+            'newest_rows': {'"sss", "2019-07-02"'},
+        }
+        consumed_rows = []
+        closed = []
+
+        def generate_rows():
+            try:
+                for row in ['"ham", "2019-07-11"',
+                            '"sss", "2019-07-02"',
+                            '"bar", "2019-07-01"',
+                            '"foo", "2019-06-30"']:
+                    consumed_rows.append(row)
+                    yield row
+                raise AssertionError('too many rows consumed')
+            finally:
+                closed.append(True)
+
+        collector = self.prepare_collector(self.ExampleTimeOrderedRowsCollector,
+                                           config_content=config_content,
+                                           initial_state=initial_state)
+        collector.example_orig_data = generate_rows()
+
+        collector.run_handling()
+
+        self.assertEqual(consumed_rows, ['"ham", "2019-07-11"',
+                                         '"sss", "2019-07-02"',
+                                         '"bar", "2019-07-01"'])
+        self.assertEqual(closed, [True])
+        self.assertEqual(self.publish_output_mock.mock_calls[0][1][1], '"ham", "2019-07-11"')
+        self.assertEqual(self.saved_state, {
+            'newest_row_time': '2019-07-11',
+            'newest_rows': {'"ham", "2019-07-11"'},
+        })
+
+
+class TestBaseDownloadingTimeOrderedRowsCollector(_BaseCollectorTestCase):
+
+    class ExampleDownloadingCollector(BaseDownloadingTimeOrderedRowsCollector):
+
+        source_config_section = 'xyz_my_channel'
+
+        def clean_row_time(self, raw_row_time):
+            return raw_row_time.strip().strip('"')
+
+        def extract_raw_row_time(self, row):
+            fields = split_csv_row(row)
+            return fields[1].strip()
+
+        def get_source_channel(self, **kwargs):
+            return 'my-channel'
+
+    ROW_COUNT = 20000
+
+    def setUp(self):
+        # rows are ordered from the newest to the oldest ones
+        self.rows = ['"{0}", "2019-{1:02}-01"'.format(i, 12 - i * 12 // self.ROW_COUNT)
+                     for i in xrange(self.ROW_COUNT)]
+        self.response_headers = {'Last-Modified': 'Mon, 02 Dec 2019 12:00:00 GMT'}
+        self.served_long_history_chunk_count = 0
+        self.server = LocalHTTPServer({
+            '/data.csv': self._provide_generated_content,
+            '/long-history.csv': self._provide_long_history,
+        })
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+    def _provide_generated_content(self, request_headers, request_body):
+        def generate_chunks():
+            for i in xrange(0, self.ROW_COUNT, 1000):
+                yield ''.join(row + '\n' for row in self.rows[i:i+1000])
+        etag = self.response_headers.get('ETag')
+        if etag and request_headers.get('if-none-match') == etag:
+            return 304, self.response_headers, ''
+        return 200, self.response_headers, generate_chunks()
+
+    LONG_HISTORY_CHUNK_COUNT = 2000
+    LONG_HISTORY_ROWS_PER_CHUNK = 2000
+
+    def _provide_long_history(self, request_headers, request_body):
+        # ~100 MB of rows (the newest ones first), generated lazily
+        def generate_chunks():
+            rows_per_chunk = self.LONG_HISTORY_ROWS_PER_CHUNK
+            for chunk_no in xrange(self.LONG_HISTORY_CHUNK_COUNT):
+                self.served_long_history_chunk_count += 1
+                year = 2019 - chunk_no // 10
+                yield ''.join('"{0}", "{1}-01-01"\n'.format(i, year)
+                              for i in xrange(chunk_no * rows_per_chunk,
+                                              (chunk_no + 1) * rows_per_chunk))
+        return 200, {}, generate_chunks()
+
+    def _get_config_content(self, download_max_size, path='/data.csv'):
+        return '''
+            [xyz_my_channel]
+            source = xyz
+            cache_dir = /who/cares
+            url = {url}
+            download_retries = 0
+            download_max_size = {download_max_size}
+        '''.format(url=self.server.url(path),
+                     download_max_size=download_max_size)
+
+    def test_state_store_options_declared_in_config_spec(self):
+        config_content = self._get_config_content(0) + '''
+            state_store = sqlite
+            state_retention_days = 30
+        '''
+        collector = self.prepare_collector(self.ExampleDownloadingCollector,
+                                           config_content=config_content)
+        self.assertEqual(collector._state_store_kind, 'sqlite')
+        self.assertEqual(collector._state_retention_days, 30)
+
+    def test_download_stopped_when_old_rows_reached(self):
+        initial_state = {
+            'newest_row_time': '2019-01-01',
+            'newest_rows': set(),
+        }
+        collector = self.prepare_collector(
+            self.ExampleDownloadingCollector,
+            config_content=self._get_config_content(0, path='/long-history.csv'),
+            initial_state=initial_state)
+
+        collector.run_handling()
+
+        body = self.publish_output_mock.mock_calls[0][1][1]
+        self.assertEqual(len(body.split('\n')), 10 * self.LONG_HISTORY_ROWS_PER_CHUNK)
+        self.assertEqual(self.saved_state['newest_row_time'], '2019-01-01')
+        # (some data may have been buffered by the OS -- but surely
+        # not the whole content)
+        self.assertLess(self.served_long_history_chunk_count,
+                        self.LONG_HISTORY_CHUNK_COUNT // 2)
+
+    def test_rows_obtained_incrementally(self):
+        initial_state = {
+            'newest_row_time': '2019-07-01',
+            'newest_rows': set(),
+        }
+        collector = self.prepare_collector(self.ExampleDownloadingCollector,
+                                           config_content=self._get_config_content(0),
+                                           initial_state=initial_state)
+
+        collector._state = collector.load_state()
+        orig_data = collector.obtain_orig_data()
+        self.assertNotIsInstance(orig_data, basestring)
+        self.assertIs(collector.split_orig_data_into_rows(orig_data), orig_data)
+        self.assertEqual(next(orig_data), self.rows[0])
+        del orig_data
+
+        collector.run_handling()
+
+        expected_fresh_rows = [row for row in self.rows
+                               if split_csv_row(row)[1].strip().strip('"') >= '2019-07-01']
+        self.assertEqual(len(self.publish_output_mock.mock_calls), 1)
+        body = self.publish_output_mock.mock_calls[0][1][1]
+        self.assertEqual(body, '\n'.join(expected_fresh_rows))
+        self.assertEqual(self.saved_state['newest_row_time'], '2019-12-01')
+        self.assertEqual(collector.http_last_modified,
+                         datetime.datetime(2019, 12, 2, 12, 0, 0))
+
+    def test_download_max_size_exceeded(self):
+        collector = self.prepare_collector(self.ExampleDownloadingCollector,
+                                           config_content=self._get_config_content(10000))
+        with self.assertRaises(ResponseTooLargeError):
+            collector.run_handling()
+        self.assertFalse(self.publish_output_mock.mock_calls)
+        self.assertIs(self.saved_state, sentinel.NO_STATE)
+
+    def test_download_with_max_size(self):
+        collector = self.prepare_collector(self.ExampleDownloadingCollector,
+                                           config_content=self._get_config_content(10000))
+        url = self.server.url('/data.csv')
+        with self.assertRaises(ResponseTooLargeError):
+            collector.download(url)
+        content = collector.download(url, max_size=10 ** 9)
+        self.assertEqual(content, ''.join(row + '\n' for row in self.rows))
+
+    def _run_collector(self, initial_state):
+        collector = self.prepare_collector(self.ExampleDownloadingCollector,
+                                           config_content=self._get_config_content(0),
+                                           initial_state=initial_state)
+        self.publish_output_mock.reset_mock()
+        self.saved_state = sentinel.NO_STATE
+        collector.run_handling()
+        return collector
+
+    def test_conditional_download(self):
+        url = self.server.url('/data.csv')
+        self.response_headers = {
+            'ETag': '"abc"',
+            'Last-Modified': 'Mon, 02 Dec 2019 12:00:00 GMT',
+        }
+
+        # 200 -> the data are published, the validators are stored
+        self._run_collector(initial_state=sentinel.NO_STATE)
+        self.assertEqual(len(self.publish_output_mock.mock_calls), 1)
+        state = self.saved_state
+        self.assertEqual(state['http_validators'], (url, self.response_headers))
+        self.assertEqual(self.server.requests[-1][1].get('if-none-match'), None)
+
+        # 304 -> nothing is done
+        collector = self._run_collector(initial_state=state)
+        self.assertTrue(collector.http_not_modified)
+        self.assertEqual(self.publish_output_mock.mock_calls, [])
+        self.assertIs(self.saved_state, sentinel.NO_STATE)
+        request_headers = self.server.requests[-1][1]
+        self.assertEqual(request_headers.get('if-none-match'), '"abc"')
+        self.assertEqual(request_headers.get('if-modified-since'),
+                         'Mon, 02 Dec 2019 12:00:00 GMT')
+
+        # 200 (ETag changed) but no new rows -> only the validators are stored
+        self.response_headers = {'ETag': '"def"'}
+        collector = self._run_collector(initial_state=dict(state))
+        self.assertFalse(collector.http_not_modified)
+        self.assertEqual(self.publish_output_mock.mock_calls, [])
+        self.assertEqual(self.saved_state, dict(state, http_validators=(url, {'ETag': '"def"'})))
+
+    def test_download_without_validator_headers(self):
+        self.response_headers = {}
+        self._run_collector(initial_state=sentinel.NO_STATE)
+        self.assertEqual(len(self.publish_output_mock.mock_calls), 1)
+        self.assertNotIn('http_validators', self.saved_state)
+
+        # no validators stored -> no conditional headers sent
+        self._run_collector(initial_state=self.saved_state)
+        request_headers = self.server.requests[-1][1]
+        self.assertNotIn('if-none-match', request_headers)
+        self.assertNotIn('if-modified-since', request_headers)
+        self.assertEqual(self.publish_output_mock.mock_calls, [])
+        self.assertIs(self.saved_state, sentinel.NO_STATE)
+
+
+class TestBaseUrlDownloaderCollector_conditional_download(_BaseCollectorTestCase):
+
+    class ExampleUrlDownloaderCollector(BaseUrlDownloaderCollector, BaseOneShotCollector):
+
+        type = 'blacklist'
+        config_group = 'xyz_my_channel'
+        content_type = 'text/plain'
+
+        def get_source_channel(self, **kwargs):
+            return 'my-channel'
+
+        def process_data(self, data):
+            return data
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.response_headers = {}
+        self.server = LocalHTTPServer({
+            '/list.txt': self._provide_content,
+        })
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+    def _provide_content(self, request_headers, request_body):
+        last_modified = self.response_headers.get('Last-Modified')
+        if last_modified and request_headers.get('if-modified-since') == last_modified:
+            return 304, {}, ''
+        return 200, self.response_headers, '1.2.3.4\n5.6.7.8\n'
+
+    def _run_collector(self, with_cache_dir=True):
+        config_content = '''
+            [xyz_my_channel]
+            source = xyz
+            url = {url}
+            download_timeout = 0
+            retry_timeout = 0
+            {cache_dir_opt}
+        '''.format(url=self.server.url('/list.txt'),
+                     cache_dir_opt=('cache_dir = ' + self.cache_dir if with_cache_dir else ''))
+        collector = self.prepare_collector(self.ExampleUrlDownloaderCollector,
+                                           config_content=config_content)
+        self.publish_output_mock.reset_mock()
+        collector.run_handling()
+        return collector
+
+    def test_200_and_304(self):
+        self.response_headers = {'Last-Modified': 'Mon, 02 Dec 2019 12:00:00 GMT'}
+        self._run_collector()
+        self.assertEqual(len(self.publish_output_mock.mock_calls), 1)
+        self.assertNotIn('if-modified-since', self.server.requests[-1][1])
+
+        collector = self._run_collector()
+        self.assertEqual(self.server.requests[-1][1].get('if-modified-since'),
+                         'Mon, 02 Dec 2019 12:00:00 GMT')
+        self.assertTrue(collector._http_not_modified)
+        self.assertEqual(self.publish_output_mock.mock_calls, [])
+
+    def test_no_validator_headers(self):
+        self._run_collector()
+        self._run_collector()
+        self.assertNotIn('if-modified-since', self.server.requests[-1][1])
+        self.assertEqual(len(self.publish_output_mock.mock_calls), 1)
+
+    def test_no_cache_dir(self):
+        self.response_headers = {'Last-Modified': 'Mon, 02 Dec 2019 12:00:00 GMT'}
+        self._run_collector(with_cache_dir=False)
+        self._run_collector(with_cache_dir=False)
+        self.assertNotIn('if-modified-since', self.server.requests[-1][1])
+        self.assertEqual(len(self.publish_output_mock.mock_calls), 1)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+@expand
+class TestCollectorWithStateMixin(_BaseCollectorTestCase):
+
+    patch_CollectorWithStateMixin = False
+
+    class ExampleStatefulCollector(CollectorWithStateMixin, BaseCollector):
+
+        type = 'stream'
+        config_spec = '''
+            [xyz_stateful]
+            source :: str
+            cache_dir :: str
+            state_store = pickle :: str
+            state_retention_days = 0 :: int
+        '''
+
+        def get_source_channel(self, **kwargs):
+            return 'my-channel'
+
+        def make_default_state(self):
+            return {'handled': set()}
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.pickle_path = os.path.join(self.cache_dir,
+                                        'xyz.my-channel.ExampleStatefulCollector.pickle')
+        self.sqlite_path = os.path.join(self.cache_dir,
+                                        'xyz.my-channel.ExampleStatefulCollector.sqlite')
+
+    def _make_collector(self, state_store, state_retention_days=0):
+        config_content = '''
+            [xyz_stateful]
+            source = xyz
+            cache_dir = {}
+            state_store = {}
+            state_retention_days = {}
+        '''.format(self.cache_dir, state_store, state_retention_days)
+        return self.prepare_collector(self.ExampleStatefulCollector,
+                                      config_content=config_content)
+
+    @foreach(['pickle', 'sqlite'])
+    def test_state_saved_and_loaded(self, state_store):
+        collector = self._make_collector(state_store)
+        self.assertEqual(collector.load_state(), {'handled': set()})
+        collector.save_state({'handled': {'a', 'b'}, 'time': 1})
+        collector = self._make_collector(state_store)
+        self.assertEqual(collector.load_state(), {'handled': {'a', 'b'}, 'time': 1})
+        self.assertEqual(os.listdir(self.cache_dir) == [os.path.basename(self.pickle_path)],
+                         state_store == 'pickle')
+
+    def test_pickled_state_migrated_to_sqlite(self):
+        self._make_collector('pickle').save_state({'handled': {'a'}, 'time': 1})
+        collector = self._make_collector('sqlite')
+        self.assertEqual(collector.load_state(), {'handled': {'a'}, 'time': 1})
+        self.assertFalse(os.path.exists(self.pickle_path))
+        with open(self.pickle_path + '.migrated', 'rb') as f:
+            self.assertEqual(cPickle.load(f), {'handled': {'a'}, 'time': 1})
+        collector.save_state({'handled': {'a', 'b'}, 'time': 2})
+        collector = self._make_collector('sqlite')
+        self.assertEqual(collector.load_state(), {'handled': {'a', 'b'}, 'time': 2})
+        self.assertTrue(os.path.exists(self.sqlite_path))
+
+    def test_state_retention_days(self):
+        day = 24 * 3600
+        with patch('time.time', return_value=1000.0):
+            self._make_collector('sqlite', 2).save_state({'old': 1, 'changed': 1})
+        with patch('time.time', return_value=1000.0 + day):
+            self._make_collector('sqlite', 2).save_state({'old': 1, 'changed': 2})
+        with patch('time.time', return_value=1000.0 + 2.5 * day):
+            self.assertEqual(self._make_collector('sqlite').load_state(),
+                             {'old': 1, 'changed': 2})
+            self.assertEqual(self._make_collector('sqlite', 2).load_state(),
+                             {'changed': 2})
+
+    def test_illegal_state_store(self):
+        with self.assertRaises(ConfigError):
+            self._make_collector('shelve')
@@ -5,6 +5,11 @@
 import copy
 import datetime
 import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 from urlparse import urlsplit
 
@@ -21,6 +26,7 @@ from unittest_expander import (
     paramseq,
 )
 
+from n6lib.unit_test_helpers import LocalHTTPServer
 from n6.collectors.misp import MispCollector
 
 
@@ -507,5 +513,102 @@ class TestMispCollector(unittest.TestCase):
         self._instance.get_output_data_body('test_source')
         self._instance._download_sample.assert_called_once_with(self.single_sample_test_url)
 
+    SAMPLE_DOWNLOAD_DELAY = 0.3
+
+    def _prepare_sample_server(self, failing_sample_ids=()):
+        # serves the samples with an artificial delay; the first request
+        # for each sample is answered with an HTTP-500 error (so that a
+        # retry is needed); samples whose ids are in `failing_sample_ids`
+        # are never available (HTTP-404)
+        self._sample_requests = []
+        lock = threading.Lock()
+
+        def make_provider(sample_id):
+            def provide_sample(request_headers, request_body):
+                with lock:
+                    is_first_request = sample_id not in self._sample_requests
+                    self._sample_requests.append(sample_id)
+                time.sleep(self.SAMPLE_DOWNLOAD_DELAY)
+                if sample_id in failing_sample_ids:
+                    return 404, {}, ''
+                if is_first_request:
+                    return 500, {}, ''
+                return 200, {}, all_samples[sample_id]
+            return provide_sample
+
+        server = LocalHTTPServer({'/{}'.format(sample_id): make_provider(sample_id)
+                                  for sample_id in all_samples})
+        server.__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self._instance.config = dict(self.mocked_config,
+                                     misp_url=server.url('/'),
+                                     misp_key='example-key',
+                                     cache_dir=cache_dir,
+                                     download_timeout=10,
+                                     retry_sleep_time=0,
+                                     download_concurrency=len(all_samples))
+        return os.path.join(cache_dir, 'test.MispCollector.samples')
+
+    def _init_class_with_real_sample_downloading(self, mocked_state):
+        self._init_class(mocked_state)
+        del self._instance._download_sample   # (the real method is to be used)
+
+    def test_concurrent_sample_downloading(self):
+        samples_dir = self._prepare_sample_server(failing_sample_ids={144646})
+        self._init_class_with_real_sample_downloading(None)
+
+        start = time.time()
+        self._mocked_run()
+        duration = time.time() - start
+
+        expected_samples = {x: all_samples[x] for x in all_samples_ids - {144646}}
+        self.assertEqual(self._published_samples, expected_samples)
+        # (sequential downloading would take at least
+        # 2 * SAMPLE_DOWNLOAD_DELAY * len(all_samples))
+        self.assertLess(duration, 6 * self.SAMPLE_DOWNLOAD_DELAY)
+        self.assertEqual(self._collector_state['last_published_samples'], [])
+        self.assertFalse(os.path.exists(samples_dir))
+
+    def test_interrupted_sample_downloading_is_resumed(self):
+        samples_dir = self._prepare_sample_server()
+        self._init_class_with_real_sample_downloading(None)
+        orig_publish_output_mock = self._publish_output_mock
+
+        def publish_output_mock_interrupting(rk, body, props, **kwargs):
+            if len(self._published_samples) == 2:
+                raise RuntimeError('interrupted!')
+            orig_publish_output_mock(rk, body, props, **kwargs)
+
+        self._publish_output_mock = publish_output_mock_interrupting
+        with self.assertRaises(SystemExit):
+            self._mocked_run()
+        self._instance._fetched_samples.close()  # (wait for the workers to finish)
+        self._publish_output_mock = orig_publish_output_mock
+
+        state = copy.deepcopy(self._collector_state)
+        published_before = set(self._published_samples)
+        self.assertEqual(set(state['last_published_samples']), published_before)
+        self.assertEqual(len(published_before), 2)
+        stored_ids = {int(name) for name in os.listdir(samples_dir)}
+        self.assertTrue(stored_ids)
+        self.assertFalse(stored_ids & published_before)
+
+        # the next run
+        del self._sample_requests[:]
+        config = self._instance.config
+        self._instance = MispCollector.__new__(MispCollector)
+        self._instance.config = config
+        self._init_class_with_real_sample_downloading(state)
+        self._mocked_run()
+
+        self.assertEqual(self._published_samples, all_samples)
+        downloaded_again = set(self._sample_requests)
+        self.assertEqual(downloaded_again,
+                         all_samples_ids - published_before - stored_ids)
+        self.assertEqual(self._collector_state['last_published_samples'], [])
+        self.assertFalse(os.path.exists(samples_dir))
+
     def tearDown(self):
         self._instance = None
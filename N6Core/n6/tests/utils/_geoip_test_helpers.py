@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+"""
+Helpers to make MaxMind DB files (with random data), for tests and benchmarks.
+"""
+
+import random
+import struct
+
+
+_DATA_SECTION_SEPARATOR = '\0' * 16
+_METADATA_START_MARKER = '\xAB\xCD\xEFMaxMind.com'
+
+_TYPE_UTF8_STRING = 2
+_TYPE_UINT16 = 5
+_TYPE_UINT32 = 6
+_TYPE_MAP = 7
+_TYPE_UINT64 = 9
+_TYPE_ARRAY = 11
+
+
+def write_mmdb(path, database_type, networks):
+    """
+    Write a MaxMind DB file (IPv6 one, with IPv4 networks placed in
+    the ::/96 subtree -- like in GeoLite2 databases).
+
+    Args:
+        `path`:
+            The output file path.
+        `database_type`:
+            E.g., 'GeoLite2-ASN' or 'GeoLite2-City'.
+        `networks`:
+            A list of (<IPv4 network as an (<int>, <prefix length>)
+            pair>, <record: a dict>) pairs; the networks must not
+            overlap.
+    """
+    data_section = []
+    data_offsets = {}
+    data_size = 0
+    tree = [[None, None]]
+    for (ip_int, prefix_length), record in networks:
+        encoded_record = _encode(record)
+        if encoded_record not in data_offsets:
+            data_offsets[encoded_record] = data_size
+            data_section.append(encoded_record)
+            data_size += len(encoded_record)
+        bits = [0] * 96 + [(ip_int >> (31 - i)) & 1 for i in xrange(prefix_length)]
+        node = 0
+        for bit in bits[:-1]:
+            child = tree[node][bit]
+            if child is None:
+                tree.append([None, None])
+                child = tree[node][bit] = len(tree) - 1
+            assert isinstance(child, int), 'overlapping networks'
+            node = child
+        assert tree[node][bits[-1]] is None, 'overlapping networks'
+        tree[node][bits[-1]] = ('data', data_offsets[encoded_record])
+    node_count = len(tree)
+    search_tree = ''.join(
+        struct.pack('>II', *[
+            (node_count if record is None
+             else record if isinstance(record, int)
+             else node_count + len(_DATA_SECTION_SEPARATOR) + record[1])
+            for record in node_records])
+        for node_records in tree)
+    metadata = {
+        'node_count': node_count,
+        'record_size': 32,
+        'ip_version': 6,
+        'database_type': database_type,
+        'languages': ['en'],
+        'binary_format_major_version': 2,
+        'binary_format_minor_version': 0,
+        'build_epoch': 1577836800,
+        'description': {'en': 'Test database'},
+    }
+    with open(path, 'wb') as f:
+        f.write(search_tree)
+        f.write(_DATA_SECTION_SEPARATOR)
+        f.write(''.join(data_section))
+        f.write(_METADATA_START_MARKER)
+        f.write(_encode(metadata))
+
+
+def make_random_networks(count, rnd=None, min_prefix_length=8):
+    """
+    Get a sorted list of `count` (or fewer -- if some of the randomly
+    chosen ones overlapped) non-overlapping IPv4 networks, as (<int>,
+    <prefix length>) pairs.
+    """
+    if rnd is None:
+        rnd = random.Random()
+    networks = set()
+    for _ in xrange(count):
+        prefix_length = rnd.randint(min_prefix_length, 32)
+        ip_int = rnd.getrandbits(32) & ~((1 << (32 - prefix_length)) - 1)
+        networks.add((ip_int, prefix_length))
+    result = []
+    last = -1
+    for ip_int, prefix_length in sorted(networks):
+        if ip_int > last:
+            result.append((ip_int, prefix_length))
+            last = ip_int | ((1 << (32 - prefix_length)) - 1)
+    return result
+
+
+def make_random_asn_record(rnd):
+    if rnd.random() < 0.05:
+        return {'autonomous_system_organization': 'Unknown'}
+    asn = rnd.choice([rnd.randint(1, 65535), rnd.randint(65536, 2 ** 32 - 1)])
+    return {'autonomous_system_number': asn,
+            'autonomous_system_organization': 'Organization {}'.format(asn)}
+
+
+def make_random_city_record(rnd):
+    if rnd.random() < 0.05:
+        return {'continent': {'code': 'EU', 'names': {'en': 'Europe'}}}
+    cc = rnd.choice(['PL', 'DE', 'US', 'CN', 'RU', 'NL', 'FR', 'GB'])
+    return {'city': {'names': {'en': 'City {}'.format(rnd.randint(1, 10))}},
+            'country': {'iso_code': cc, 'names': {'en': 'Country {}'.format(cc)}}}
+
+
+def _encode(value):
+    if isinstance(value, dict):
+        return _control_bytes(_TYPE_MAP, len(value)) + ''.join(
+            _encode(k) + _encode(v) for k, v in sorted(value.iteritems()))
+    if isinstance(value, list):
+        return _control_bytes(_TYPE_ARRAY, len(value)) + ''.join(map(_encode, value))
+    if isinstance(value, basestring):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return _control_bytes(_TYPE_UTF8_STRING, len(value)) + value
+    if isinstance(value, (int, long)) and value >= 0:
+        type_num = (_TYPE_UINT16 if value < 2 ** 16
+                    else _TYPE_UINT32 if value < 2 ** 32
+                    else _TYPE_UINT64)
+        value_bytes = struct.pack('>Q', value).lstrip('\0')
+        return _control_bytes(type_num, len(value_bytes)) + value_bytes
+    raise TypeError('cannot encode {!r}'.format(value))
+
+
+def _control_bytes(type_num, size):
+    if size < 29:
+        size_bits, size_bytes = size, ''
+    elif size < 285:
+        size_bits, size_bytes = 29, chr(size - 29)
+    elif size < 65821:
+        size_bits, size_bytes = 30, struct.pack('>H', size - 285)
+    else:
+        size_bits, size_bytes = 31, struct.pack('>I', size - 65821)[1:]
+    if type_num <= 7:
+        return chr(type_num << 5 | size_bits) + size_bytes
+    return chr(size_bits) + chr(type_num - 7) + size_bytes
@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
 
-# Copyright (c) 2013-2018 NASK. All rights reserved.
+# Copyright (c) 2013-2020 NASK. All rights reserved.
 
+import collections
+import copy_reg
+import cPickle
 import datetime
+import errno
 import json
+import os
+import os.path as osp
+import random
+import shutil
+import tempfile
 import unittest
 from collections import namedtuple
 
@@ -21,13 +30,20 @@ from unittest_expander import (
 
 from n6.base.queue import n6QueueProcessingException
 from n6.utils.aggregator import (
+    AGGREGATE_WAIT,
     Aggregator,
     AggregatorData,
     AggregatorDataWrapper,
+    AggregatorRouter,
     HiFreqEventData,
     SourceData,
+    SourcePartitioner,
     DEFAULT_TIME_TOLERANCE,
+    RebalancingError,
+    get_partition_dbpath,
+    rebalance_partitioned_state,
 )
+from n6lib.datetime_helpers import parse_iso_datetime_to_utc
 from n6lib.unit_test_helpers import TestCaseMixin
 
 
@@ -1566,3 +1582,577 @@ class TestAggregatorData(unittest.TestCase):
         self.assertEqual(self.groups_hifreq_data, source_data.groups['group1'])
         self.assertEqual(self.buffer_hifreq_data, source_data.buffer['group1'])
         self.assertIs(source_data, self._aggregator_data.sources[self.sample_source])
+
+
+class _NaiveSourceData(object):
+
+    """
+    The reference implementation of the `SourceData` logic (using the
+    plain linear scans), for the differential tests.
+    """
+
+    def __init__(self, time_tolerance):
+        self.time = None
+        self.groups = collections.OrderedDict()
+        self.time_tolerance = datetime.timedelta(seconds=time_tolerance)
+        self.buffer = collections.OrderedDict()
+
+    def process_event(self, data):
+        event_time = parse_iso_datetime_to_utc(data['time'])
+        event = self.groups.get(data['_group'])
+        if self.time is None:
+            self.time = event_time
+        if event_time + self.time_tolerance < self.time:
+            if event is None or event.first > event_time:
+                raise n6QueueProcessingException('Event out of order.')
+            event.until = max(event.until, event_time)
+            event.count += 1
+            return False
+        if event is None:
+            if event_time < self.time:
+                buffered_event = self.buffer.get(data['_group'])
+                if buffered_event is not None:
+                    buffered_event.count += 1
+                    return False
+            self.groups[data['_group']] = HiFreqEventData(data)
+            self.time = max(self.time, event_time)
+            return True
+        if (event_time > event.until + datetime.timedelta(hours=AGGREGATE_WAIT) or
+              event_time.date() > self.time.date()):
+            del self.groups[data['_group']]
+            self.groups[data['_group']] = HiFreqEventData(data)
+            self.buffer[data['_group']] = event
+            self.time = max(self.time, event_time)
+            return True
+        event.count += 1
+        event.until = max(event.until, event_time)
+        del self.groups[data['_group']]
+        self.groups[data['_group']] = event
+        self.time = max(self.time, event_time)
+        return False
+
+    def generate_suppressed_events(self):
+        cutoff_time = self.time - datetime.timedelta(hours=AGGREGATE_WAIT)
+        cutoff_check_complete = False
+        for k, v in list(self.groups.iteritems()):
+            if v.until >= cutoff_time:
+                cutoff_check_complete = True
+            if cutoff_check_complete and v.until.date() == self.time.date():
+                break
+            del self.groups[k]
+            self.buffer[k] = v
+        cutoff_time = self.time - self.time_tolerance
+        for k, v in list(self.buffer.iteritems()):
+            if v.until >= cutoff_time:
+                break
+            del self.buffer[k]
+            yield 'suppressed', v.to_dict() if v.count > 1 else None
+
+    def generate_suppressed_events_after_inactive(self):
+        for v in self.buffer.values() + self.groups.values():
+            yield 'suppressed', v.to_dict() if v.count > 1 else None
+        self.groups.clear()
+        self.buffer.clear()
+
+
+@expand
+class TestSourceData__randomized_differential(unittest.TestCase):
+
+    time_tolerance = 600
+
+    def _generate_events(self, rnd, count):
+        group_count = rnd.choice([3, 30, 300])
+        time = datetime.datetime(2020, 1, 1, rnd.randrange(24))
+        for i in xrange(count):
+            time += rnd.choice([
+                datetime.timedelta(seconds=rnd.randrange(60)),
+                datetime.timedelta(seconds=rnd.randrange(600)),
+                datetime.timedelta(minutes=rnd.randrange(120)),
+                datetime.timedelta(hours=rnd.randrange(14)),
+            ] * 5 + [
+                # (events out of order -- some of them beyond the tolerance)
+                -datetime.timedelta(seconds=rnd.randrange(self.time_tolerance)),
+                -datetime.timedelta(seconds=rnd.randrange(3 * self.time_tolerance)),
+            ])
+            yield {
+                'id': '{:032x}'.format(i),
+                'source': 'testsource.testchannel',
+                '_group': 'group{}'.format(rnd.randrange(group_count)),
+                'time': str(time),
+            }
+
+    @staticmethod
+    def _process(source_data, event):
+        try:
+            result = source_data.process_event(dict(event))
+        except n6QueueProcessingException:
+            result = 'error'
+        return result, list(source_data.generate_suppressed_events())
+
+    @foreach(range(20))
+    def test(self, seed):
+        rnd = random.Random(seed)
+        source_data = SourceData(self.time_tolerance)
+        reference = _NaiveSourceData(self.time_tolerance)
+        for event in self._generate_events(rnd, 2000):
+            self.assertEqual(self._process(source_data, event),
+                             self._process(reference, event))
+            if rnd.random() < 0.01:
+                # (the state may also be stored and restored)
+                source_data = cPickle.loads(cPickle.dumps(source_data))
+        self.assertEqual(list(source_data.groups), list(reference.groups))
+        self.assertEqual(list(source_data.buffer), list(reference.buffer))
+        self.assertEqual(list(source_data.generate_suppressed_events_after_inactive()),
+                         list(reference.generate_suppressed_events_after_inactive()))
+
+
+class TestAggregatorDataWrapper__persistence(unittest.TestCase):
+
+    time_tolerance = 600
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.dbpath = osp.join(self.tmp_dir, 'aggregator_db.pickle')
+        self.journal_path = self.dbpath + '.journal'
+
+    def _open_wrapper(self, **kwargs):
+        wrapper = AggregatorDataWrapper(self.dbpath, self.time_tolerance, **kwargs)
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def _process(self, wrapper, messages):
+        for data in messages:
+            data = dict(data)
+            try:
+                wrapper.process_new_message(data)
+            except n6QueueProcessingException:
+                continue
+            list(wrapper.generate_suppresed_events_for_source(data))
+            wrapper.record_processed_message(data)
+
+    def _make_messages(self, count, seed=0):
+        rnd = random.Random(seed)
+        time = datetime.datetime(2020, 1, 1)
+        for i in xrange(count):
+            time += datetime.timedelta(minutes=rnd.randrange(90))
+            yield {
+                'id': '{:032x}'.format(i),
+                'source': rnd.choice(['source1.channel', 'source2.channel']),
+                '_group': 'group{}'.format(rnd.randrange(10)),
+                'time': str(time),
+            }
+
+    @staticmethod
+    def _state_repr(wrapper):
+        def groups_repr(groups):
+            return [(k, v.count, v.first, v.until, v.payload) for k, v in groups.iteritems()]
+        return sorted(
+            (name, sd.time, sd.last_event, groups_repr(sd.groups), groups_repr(sd.buffer))
+            for name, sd in wrapper.aggr_data.sources.iteritems())
+
+    def test_state_restored_from_journal_only(self):
+        wrapper = self._open_wrapper()
+        self._process(wrapper, self._make_messages(500))
+        # (no snapshot has been made -- e.g., the process crashed)
+        self.assertFalse(osp.exists(self.dbpath))
+        restored = self._open_wrapper()
+        self.assertEqual(self._state_repr(restored), self._state_repr(wrapper))
+        self.assertEqual(restored.aggr_data.last_journal_seq, 500)
+
+    def test_state_restored_from_snapshot_and_journal(self):
+        wrapper = self._open_wrapper(snapshot_interval=200)
+        self._process(wrapper, self._make_messages(500))
+        self.assertTrue(osp.exists(self.dbpath))
+        self.assertEqual(wrapper._journal_record_count, 100)
+        restored = self._open_wrapper(snapshot_interval=200)
+        self.assertEqual(self._state_repr(restored), self._state_repr(wrapper))
+        # processing can be continued
+        self._process(wrapper, self._make_messages(300, seed=1))
+        self._process(restored, self._make_messages(300, seed=1))
+        self.assertEqual(self._state_repr(self._open_wrapper()), self._state_repr(wrapper))
+
+    def test_records_included_in_snapshot_not_replayed_again(self):
+        wrapper = self._open_wrapper()
+        self._process(wrapper, self._make_messages(100))
+        with open(self.journal_path, 'rb') as f:
+            journal_content = f.read()
+        wrapper.store_state()
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+        # (simulating a crash after saving the snapshot but before
+        # truncating the journal)
+        with open(self.journal_path, 'wb') as f:
+            f.write(journal_content)
+        restored = self._open_wrapper()
+        self.assertEqual(self._state_repr(restored), self._state_repr(wrapper))
+
+    def test_incomplete_last_record_discarded(self):
+        wrapper = self._open_wrapper()
+        messages = list(self._make_messages(101))
+        self._process(wrapper, messages[:100])
+        expected_state_repr = self._state_repr(wrapper)
+        self._process(wrapper, messages[100:])
+        wrapper.close()
+        # (simulating a crash in the middle of writing the last record)
+        with open(self.journal_path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.journal_path) - 10)
+        restored = self._open_wrapper()
+        self.assertEqual(self._state_repr(restored), expected_state_repr)
+        self._process(restored, messages[100:])
+        self.assertEqual(self._state_repr(self._open_wrapper()), self._state_repr(restored))
+
+    def test_inactive_source_suppression_journaled(self):
+        wrapper = self._open_wrapper()
+        self._process(wrapper, self._make_messages(100))
+        with patch('n6.utils.aggregator.datetime') as datetime_mock:
+            datetime_mock.datetime.utcnow.return_value = datetime.datetime(2100, 1, 1)
+            datetime_mock.timedelta.side_effect = datetime.timedelta
+            self.assertTrue(list(wrapper.generate_suppresed_events_after_timeout()))
+        restored = self._open_wrapper()
+        self.assertEqual(self._state_repr(restored), self._state_repr(wrapper))
+        for source_data in restored.aggr_data.sources.itervalues():
+            self.assertFalse(source_data.groups)
+            self.assertFalse(source_data.buffer)
+            self.assertEqual(source_data.last_event, datetime.datetime(2100, 1, 1))
+
+    def test_old_state_file_restored(self):
+        wrapper = self._open_wrapper()
+        self._process(wrapper, self._make_messages(100))
+        wrapper.close()
+        os.remove(self.journal_path)
+        # (an `AggregatorData` instance saved by older versions
+        # has no `last_journal_seq` attribute)
+        del wrapper.aggr_data.last_journal_seq
+        with open(self.dbpath, 'w') as f:
+            cPickle.dump(wrapper.aggr_data, f)
+        restored = self._open_wrapper()
+        self.assertEqual(restored.aggr_data.last_journal_seq, 0)
+        self.assertEqual(self._state_repr(restored), self._state_repr(wrapper))
+
+
+class _PickledByOlderVersion(object):
+
+    # (pickled as an instance of `cls` whose `__dict__` was `state`
+    # -- just like instances of `cls` were pickled by older versions)
+
+    def __init__(self, cls, state):
+        self.cls = cls
+        self.state = state
+
+    def __reduce__(self):
+        return copy_reg._reconstructor, (self.cls, object, None), self.state
+
+
+class TestAggregatorData__old_state_migration(unittest.TestCase):
+
+    def _make_old_state(self):
+        # (with times kept as `datetime.datetime` objects)
+        payload = {
+            'id': 'd41d8cd98f00b204e9800998ecf8427e',
+            'source': 'testsource.testchannel',
+            '_group': 'group1',
+            'time': '2017-06-01 10:00:00',
+        }
+        group = _PickledByOlderVersion(HiFreqEventData, {
+            'group': 'group1',
+            'until': datetime.datetime(2017, 6, 1, 10),
+            'first': datetime.datetime(2017, 6, 1, 8, 30, 0, 123456),
+            'count': 3,
+            'payload': payload,
+        })
+        source_data = _PickledByOlderVersion(SourceData, {
+            'time': datetime.datetime(2017, 6, 1, 10),
+            'last_event': datetime.datetime(2017, 6, 1, 10, 0, 5),
+            'groups': collections.OrderedDict([('group1', group)]),
+            'time_tolerance': datetime.timedelta(seconds=600),
+            'buffer': collections.OrderedDict(),
+        })
+        aggr_data = AggregatorData()
+        aggr_data.sources['testsource.testchannel'] = source_data
+        return aggr_data
+
+    def test_old_pickled_state_migrated(self):
+        aggr_data = cPickle.loads(cPickle.dumps(self._make_old_state()))
+        source_data = aggr_data.sources['testsource.testchannel']
+        self.assertEqual(source_data.time, datetime.datetime(2017, 6, 1, 10))
+        self.assertEqual(source_data.time_tolerance_secs, 600)
+        group = source_data.groups['group1']
+        self.assertEqual(group.until, datetime.datetime(2017, 6, 1, 10))
+        self.assertEqual(group.first, datetime.datetime(2017, 6, 1, 8, 30, 0, 123456))
+        self.assertIsInstance(group.until_ts, float)
+        # the migrated state can be used further
+        self.assertFalse(source_data.process_event({
+            'id': 'd41d8cd98f00b204e9800998ecf8427f',
+            'source': 'testsource.testchannel',
+            '_group': 'group1',
+            'time': '2017-06-01 11:00:00',
+        }))
+        self.assertEqual(group.count, 4)
+        self.assertEqual(source_data.time, datetime.datetime(2017, 6, 1, 11))
+        self.assertEqual(list(source_data.generate_suppressed_events_after_inactive()), [
+            ('suppressed', {
+                'id': 'd41d8cd98f00b204e9800998ecf8427e',
+                'source': 'testsource.testchannel',
+                '_group': 'group1',
+                'time': '2017-06-01 10:00:00',
+                'count': 4,
+                'until': '2017-06-01 11:00:00',
+                '_first_time': '2017-06-01 08:30:00.123456',
+            }),
+        ])
+
+
+class TestSourcePartitioner(unittest.TestCase):
+
+    sources = ['source{}.channel{}'.format(i, j) for i in xrange(200) for j in xrange(5)]
+
+    def test_all_partitions_used(self):
+        partitioner = SourcePartitioner(4)
+        counts = collections.Counter(partitioner.get_partition(s) for s in self.sources)
+        self.assertEqual(sorted(counts), [0, 1, 2, 3])
+        for count in counts.itervalues():
+            self.assertGreater(count, len(self.sources) / 4 / 2)
+
+    def test_only_sources_for_new_partition_moved(self):
+        old_partitioner = SourcePartitioner(4)
+        new_partitioner = SourcePartitioner(5)
+        moved_count = 0
+        for source in self.sources:
+            old_partition = old_partitioner.get_partition(source)
+            new_partition = new_partitioner.get_partition(source)
+            if new_partition != old_partition:
+                self.assertEqual(new_partition, 4)
+                moved_count += 1
+        self.assertGreater(moved_count, 0)
+        self.assertLess(moved_count, len(self.sources) / 5 * 2)
+
+    def test_invalid_partition_count(self):
+        with self.assertRaises(ValueError):
+            SourcePartitioner(0)
+
+
+class TestAggregator__partitioned(unittest.TestCase):
+
+    time_tolerance = 600
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.dbpath = osp.join(self.tmp_dir, 'aggregator_db.pickle')
+
+    def _make_messages(self, count, seed=0):
+        rnd = random.Random(seed)
+        sources = ['source{}.channel{}'.format(i, i % 3) for i in xrange(20)]
+        time = datetime.datetime(2020, 1, 1)
+        for i in xrange(count):
+            time += datetime.timedelta(minutes=rnd.randrange(30))
+            source = rnd.choice(sources)
+            routing_key = 'hifreq.parsed.' + source
+            body = json.dumps({
+                'id': '{:032x}'.format(i),
+                'source': source,
+                '_group': 'group{}'.format(rnd.randrange(5)),
+                'time': str(time),
+            })
+            yield routing_key, body
+
+    def _make_aggregator(self, dbpath, output):
+        aggregator = Aggregator.__new__(Aggregator)
+        aggregator.db = AggregatorDataWrapper(dbpath, self.time_tolerance)
+        aggregator.publish_output = (lambda routing_key, body:
+                                     output.append((routing_key, json.loads(body))))
+        return aggregator
+
+    def _make_router(self, partition_count, partition_queues):
+        router = AggregatorRouter.__new__(AggregatorRouter)
+        router.partitioner = SourcePartitioner(partition_count)
+        router.publish_output = (lambda routing_key, body, prop_kwargs:
+                                 partition_queues[routing_key].append(body))
+        return router
+
+    def _run_partitioned(self, partition_count, messages, output):
+        partition_queues = collections.defaultdict(collections.deque)
+        router = self._make_router(partition_count, partition_queues)
+        for routing_key, body in messages:
+            router.input_callback(routing_key, body, None)
+        self.assertLessEqual(len(partition_queues), partition_count)
+        for partition in xrange(partition_count):
+            aggregator = self._make_aggregator(
+                get_partition_dbpath(self.dbpath, partition_count, partition),
+                output)
+            queue = partition_queues.pop('aggregator_partition_{}'.format(partition), ())
+            while queue:
+                aggregator.input_callback(None, queue.popleft(), None)
+            aggregator.db.close()
+        self.assertEqual(partition_queues, {})
+
+    @staticmethod
+    def _by_source(output):
+        result = collections.defaultdict(list)
+        for routing_key, payload in output:
+            result[payload['source']].append((routing_key, payload))
+        return dict(result)
+
+    def test_output_matches_single_instance_output(self):
+        messages = list(self._make_messages(2000))
+        single_instance_output = []
+        aggregator = self._make_aggregator(osp.join(self.tmp_dir, 'single.pickle'),
+                                           single_instance_output)
+        for _, body in messages:
+            aggregator.input_callback(None, body, None)
+
+        # first, 3 partitions...
+        partitioned_output = []
+        self._run_partitioned(3, messages[:1000], partitioned_output)
+        # ...then, 5 partitions (after rebalancing)
+        rebalance_partitioned_state(self.dbpath, self.time_tolerance, 3, 5)
+        self.assertFalse(osp.exists(self.dbpath))
+        self._run_partitioned(5, messages[1000:], partitioned_output)
+
+        self.assertEqual(self._by_source(partitioned_output),
+                         self._by_source(single_instance_output))
+        self.assertTrue(any(payload.get('type') == 'suppressed'
+                            for _, payload in single_instance_output))
+
+    def test_rebalancing_from_and_to_single_instance_mode(self):
+        messages = list(self._make_messages(1000))
+        single_instance_output = []
+        aggregator = self._make_aggregator(osp.join(self.tmp_dir, 'single.pickle'),
+                                           single_instance_output)
+        for _, body in messages:
+            aggregator.input_callback(None, body, None)
+
+        output = []
+        self._run_partitioned(1, messages[:300], output)
+        rebalance_partitioned_state(self.dbpath, self.time_tolerance, 1, 4)
+        self.assertFalse(osp.exists(self.dbpath))
+        self._run_partitioned(4, messages[300:600], output)
+        rebalance_partitioned_state(self.dbpath, self.time_tolerance, 4, 1)
+        self.assertEqual([name for name in os.listdir(self.tmp_dir)
+                          if name.startswith('aggregator_db')],
+                         ['aggregator_db.pickle'])
+        self._run_partitioned(1, messages[600:], output)
+
+        self.assertEqual(self._by_source(output), self._by_source(single_instance_output))
+
+    def _dir_contents(self):
+        contents = {}
+        for name in os.listdir(self.tmp_dir):
+            with open(osp.join(self.tmp_dir, name), 'rb') as f:
+                contents[name] = f.read()
+        return contents
+
+    def test_rebalancing_changes_nothing_if_new_state_cannot_be_saved(self):
+        messages = list(self._make_messages(1000))
+        single_instance_output = []
+        aggregator = self._make_aggregator(osp.join(self.tmp_dir, 'single.pickle'),
+                                           single_instance_output)
+        for _, body in messages:
+            aggregator.input_callback(None, body, None)
+        aggregator.db.close()
+
+        output = []
+        self._run_partitioned(1, messages[:500], output)
+        contents_before = self._dir_contents()
+        with patch('os.rename', side_effect=OSError(errno.ENOSPC, 'No space left on device')), \
+             patch('n6.utils.aggregator.LOGGER'):
+            with self.assertRaises(RebalancingError):
+                rebalance_partitioned_state(self.dbpath, self.time_tolerance, 1, 2)
+        self.assertEqual(self._dir_contents(), contents_before)
+        # (the state is intact, so the rebalancing can be retried)
+        rebalance_partitioned_state(self.dbpath, self.time_tolerance, 1, 2)
+        self._run_partitioned(2, messages[500:], output)
+
+        self.assertEqual(self._by_source(output), self._by_source(single_instance_output))
+
+    def test_rebalancing_changes_nothing_if_old_state_cannot_be_loaded(self):
+        self._run_partitioned(2, list(self._make_messages(300)), [])
+        with open(get_partition_dbpath(self.dbpath, 2, 1), 'wb') as f:
+            f.write('not a pickle')
+        contents_before = self._dir_contents()
+        with patch('n6.utils.aggregator.LOGGER'):
+            with self.assertRaises(RebalancingError):
+                rebalance_partitioned_state(self.dbpath, self.time_tolerance, 2, 1)
+        self.assertEqual(self._dir_contents(), contents_before)
+
+    def test_router_declares_and_binds_all_partition_queues_before_publishing(self):
+        router = self._make_router(3, collections.defaultdict(list))
+        router._channel_out = channel = MagicMock()
+        frame = MagicMock()
+        with patch('n6.base.queue.QueuedBase.on_output_exchange_declared') as super_method:
+            router.on_output_exchange_declared('aggregator_partitions', frame)
+            self.assertEqual(channel.queue_bind.mock_calls, [])
+            for c in channel.queue_declare.mock_calls:
+                c[1][0](MagicMock())
+            self.assertEqual(super_method.mock_calls, [])
+            for c in channel.queue_bind.mock_calls[:-1]:
+                c[1][0](MagicMock())
+            # (publishing is not started until all queues are bound)
+            self.assertEqual(super_method.mock_calls, [])
+            channel.queue_bind.mock_calls[-1][1][0](MagicMock())
+        self.assertEqual(super_method.mock_calls, [call('aggregator_partitions', frame)])
+        self.assertEqual(
+            [c[1][1:] + (c[2],) for c in channel.queue_declare.mock_calls],
+            [('aggregator_partition_{}'.format(partition),
+              {'durable': True,
+               'auto_delete': False,
+               'arguments': {'x-dead-letter-exchange': 'dead'}})
+             for partition in xrange(3)])
+        self.assertEqual(
+            [c[1][1:] for c in channel.queue_bind.mock_calls],
+            [('aggregator_partition_{}'.format(partition),
+              'aggregator_partitions',
+              'aggregator_partition_{}'.format(partition))
+             for partition in xrange(3)])
+
+    def test_router_rejects_unexpected_routing_key(self):
+        router = self._make_router(3, collections.defaultdict(list))
+        with self.assertRaises(n6QueueProcessingException):
+            router.input_callback('hifreq.parsed.foo', '{}', None)
+
+
+@expand
+class TestHiFreqEventData(unittest.TestCase):
+
+    def _make_payload(self, i):
+        return json.loads(json.dumps({
+            'id': '{:032x}'.format(i),
+            'source': 'testsource.testchannel',
+            'category': 'bots',
+            '_group': 'group{}'.format(i),
+            'time': '2017-06-01 10:00:00',
+            'address': [{'ip': '10.0.0.{}'.format(i)}],
+        }))
+
+    def test_compact_representation(self):
+        payload1 = self._make_payload(1)
+        payload2 = self._make_payload(2)
+        group1 = HiFreqEventData(payload1)
+        group2 = HiFreqEventData(payload2)
+        self.assertFalse(hasattr(group1, '__dict__'))
+        self.assertEqual(group1.payload, payload1)
+        self.assertEqual(group2.payload, payload2)
+        self.assertEqual(group2.group, 'group2')
+        self.assertIs(group1._payload_keys, group2._payload_keys)
+        self.assertIs(group1.payload['category'], group2.payload['category'])
+        self.assertIsNot(group1.payload['id'], group2.payload['id'])
+        self.assertIsInstance(group1.payload['id'], str)
+        self.assertEqual(HiFreqEventData(dict(payload1, name=u'zażółć')).payload['name'],
+                         u'zażółć')
+
+    def test_update_payload(self):
+        group = HiFreqEventData(self._make_payload(1))
+        group.update_payload({'category': 'cnc', 'name': 'foo'})
+        self.assertEqual(group.payload, dict(self._make_payload(1), category='cnc', name='foo'))
+
+    @foreach([0, 2])
+    def test_pickling(self, protocol):
+        group = HiFreqEventData(self._make_payload(1))
+        group.count = 5
+        group.until = datetime.datetime(2017, 6, 1, 11)
+        unpickled = cPickle.loads(cPickle.dumps(group, protocol))
+        self.assertEqual(unpickled.payload, group.payload)
+        self.assertEqual(unpickled.count, 5)
+        self.assertEqual(unpickled.first, datetime.datetime(2017, 6, 1, 10))
+        self.assertEqual(unpickled.until, datetime.datetime(2017, 6, 1, 11))
+        self.assertIs(unpickled._payload_keys, group._payload_keys)
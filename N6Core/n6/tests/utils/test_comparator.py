@@ -1,22 +1,42 @@
 # -*- coding: utf-8 -*-
 
-# Copyright (c) 2013-2018 NASK. All rights reserved.
-
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+import cPickle
+import datetime
+import os
+import os.path as osp
+import random
+import shutil
+import tempfile
+import time
 import unittest
+import urllib
 import json
 
 from mock import (
     MagicMock,
     call,
+    patch,
     sentinel as sen,
 )
+from unittest_expander import (
+    expand,
+    foreach,
+)
+
+from n6.base.queue import n6QueueProcessingException
 
 from n6.utils.comparator import (
+    BlackListData,
+    CompactBlackListData,
     Comparator,
     ComparatorData,
     ComparatorDataWrapper,
     ComparatorState,
+    SourceData,
 )
+from n6lib.datetime_helpers import parse_iso_datetime_to_utc
 from n6lib.unit_test_helpers import TestCaseMixin
 
 
@@ -33,6 +53,7 @@ class TestComparator__message_flow(TestCaseMixin, unittest.TestCase):
         self.patch_object(ComparatorDataWrapper, 'store_state')
         self.comparator.db = ComparatorDataWrapper.__new__(ComparatorDataWrapper)
         self.comparator.db.comp_data = ComparatorData()
+        self.comparator.db.dbpath = '/nonexistent/comparator_db.pickle'
 
         self.comparator.publish_output = MagicMock()
 
@@ -503,3 +524,445 @@ class TestComparator__message_flow(TestCaseMixin, unittest.TestCase):
             new_body = json.loads(call_kwargs['body'])
             deserialized_call_list.append(call(body=new_body, routing_key=call_kwargs['routing_key']))
         return deserialized_call_list
+
+
+class TestComparatorState(unittest.TestCase):
+
+    def setUp(self):
+        self.state = ComparatorState(sen.irrelevant)
+
+    def _message(self, series_no, total=3, series_id='s1'):
+        return {
+            '_bl-series-id': series_id,
+            '_bl-series-total': total,
+            '_bl-series-no': series_no,
+            'id': 'id-{}-{}'.format(series_id, series_no),
+        }
+
+    def _receive(self, message):
+        if not self.state.is_message_valid(message):
+            return 'invalid'
+        self.state.update_series(message)
+        return ('complete' if self.state.is_series_complete(message['_bl-series-id'])
+                else 'incomplete')
+
+    def test_out_of_order_messages(self):
+        self.assertEqual(self._receive(self._message(3)), 'incomplete')
+        self.assertEqual(self._receive(self._message(1)), 'incomplete')
+        self.assertEqual(self._receive(self._message(2)), 'complete')
+        self.assertEqual(self.state.open_series['s1']['msg-nums'], {1, 2, 3})
+        self.assertEqual(self.state.open_series['s1']['msg-ids'], ['id-s1-3', 'id-s1-1', 'id-s1-2'])
+
+    def test_duplicate_messages(self):
+        self.assertEqual(self._receive(self._message(1)), 'incomplete')
+        self.assertEqual(self._receive(self._message(1)), 'invalid')
+        self.assertEqual(self._receive(self._message(2)), 'incomplete')
+        self.assertEqual(self._receive(self._message(2)), 'invalid')
+        self.assertEqual(self.state.open_series['s1']['msg-count'], 2)
+
+    def test_missing_message(self):
+        for series_no in (1, 3):
+            self.assertEqual(self._receive(self._message(series_no)), 'incomplete')
+        self.assertFalse(self.state.is_series_complete('s1'))
+        self.state.close_series('s1')
+        self.assertEqual(self.state.open_series, {})
+
+    def test_total_mismatch_and_too_many_messages(self):
+        self.assertEqual(self._receive(self._message(1, total=2)), 'incomplete')
+        self.assertEqual(self._receive(self._message(2, total=3)), 'invalid')
+        self.assertEqual(self._receive(self._message(5, total=2)), 'complete')
+        self.assertEqual(self._receive(self._message(6, total=2)), 'invalid')
+
+    def test_separate_series(self):
+        self.assertEqual(self._receive(self._message(1, total=2, series_id='s1')), 'incomplete')
+        self.assertEqual(self._receive(self._message(1, total=1, series_id='s2')), 'complete')
+        self.assertEqual(self._receive(self._message(2, total=2, series_id='s1')), 'complete')
+
+    def test_large_series(self):
+        total = 20000
+        for series_no in reversed(xrange(1, total)):
+            self.assertEqual(self._receive(self._message(series_no, total=total)), 'incomplete')
+            self.assertEqual(self._receive(self._message(series_no, total=total)), 'invalid')
+        self.assertEqual(self._receive(self._message(total, total=total)), 'complete')
+
+
+class TestComparatorDataWrapper__persistence(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.dbpath = osp.join(self.tmp_dir, 'comparator_db.pickle')
+        self.sources_dir = self.dbpath + '.sources'
+
+    def _message(self, source, series_id, ip, bl_time='2017-01-19 12:07:32'):
+        return {
+            '_bl-time': bl_time,
+            '_bl-series-total': 1,
+            '_bl-series-no': 1,
+            '_bl-series-id': series_id,
+            'expires': '2017-01-20 15:15:15',
+            'time': '2017-01-18 15:15:15',
+            'address': [{'ip': ip}],
+            'source': source,
+            'id': '{:032x}'.format(hash((source, series_id, ip)) % 2 ** 128),
+        }
+
+    def _process_series(self, wrapper, source, series_id, ips):
+        for ip in ips:
+            wrapper.process_new_message(self._message(source, series_id, ip))
+        return list(wrapper.process_deleted(source))
+
+    def _state_repr(self, wrapper):
+        source_names = set(wrapper.comp_data.sources)
+        if osp.isdir(self.sources_dir):
+            source_names.update(urllib.unquote(filename[:-len('.pickle')])
+                                for filename in self._stored_filenames()
+                                if filename.endswith('.pickle'))
+        # (note: not using `get_source_data()`, not to affect eviction)
+        return {
+            source_name: {key: (event.payload, event.flag, event.expires)
+                          for key, event in (wrapper.comp_data.sources.get(source_name) or
+                                             wrapper._load_source_data(source_name)
+                                             ).blacklist.iteritems()}
+            for source_name in source_names}
+
+    def _stored_filenames(self):
+        return sorted(os.listdir(self.sources_dir))
+
+    def test_only_dirty_sources_stored(self):
+        wrapper = ComparatorDataWrapper(self.dbpath)
+        self._process_series(wrapper, 'src1.ch', 's1', ['1.1.1.1', '2.2.2.2'])
+        self._process_series(wrapper, 'src2.ch', 's2', ['3.3.3.3'])
+        self.assertEqual(self._stored_filenames(), ['src1.ch.pickle', 'src2.ch.pickle'])
+        with patch.object(ComparatorDataWrapper, '_store_source_data',
+                          wraps=wrapper._store_source_data) as store_mock:
+            self._process_series(wrapper, 'src2.ch', 's3', ['3.3.3.3'])
+        self.assertEqual([c[0][0] for c in store_mock.call_args_list], ['src2.ch'])
+        with patch.object(ComparatorDataWrapper, '_store_source_data') as store_mock:
+            wrapper.store_state()
+        self.assertEqual(store_mock.call_args_list, [])
+        self.assertEqual(self._state_repr(ComparatorDataWrapper(self.dbpath)),
+                         self._state_repr(wrapper))
+
+    def test_checkpoint_interval(self):
+        wrapper = ComparatorDataWrapper(self.dbpath, checkpoint_interval=3600)
+        self._process_series(wrapper, 'src1.ch', 's1', ['1.1.1.1'])
+        # (a series that timed out)
+        wrapper.process_new_message(self._message('src2.ch', 's2', '3.3.3.3'))
+        wrapper.clear_flags('src2.ch', 's2')
+        self.assertFalse(osp.exists(self.sources_dir))
+        with patch('time.time', return_value=time.time() + 3600):
+            self._process_series(wrapper, 'src3.ch', 's3', ['4.4.4.4'])
+        self.assertEqual(self._stored_filenames(),
+                         ['src1.ch.pickle', 'src2.ch.pickle', 'src3.ch.pickle'])
+
+    def test_state_after_crash_is_the_state_as_of_last_checkpoint(self):
+        wrapper = ComparatorDataWrapper(self.dbpath)
+        self._process_series(wrapper, 'src1.ch', 's1', ['1.1.1.1', '2.2.2.2'])
+        expected_state_repr = self._state_repr(wrapper)
+        # (a series in progress when the crash occurs)
+        wrapper.process_new_message(self._message('src1.ch', 's2', '5.5.5.5'))
+        wrapper.process_new_message(self._message('src2.ch', 's3', '6.6.6.6'))
+        restored = ComparatorDataWrapper(self.dbpath)
+        self.assertEqual(self._state_repr(restored), expected_state_repr)
+
+    def test_failed_write_leaves_previous_state_and_source_stays_dirty(self):
+        wrapper = ComparatorDataWrapper(self.dbpath)
+        self._process_series(wrapper, 'src1.ch', 's1', ['1.1.1.1'])
+        expected_state_repr = self._state_repr(wrapper)
+        wrapper.process_new_message(self._message('src1.ch', 's2', '2.2.2.2'))
+        with patch('os.fsync', side_effect=OSError('disk failure')):
+            self.assertFalse(wrapper.store_state())
+        self.assertTrue(wrapper.comp_data.sources['src1.ch'].dirty)
+        self.assertEqual(self._state_repr(ComparatorDataWrapper(self.dbpath)),
+                         expected_state_repr)
+        self.assertTrue(wrapper.store_state())
+        self.assertFalse(wrapper.comp_data.sources['src1.ch'].dirty)
+        self.assertEqual(self._state_repr(ComparatorDataWrapper(self.dbpath)),
+                         self._state_repr(wrapper))
+
+    def test_migration_from_former_state_file(self):
+        comp_data = ComparatorData()
+        source_data = comp_data.get_or_create_sourcedata('src1.ch')
+        source_data.process_event(self._message('src1.ch', 's1', '1.1.1.1'))
+        del source_data.dirty   # (former instances had no such attribute)
+        with open(self.dbpath, 'w') as f:
+            cPickle.dump(comp_data, f)
+        wrapper = ComparatorDataWrapper(self.dbpath)
+        self.assertEqual(wrapper.comp_data.sources.keys(), ['src1.ch'])
+        self.assertFalse(osp.exists(self.dbpath))
+        self.assertTrue(osp.exists(self.dbpath + '.migrated'))
+        self.assertEqual(self._stored_filenames(), ['src1.ch.pickle'])
+        self.assertEqual(self._state_repr(ComparatorDataWrapper(self.dbpath)),
+                         self._state_repr(wrapper))
+
+    def test_migration_repeated_after_partial_failure(self):
+        comp_data = ComparatorData()
+        for source_name, ip in [('src1.ch', '1.1.1.1'), ('src2.ch', '2.2.2.2')]:
+            source_data = comp_data.get_or_create_sourcedata(source_name)
+            source_data.process_event(self._message(source_name, 's1', ip))
+            source_data.process_deleted()
+        with open(self.dbpath, 'w') as f:
+            cPickle.dump(comp_data, f)
+        orig_store_source_data = ComparatorDataWrapper._store_source_data
+        def store_source_data(wrapper, source_name, source_data):
+            if source_name == 'src2.ch':
+                raise OSError('disk failure')
+            orig_store_source_data(wrapper, source_name, source_data)
+        with patch.object(ComparatorDataWrapper, '_store_source_data', store_source_data):
+            wrapper = ComparatorDataWrapper(self.dbpath)
+        self.assertTrue(osp.exists(self.dbpath))
+        self.assertEqual(self._stored_filenames(), ['src1.ch.pickle'])
+        # (newer states of both sources are stored at a checkpoint)
+        self.assertEqual(self._process_series(wrapper, 'src1.ch', 's2', ['3.3.3.3']), [
+            ['bl-delist', self._message('src1.ch', 's1', '1.1.1.1')],
+        ])
+        self.assertEqual(self._process_series(wrapper, 'src2.ch', 's2', ['4.4.4.4']), [
+            ['bl-delist', self._message('src2.ch', 's1', '2.2.2.2')],
+        ])
+        self.assertEqual(self._stored_filenames(), ['src1.ch.pickle', 'src2.ch.pickle'])
+        expected_state_repr = self._state_repr(wrapper)
+        # (a restart: the migration is repeated, but the newer states are kept)
+        restored = ComparatorDataWrapper(self.dbpath)
+        self.assertFalse(osp.exists(self.dbpath))
+        self.assertTrue(osp.exists(self.dbpath + '.migrated'))
+        self.assertEqual(self._state_repr(restored), expected_state_repr)
+        self.assertEqual(self._process_series(restored, 'src1.ch', 's3', ['3.3.3.3']), [])
+        self.assertEqual(self._process_series(restored, 'src2.ch', 's3', ['4.4.4.4']), [])
+
+    def test_compact_blacklists(self):
+        wrapper = ComparatorDataWrapper(self.dbpath)
+        self._process_series(wrapper, 'src1.ch', 's1', ['1.1.1.1', '2.2.2.2'])
+        expected_state_repr = self._state_repr(wrapper)
+        wrapper = ComparatorDataWrapper(self.dbpath, compact_blacklists=True)
+        source_data = wrapper.get_source_data('src1.ch')
+        self.assertTrue(source_data.compact)
+        self.assertTrue(source_data.dirty)
+        self.assertEqual(set(map(type, source_data.blacklist.itervalues())),
+                         {CompactBlackListData})
+        self.assertEqual(set(map(len, source_data.blacklist)), {16})
+        self.assertTrue(wrapper.store_state())
+        self.assertEqual(
+            sorted(self._state_repr(ComparatorDataWrapper(self.dbpath,
+                                                          compact_blacklists=True))['src1.ch']
+                   .values()),
+            sorted(expected_state_repr['src1.ch'].values()))
+        self.assertEqual(self._state_repr(ComparatorDataWrapper(self.dbpath)),
+                         expected_state_repr)
+        wrapper = ComparatorDataWrapper(self.dbpath, compact_blacklists=True)
+        self.assertEqual(self._process_series(wrapper, 'src1.ch', 's2', ['1.1.1.1']), [
+            ['bl-delist', self._message('src1.ch', 's1', '2.2.2.2')],
+        ])
+        self.assertTrue(wrapper.get_source_data('new.ch').compact)
+
+    def test_sources_loaded_lazily(self):
+        wrapper = ComparatorDataWrapper(self.dbpath)
+        self._process_series(wrapper, 'src1.ch', 's1', ['1.1.1.1'])
+        self._process_series(wrapper, 'src/2.ch', 's2', ['2.2.2.2'])
+        expected_state_repr = self._state_repr(wrapper)
+        restored = ComparatorDataWrapper(self.dbpath)
+        self.assertEqual(restored.comp_data.sources, {})
+        self.assertEqual(self._process_series(restored, 'src/2.ch', 's3', []), [
+            ['bl-delist', self._message('src/2.ch', 's2', '2.2.2.2')],
+        ])
+        self.assertEqual(restored.comp_data.sources.keys(), ['src/2.ch'])
+        self.assertEqual(restored.get_source_data('src1.ch').blacklist.keys(),
+                         expected_state_repr['src1.ch'].keys())
+
+    def test_idle_sources_evicted(self):
+        wrapper = ComparatorDataWrapper(self.dbpath, checkpoint_interval=3600,
+                                        source_idle_timeout=600)
+        now = time.time()
+        with patch('time.time', return_value=now):
+            self._process_series(wrapper, 'src1.ch', 's1', ['1.1.1.1'])
+            self._process_series(wrapper, 'src2.ch', 's2', ['2.2.2.2'])
+        self.assertFalse(osp.exists(self.sources_dir))
+        with patch('time.time', return_value=now + 300):
+            self._process_series(wrapper, 'src2.ch', 's3', ['2.2.2.2', '3.3.3.3'])
+        expected_state_repr = self._state_repr(wrapper)
+        with patch('time.time', return_value=now + 600):
+            self._process_series(wrapper, 'src3.ch', 's4', ['4.4.4.4'])
+        # (the dirty state of the evicted source has been stored)
+        self.assertEqual(sorted(wrapper.comp_data.sources), ['src2.ch', 'src3.ch'])
+        self.assertEqual(self._stored_filenames(), ['src1.ch.pickle'])
+        with patch('time.time', return_value=now + 900):
+            self._process_series(wrapper, 'src3.ch', 's5', ['4.4.4.4'])
+        self.assertEqual(sorted(wrapper.comp_data.sources), ['src3.ch'])
+        self.assertEqual(self._stored_filenames(), ['src1.ch.pickle', 'src2.ch.pickle'])
+        # (evicted sources are loaded again when needed)
+        self.assertEqual(self._process_series(wrapper, 'src1.ch', 's6', ['1.1.1.1']), [])
+        self.assertEqual(wrapper.get_source_data('src2.ch').blacklist.keys(),
+                         expected_state_repr['src2.ch'].keys())
+        self.assertEqual(self._state_repr(wrapper)['src2.ch'], expected_state_repr['src2.ch'])
+
+
+class _NaiveSourceData(SourceData):
+
+    """
+    The reference implementation of the `SourceData` logic (flagging
+    entries and scanning the whole blacklist), for the differential
+    tests.
+    """
+
+    def process_event(self, data):
+        event_time = parse_iso_datetime_to_utc(data['_bl-time'])
+        if self.time is None:
+            self.time = event_time
+        if event_time < self.time:
+            raise n6QueueProcessingException('Event belongs to blacklist'
+                                             ' older than the last one processed.')
+        event_key = self.get_event_key(data)
+        event = self.blacklist.get(event_key)
+        if event is None:
+            new_event = BlackListData(data)
+            new_event.flag = data.get("_bl-series-id")
+            self.blacklist[event_key] = new_event
+            return 'bl-new', new_event.payload
+        else:
+            ips_old = event.ip
+            ips_new = [x["ip"] for x in data.get("address")] if data.get("address") is not None else []
+            if self._are_ips_different(ips_old, ips_new):
+                data["replaces"] = event.id
+                new_event = BlackListData(data)
+                new_event.flag = data.get("_bl-series-id")
+                self.blacklist[event_key] = new_event
+                return "bl-change", new_event.payload
+            elif parse_iso_datetime_to_utc(data.get("expires")) != event.expires:
+                event.expires = parse_iso_datetime_to_utc(data.get("expires"))
+                event.flag = data.get("_bl-series-id")
+                event.update_payload({"expires": data.get("expires")})
+                return "bl-update", event.payload
+            else:
+                event.flag = data.get("_bl-series-id")
+                return None, event.payload
+
+    def process_deleted(self):
+        ret_value = []
+        for key, event in list(self.blacklist.iteritems()):
+            if event.flag is None:
+                del self.blacklist[key]
+                ret_value.append(["bl-delist", event.payload.copy()])
+                continue
+            if event.expires < self.time:
+                del self.blacklist[key]
+                ret_value.append(["bl-expire", event.payload.copy()])
+                continue
+            event.flag = None
+        return ret_value
+
+    def clear_flags(self, flag_id):
+        for key, event in list(self.blacklist.iteritems()):
+            if event.flag == flag_id:
+                event.flag = None
+
+
+@expand
+class TestSourceData__randomized_differential(unittest.TestCase):
+
+    def _iter_operations(self, rnd):
+        keys = ['{}.example.com'.format(i) for i in xrange(rnd.choice([5, 50, 300]))]
+        bl_time = datetime.datetime(2020, 1, 1)
+        for series_num in xrange(60):
+            bl_time += datetime.timedelta(hours=rnd.randrange(1, 12))
+            series_id = 'series{}'.format(series_num)
+            present_keys = rnd.sample(keys, rnd.randrange(len(keys) + 1))
+            if rnd.random() < 0.2:
+                # (another series of the source, which will time out)
+                yield 'message', self._make_message(rnd, 'other' + series_id, bl_time,
+                                                    rnd.choice(keys))
+            for i, key in enumerate(present_keys):
+                if rnd.random() < 0.02:
+                    # (the older bl-time => out of order)
+                    yield 'message', self._make_message(
+                        rnd, series_id, bl_time - datetime.timedelta(days=1), key)
+                yield 'message', self._make_message(rnd, series_id, bl_time, key)
+                if rnd.random() < 0.1:
+                    yield 'message', self._make_message(rnd, series_id, bl_time, key)
+                if rnd.random() < 0.05:
+                    yield 'clear_flags', 'other' + series_id
+            if rnd.random() < 0.15:
+                yield 'clear_flags', series_id    # (series timed out)
+            else:
+                yield 'process_deleted', None
+            if rnd.random() < 0.1:
+                yield 'pickle', None
+
+    def _make_message(self, rnd, series_id, bl_time, key):
+        expires = bl_time + datetime.timedelta(hours=rnd.choice([-5, 1, 5, 24, 48, 72]))
+        return {
+            '_bl-time': str(bl_time),
+            '_bl-series-id': series_id,
+            'expires': str(expires),
+            'fqdn': key,
+            'address': [{'ip': '10.0.0.{}'.format(rnd.randrange(2))}],
+            'source': 'testsource.testchannel',
+            'id': '{:032x}'.format(rnd.getrandbits(128)),
+        }
+
+    @staticmethod
+    def _apply(source_data, operation, arg):
+        if operation == 'message':
+            try:
+                result = source_data.process_event(dict(arg))
+            except n6QueueProcessingException:
+                return 'error'
+            source_data.update_time(parse_iso_datetime_to_utc(arg['_bl-time']))
+            return result
+        if operation == 'process_deleted':
+            return sorted(source_data.process_deleted())
+        assert operation == 'clear_flags'
+        return source_data.clear_flags(arg)
+
+    @foreach(range(15))
+    def test(self, seed):
+        self._test(seed, SourceData())
+
+    @foreach(range(5))
+    def test_compact(self, seed):
+        self._test(seed, SourceData(compact=True))
+
+    @foreach(range(5))
+    def test_compact_with_colliding_digests(self, seed):
+        digests = ['digest{}'.format(i) for i in xrange(3)]
+        with patch('n6.utils.comparator._get_key_digest',
+                   side_effect=lambda event_key: digests[hash(event_key) % len(digests)]):
+            self._test(seed, SourceData(compact=True))
+
+    @foreach(range(5))
+    def test_converted_to_compact_and_back(self, seed):
+        self._test(seed, SourceData(), convert_to_compact=True)
+
+    def _test(self, seed, source_data, convert_to_compact=False):
+        rnd = random.Random(seed)
+        reference = _NaiveSourceData()
+        for operation, arg in self._iter_operations(rnd):
+            if operation == 'pickle':
+                source_data = cPickle.loads(cPickle.dumps(source_data, cPickle.HIGHEST_PROTOCOL))
+                if convert_to_compact:
+                    source_data.set_compact(not source_data.compact)
+                continue
+            self.assertEqual(self._apply(source_data, operation, arg),
+                             self._apply(reference, operation, arg))
+        self.assertEqual(
+            {source_data.get_event_key(event.payload): event.payload
+             for event in source_data.blacklist.itervalues()},
+            {key: event.payload for key, event in reference.blacklist.iteritems()})
+
+    def test_state_pickled_by_older_version_migrated(self):
+        rnd = random.Random(0)
+        source_data = SourceData()
+        reference = _NaiveSourceData()
+        operations = list(self._iter_operations(rnd))
+        for operation, arg in operations[:len(operations) // 2]:
+            if operation != 'pickle':
+                self._apply(reference, operation, arg)
+        # (an older `SourceData` had no generation-related attributes)
+        source_data.__dict__.update(cPickle.loads(cPickle.dumps(reference.__dict__)))
+        for name in ['generation'] + list(SourceData._INDEX_ATTRIBUTE_NAMES):
+            source_data.__dict__.pop(name)
+        source_data = cPickle.loads(cPickle.dumps(source_data))
+        for operation, arg in operations[len(operations) // 2:]:
+            if operation != 'pickle':
+                self.assertEqual(self._apply(source_data, operation, arg),
+                                 self._apply(reference, operation, arg))
+
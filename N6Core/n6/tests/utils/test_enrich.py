@@ -1,18 +1,33 @@
 # -*- coding: utf-8 -*-
 
-# Copyright (c) 2013-2018 NASK. All rights reserved.
+# Copyright (c) 2013-2020 NASK. All rights reserved.
 
+import SocketServer
+import collections
 import datetime
 import hashlib
+import json
+import random
+import threading
+import time
 import unittest
 
+import dns.message
+import dns.rcode
+import dns.resolver
+import dns.rrset
 import iptools
 import mock
 from geoip2.errors import GeoIP2Error
 from dns.exception import DNSException
 
-from n6.utils.enrich import Enricher
-from n6lib.record_dict import RecordDict
+from n6.utils.enrich import (
+    Enricher,
+    GeoIPCache,
+    IPRangeIndex,
+    PrevalidatedRecord,
+)
+from n6lib.record_dict import AdjusterError, RecordDict
 from n6lib.unit_test_helpers import TestCaseMixin
 
 
@@ -55,9 +70,9 @@ class TestEnricher(TestCaseMixin, unittest.TestCase):
 
     @mock.patch('n6.base.queue.QueuedBase.get_connection_params_dict')
     @mock.patch('n6.utils.enrich.Config', MockConfig)
+    @mock.patch('n6.utils.enrich.Enricher._setup_dnsresolver', mock.MagicMock())
+    @mock.patch('n6.utils.enrich.Enricher._setup_geodb', mock.MagicMock())
     def setUp(self, *args):
-        Enricher._setup_dnsresolver = mock.MagicMock()
-        Enricher._setup_geodb = mock.MagicMock()
         self.enricher = Enricher()
         self.enricher._resolver = mock.MagicMock()
         self.enricher._resolver.query = mock.MagicMock(return_value=["127.0.0.1"])
@@ -574,6 +589,17 @@ class TestEnricher(TestCaseMixin, unittest.TestCase):
                          "asn": '1234',
                          "cc": 'PL'}]}))
 
+    def test__enrich__with_excluded_ips_config__with_ipv6_ranges(self):
+        self.enricher._enrich_config = {'dnshost': '8.8.8.8',
+                                        'dnsport': '53',
+                                        'geoippath': '/usr/share/GeoIP',
+                                        'excluded_ips': '2001:db8::/32, 127.0.0.0/8, ::1'}
+        self.enricher.excluded_ips = self.enricher._get_excluded_ips()
+        data = self.enricher.enrich(RecordDict({"url": "http://www.nask.pl/asd",
+                                                "address": [{'ip': "127.0.0.1"},
+                                                            {'ip': "128.0.0.1"}]}))
+        self.assertEqual(data["address"], [{"ip": '128.0.0.1', "asn": 1234, "cc": 'PL'}])
+
     def test__filter_out_excluded_ips__with_excluded_ips_being_None(self):
         self.enricher.excluded_ips = None
         data = RecordDict({
@@ -683,3 +709,478 @@ class TestEnricher(TestCaseMixin, unittest.TestCase):
         self.enricher._filter_out_excluded_ips(data, ip_to_enr_mock)
         self.assertEqualIncludingTypes(expected, data)
         self.assertItemsEqual(ip_to_enr_mock.mock_calls, ip_to_enr_expected_call_items)
+
+
+class TestEnricher__geoip_cache(unittest.TestCase):
+
+    @mock.patch('n6.base.queue.QueuedBase.get_connection_params_dict')
+    @mock.patch('n6.utils.enrich.Config', MockConfig)
+    @mock.patch('n6.utils.enrich.Enricher._setup_dnsresolver', mock.MagicMock())
+    @mock.patch('n6.utils.enrich.Enricher._setup_geodb', mock.MagicMock())
+    def setUp(self, *args):
+        self.enricher = Enricher()
+        self.enricher.gi_asn = mock.Mock()
+        self.enricher.gi_asn.asn.side_effect = lambda ip: mock.Mock(
+            autonomous_system_number=int(ip.split('.')[0]))
+        self.enricher.gi_cc = mock.Mock()
+        self.enricher.gi_cc.city.side_effect = lambda ip: mock.Mock(
+            country=mock.Mock(iso_code=('PL' if ip.startswith('1.') else None)))
+
+    def test_one_lookup_per_address(self):
+        for _ in xrange(3):
+            data = self.enricher.enrich(RecordDict({
+                "address": [{"ip": "1.1.1.1"}, {"ip": "2.2.2.2"}]}))
+            self.assertEqual(data["address"], [{u'ip': u'1.1.1.1', u'asn': 1, u'cc': u'PL'},
+                                               {u'ip': u'2.2.2.2', u'asn': 2}])
+        self.assertEqual(self.enricher.gi_asn.asn.mock_calls,
+                         [mock.call(u'1.1.1.1'), mock.call(u'2.2.2.2')])
+        self.assertEqual(self.enricher.gi_cc.city.mock_calls,
+                         [mock.call(u'1.1.1.1'), mock.call(u'2.2.2.2')])
+        self.assertEqual((self.enricher._geoip_cache.hits, self.enricher._geoip_cache.misses),
+                         (10, 2))
+
+    def test_lookup_errors_cached(self):
+        self.enricher.gi_asn.asn.side_effect = GeoIP2Error
+        self.assertIsNone(self.enricher.ip_to_asn('1.2.3.4'))
+        self.assertEqual(self.enricher.ip_to_cc('1.2.3.4'), 'PL')
+        self.assertIsNone(self.enricher.ip_to_asn('1.2.3.4'))
+        self.assertEqual(self.enricher.gi_asn.asn.call_count, 1)
+        self.assertEqual(self.enricher.gi_cc.city.call_count, 1)
+
+
+class TestGeoIPCache(unittest.TestCase):
+
+    def setUp(self):
+        self.lookup = mock.Mock(side_effect=lambda ip: (len(ip), ip))
+
+    def test_least_recently_used_evicted(self):
+        cache = GeoIPCache(self.lookup, max_size=2)
+        for ip in ['1.1.1.1', '2.2.2.2', '1.1.1.1', '3.3.3.3', '1.1.1.1', '2.2.2.2']:
+            self.assertEqual(cache.get(ip), (7, ip))
+        self.assertEqual(self.lookup.mock_calls, [mock.call('1.1.1.1'),
+                                                  mock.call('2.2.2.2'),
+                                                  mock.call('3.3.3.3'),
+                                                  mock.call('2.2.2.2')])
+        self.assertEqual((cache.hits, cache.misses, cache.hit_ratio), (2, 4, 2 / 6.0))
+
+    def test_caching_disabled(self):
+        cache = GeoIPCache(self.lookup, max_size=0)
+        for _ in xrange(3):
+            self.assertEqual(cache.get('1.1.1.1'), (7, '1.1.1.1'))
+        self.assertEqual(self.lookup.call_count, 3)
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+
+    @mock.patch('n6.utils.enrich.LOGGER')
+    def test_stats_logged_periodically(self, LOGGER_mock):
+        cache = GeoIPCache(self.lookup, stats_log_interval=3)
+        for ip in ['1.1.1.1', '2.2.2.2', '1.1.1.1', '1.1.1.1']:
+            cache.get(ip)
+        self.assertEqual(LOGGER_mock.info.call_count, 1)
+        self.assertEqual(LOGGER_mock.info.mock_calls[0][1][1:4], (1, 2, 1 / 3.0))
+
+
+class _LocalDNSRequestHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        wire, sock = self.request
+        query = dns.message.from_wire(wire)
+        qname = query.question[0].name
+        behavior = self.server.behaviors.get(qname.to_text().rstrip('.'))
+        response = dns.message.make_response(query)
+        if behavior is None:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        else:
+            delay, ips = behavior
+            if ips is None:
+                return  # (simulating a timeout: never responding)
+            time.sleep(delay)
+            response.answer.append(dns.rrset.from_text(qname, 60, 'IN', 'A', *ips))
+        sock.sendto(response.to_wire(), self.client_address)
+
+
+class _LocalDNSServer(SocketServer.ThreadingUDPServer):
+
+    """
+    A stand-in DNS server (for A queries), with injected latency and
+    timeouts: `behaviors` maps domain names to (<delay in seconds>,
+    <list of IPs or None -- meaning no response at all>) pairs; for
+    other names, NXDOMAIN is returned.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, behaviors):
+        SocketServer.ThreadingUDPServer.__init__(self, ('127.0.0.1', 0), _LocalDNSRequestHandler)
+        self.behaviors = behaviors
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class _FakeConnection(object):
+
+    def __init__(self):
+        self.timeouts = []
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append((time.time() + deadline, callback))
+
+    def run_due_timeouts(self):
+        now = time.time()
+        due = [t for t in self.timeouts if t[0] <= now]
+        self.timeouts = [t for t in self.timeouts if t[0] > now]
+        for _, callback in due:
+            callback()
+
+
+class TestEnricher__concurrent_dns(unittest.TestCase):
+
+    DNS_BEHAVIORS = {
+        'slow.example.com': (0.4, ['10.0.0.1']),
+        'timeout.example.com': (0, None),
+        'fast1.example.com': (0, ['10.0.0.2', '10.0.0.3']),
+        'fast2.example.com': (0, ['10.0.0.4']),
+        'xn--w-uga1v8h.example.com': (0, ['10.0.0.5']),
+    }
+    RESOLVER_LIFETIME = 0.6
+
+    def _make_enricher(self, dns_concurrency, dns_port):
+        class Config(MockConfig):
+            config = dict(MockConfig.config, enrich=dict(MockConfig.config['enrich'],
+                                                         dns_concurrency=str(dns_concurrency)))
+        with mock.patch('n6.base.queue.QueuedBase.get_connection_params_dict'), \
+             mock.patch('n6.utils.enrich.Config', Config), \
+             mock.patch.object(Enricher, '_setup_dnsresolver'), \
+             mock.patch.object(Enricher, '_setup_geodb'):
+            enricher = Enricher()
+        if enricher._dns_pool is not None:
+            self.addCleanup(enricher._dns_pool.terminate)
+        enricher._resolver = dns.resolver.Resolver(configure=False)
+        enricher._resolver.nameservers = ['127.0.0.1']
+        enricher._resolver.port = dns_port
+        enricher._resolver.timeout = enricher._resolver.lifetime = self.RESOLVER_LIFETIME
+        enricher.gi_asn = mock.Mock(**{'asn.side_effect': GeoIP2Error})
+        enricher.gi_cc = mock.Mock(**{'city.side_effect': GeoIP2Error})
+        enricher._connection = _FakeConnection()
+        enricher._channel_in = mock.Mock()
+        enricher.publish_output = mock.Mock()
+        return enricher
+
+    def _message_bodies(self):
+        bodies = []
+        for i, (key, value) in enumerate([
+                ('fqdn', 'slow.example.com'),
+                ('fqdn', 'timeout.example.com'),
+                ('url', 'http://fast1.example.com/foo'),
+                ('address', [{'ip': '10.20.30.40'}]),
+                ('fqdn', 'nonexistent.example.com'),
+                (None, None),
+                ('fqdn', 'fast2.example.com')]):
+            if key is None:
+                bodies.append('{"invalid": ')
+            else:
+                data = RecordDict(TestEnricher.COMMON_DATA)
+                data['id'] = hashlib.md5(str(i)).hexdigest()
+                data[key] = value
+                bodies.append(data.get_ready_json())
+        return bodies
+
+    def _process_all(self, enricher, bodies):
+        for delivery_tag, body in enumerate(bodies, 1):
+            basic_deliver = mock.Mock(delivery_tag=delivery_tag,
+                                      routing_key='event.parsed.test.test')
+            enricher.on_message(mock.sentinel.channel, basic_deliver, None, body)
+        deadline = time.time() + 5
+        while enricher._connection.timeouts and time.time() < deadline:
+            time.sleep(0.001)
+            enricher._connection.run_due_timeouts()
+
+    def _get_results(self, enricher):
+        return (
+            [(kwargs['routing_key'], json.loads(kwargs['body']))
+             for _, kwargs in enricher.publish_output.call_args_list],
+            [(name, args[0]) for name, args, _ in enricher._channel_in.mock_calls])
+
+    def test_results_published_and_acked_in_order(self):
+        bodies = self._message_bodies()
+        with _LocalDNSServer(self.DNS_BEHAVIORS) as server:
+            sequential_enricher = self._make_enricher(1, server.server_address[1])
+            start = time.time()
+            self._process_all(sequential_enricher, bodies)
+            sequential_duration = time.time() - start
+            concurrent_enricher = self._make_enricher(4, server.server_address[1])
+            start = time.time()
+            self._process_all(concurrent_enricher, bodies)
+            concurrent_duration = time.time() - start
+        published, acks = self._get_results(concurrent_enricher)
+        self.assertEqual((published, acks), self._get_results(sequential_enricher))
+        self.assertEqual(acks, [('basic_ack', 1), ('basic_ack', 2), ('basic_ack', 3),
+                                ('basic_ack', 4), ('basic_ack', 5), ('basic_nack', 6),
+                                ('basic_ack', 7)])
+        self.assertEqual([body.get('fqdn') for _, body in published], [
+            'slow.example.com',
+            'timeout.example.com',
+            'fast1.example.com',    # (from the URL)
+            None,
+            'nonexistent.example.com',
+            'fast2.example.com',
+        ])
+        self.assertEqual([body.get('address') for _, body in published], [
+            [{'ip': '10.0.0.1'}],
+            None,
+            [{'ip': '10.0.0.2'}, {'ip': '10.0.0.3'}],
+            [{'ip': '10.20.30.40'}],
+            None,
+            [{'ip': '10.0.0.4'}],
+        ])
+        self.assertEqual(concurrent_enricher._pending_messages, collections.deque())
+        # the sequential enricher waits for the slow server and for
+        # the timeout one after another, the concurrent one -- not
+        self.assertGreater(sequential_duration, 0.4 + self.RESOLVER_LIFETIME)
+        self.assertLess(concurrent_duration, 0.4 + self.RESOLVER_LIFETIME)
+
+    def test_lookups_made_only_by_pool_workers_for_adjusted_fqdns(self):
+        bodies = []
+        for i, url in enumerate(['http://FAST1.Example.COM/foo',
+                                 u'http://żółw.example.com/']):
+            data = RecordDict(TestEnricher.COMMON_DATA)
+            data['id'] = hashlib.md5(str(i)).hexdigest()
+            data['url'] = url
+            bodies.append(data.get_ready_json())
+        main_thread = threading.current_thread()
+        with _LocalDNSServer(self.DNS_BEHAVIORS) as server:
+            enricher = self._make_enricher(4, server.server_address[1])
+            calls = []
+            def wrap(method):
+                def wrapper(fqdn):
+                    calls.append((method.__name__, fqdn,
+                                  threading.current_thread() is main_thread))
+                    return method(fqdn)
+                return wrapper
+            enricher.fqdn_to_ip = wrap(enricher.fqdn_to_ip)
+            enricher._resolve_fqdn_to_ip = wrap(enricher._resolve_fqdn_to_ip)
+            self._process_all(enricher, bodies)
+        published, acks = self._get_results(enricher)
+        self.assertEqual(acks, [('basic_ack', 1), ('basic_ack', 2)])
+        self.assertEqual([(body.get('fqdn'), body.get('address')) for _, body in published], [
+            ('fast1.example.com', [{'ip': '10.0.0.2'}, {'ip': '10.0.0.3'}]),
+            ('xn--w-uga1v8h.example.com', [{'ip': '10.0.0.5'}]),
+        ])
+        # (the lookups are made only by the pool workers, which do not
+        # use `fqdn_to_ip()`; the prefetched results are used for the
+        # adjusted FQDNs, so no lookups are made by the main thread)
+        self.assertEqual(sorted(calls), [
+            ('_resolve_fqdn_to_ip', u'fast1.example.com', False),
+            ('_resolve_fqdn_to_ip', u'xn--w-uga1v8h.example.com', False),
+            ('fqdn_to_ip', u'fast1.example.com', True),
+            ('fqdn_to_ip', u'xn--w-uga1v8h.example.com', True),
+        ])
+
+    def test_no_lookup_for_invalid_fqdn_from_url(self):
+        enricher = Enricher.__new__(Enricher)
+        data = RecordDict(TestEnricher.COMMON_DATA)
+        data['url'] = 'http://foo..bar/'
+        with mock.patch('n6lib.record_dict.LOGGER'):
+            self.assertIsNone(enricher._get_fqdn_to_resolve(data))
+
+    def test_nothing_processed_after_closing(self):
+        with _LocalDNSServer(self.DNS_BEHAVIORS) as server:
+            enricher = self._make_enricher(4, server.server_address[1])
+            enricher.on_message(mock.sentinel.channel,
+                                mock.Mock(delivery_tag=1, routing_key='event.parsed.test.test'),
+                                None, self._message_bodies()[0])
+            enricher._closing = True
+            self._process_all(enricher, [])
+        self.assertEqual(enricher.publish_output.mock_calls, [])
+        self.assertEqual(enricher._channel_in.mock_calls, [])
+
+
+class TestEnricher__json_fast_path(unittest.TestCase):
+
+    BASE_DATA = {
+        'id': '0123456789abcdef0123456789abcdef',
+        'rid': 'fedcba9876543210fedcba9876543210',
+        'source': 'test.test',
+        'restriction': 'public',
+        'confidence': 'low',
+        'category': 'other',
+        'time': '2020-01-02 03:04:05',
+    }
+
+    CORPUS = [
+        {},
+        {'fqdn': 'example.com'},
+        {'fqdn': 'example.com', '_do_not_resolve_fqdn_to_ip': True},
+        {'fqdn': 'excluded.example.com'},
+        {'fqdn': 'unresolved.example.com'},
+        {'url': 'http://Www.Example.COM:8080/path?q=1'},
+        {'url': 'http://10.20.30.40/path'},
+        {'url': 'http://http://example.com/'},
+        {'url': 'http://example.com/', 'fqdn': 'other.example.org'},
+        {'address': [{'ip': '1.1.1.1', 'asn': 42, 'cc': 'DE'}, {'ip': '2.2.2.2'}]},
+        {'address': [{'ip': '10.0.0.1'}, {'ip': '3.3.3.3'}]},
+        {'address': [{'ip': '10.0.0.1'}]},
+        {'address': [{'ip': '1.1.1.1'}], 'enriched': [[], {'1.1.1.1': ['asn']}]},
+        {'name': u'Zażółć gęślą jaźń',
+         'client': ['org1', 'org2'], 'count': 3, 'dport': 80, 'proto': 'tcp', 'md5': 'b' * 32,
+         'until': '2020-01-03 00:00:00', 'modified': '2020-01-04 00:00:00.123456'},
+        {'expires': '2020-02-01 00:00:00', '_bl-series-id': 'a' * 32,
+         '_bl-series-no': 1, '_bl-series-total': 10, '_bl-time': '2020-01-01 00:00:00',
+         'url': 'https://bl.example.com/'},
+        {'additional_data': 'foo', 'x509fp_sha1': 'c' * 40, 'tags': ['a', 'b'],
+         'fqdn': 'example.com'},
+    ]
+
+    # (for the randomized part of the corpus)
+    VALUE_CHOICES = {
+        'fqdn': ['example.com', 'excluded.example.com', 'unresolved.example.com'],
+        'url': ['http://example.com/', 'http://Foo.Example.com/x', 'http://1.1.1.1:81/',
+                'ftp://10.0.0.5/', 'http://http://x/'],
+        'address': [[{'ip': '1.1.1.1'}], [{'ip': '2.2.2.2', 'cc': 'PL'}, {'ip': '10.0.0.2'}],
+                    [{'ip': '10.0.0.3', 'asn': 1}]],
+        '_do_not_resolve_fqdn_to_ip': [True, False],
+        'name': ['foo', u'b\xe4r'],
+        'count': [1, 1000],
+        'username': ['user', u'ł'],
+        'email': ['foo@example.com'],
+        'sport': [1, 65535],
+        'target': ['bar'],
+    }
+
+    def setUp(self):
+        self.enrichers = [self._make_enricher(json_fast_path) for json_fast_path in ('no', 'yes')]
+
+    def _make_enricher(self, json_fast_path):
+        class Config(MockConfig):
+            config = dict(MockConfig.config, enrich=dict(MockConfig.config['enrich'],
+                                                         excluded_ips='10.0.0.0/8',
+                                                         json_fast_path=json_fast_path))
+        with mock.patch('n6.base.queue.QueuedBase.get_connection_params_dict'), \
+             mock.patch('n6.utils.enrich.Config', Config), \
+             mock.patch.object(Enricher, '_setup_dnsresolver'), \
+             mock.patch.object(Enricher, '_setup_geodb'):
+            enricher = Enricher()
+        enricher.fqdn_to_ip = mock.Mock(side_effect=lambda fqdn: {
+            'example.com': ['1.1.1.1', '2.2.2.2'],
+            'www.example.com': ['2.2.2.2'],
+            'excluded.example.com': ['10.0.0.1', '3.3.3.3'],
+        }.get(fqdn, []))
+        enricher.gi_asn = mock.Mock()
+        enricher.gi_asn.asn.side_effect = lambda ip: mock.Mock(
+            autonomous_system_number=(int(ip.split('.')[0]) if ip != '3.3.3.3' else None))
+        enricher.gi_cc = mock.Mock()
+        enricher.gi_cc.city.side_effect = lambda ip: mock.Mock(
+            country=mock.Mock(iso_code=('PL' if ip.startswith('1.') else None)))
+        enricher.publish_output = mock.Mock()
+        return enricher
+
+    def _get_output(self, enricher, body):
+        enricher.publish_output.reset_mock()
+        enricher.input_callback('event.parsed.test.test', body, None)
+        (_, kwargs), = enricher.publish_output.call_args_list
+        return kwargs['routing_key'], kwargs['body']
+
+    def _iter_corpus(self):
+        for items in self.CORPUS:
+            yield items
+        rnd = random.Random(42)
+        for _ in xrange(300):
+            keys = rnd.sample(sorted(self.VALUE_CHOICES), rnd.randint(1, 5))
+            yield {key: rnd.choice(self.VALUE_CHOICES[key]) for key in keys}
+
+    def test_output_same_as_without_fast_path(self):
+        regular_enricher, fast_enricher = self.enrichers
+        for items in self._iter_corpus():
+            body = RecordDict(dict(self.BASE_DATA, **items)).get_ready_json()
+            with mock.patch('n6.utils.enrich.RecordDict.from_json') as from_json_mock:
+                fast_output = self._get_output(fast_enricher, body)
+            self.assertEqual(from_json_mock.mock_calls, [])
+            self.assertEqual(fast_output, self._get_output(regular_enricher, body), items)
+
+    def _get_output_or_exc_class(self, enricher, body):
+        try:
+            return self._get_output(enricher, body)
+        except Exception as exc:
+            return exc.__class__
+
+    def test_regular_path_used_if_fast_path_not_applicable(self):
+        regular_enricher, fast_enricher = self.enrichers
+        base_data_without_id = {k: v for k, v in self.BASE_DATA.iteritems() if k != 'id'}
+        for data, expected_exc_class in [
+                (dict(self.BASE_DATA, name={'a': 1}), None),  # (invalid `name` just omitted)
+                (dict(self.BASE_DATA, tags=[['a']]), AdjusterError),
+                (dict(self.BASE_DATA, illegal_key='foo'), RuntimeError),
+                (base_data_without_id, ValueError)]:
+            body = json.dumps(data)
+            self.assertIsNone(PrevalidatedRecord.from_json(body))
+            result = self._get_output_or_exc_class(fast_enricher, body)
+            self.assertEqual(result, self._get_output_or_exc_class(regular_enricher, body))
+            if expected_exc_class is not None:
+                self.assertIs(result, expected_exc_class)
+
+
+class TestIPRangeIndex(unittest.TestCase):
+
+    def _random_ipv4_range(self, rnd):
+        # (also in the abbreviated notations, e.g., '127/8' or '10.1/16')
+        ip = '.'.join(str(rnd.randrange(256)) for _ in xrange(rnd.choice([1, 2, 3, 4, 4, 4])))
+        prefix_length = rnd.choice([None, 8, 16, 24, 28, 30, 31, 32, '255.255.0.0'])
+        return (ip if prefix_length is None else '{}/{}'.format(ip, prefix_length))
+
+    def test_ipv4_lookups_equivalent_to_IpRangeList(self):
+        rnd = random.Random(42)
+        for _ in xrange(20):
+            ranges = [self._random_ipv4_range(rnd) for _ in xrange(rnd.randrange(1, 50))]
+            index = IPRangeIndex(*ranges)
+            range_list = iptools.IpRangeList(*ranges)
+            ips = ['{}.{}.{}.{}'.format(*(rnd.randrange(256) for _ in xrange(4)))
+                   for _ in xrange(200)]
+            # (including the bounds of the ranges and their neighbours)
+            for ip_range in range_list.ips:
+                for ip_int in [ip_range.startIp - 1, ip_range.startIp,
+                               ip_range.endIp, ip_range.endIp + 1]:
+                    if 0 <= ip_int < 2 ** 32:
+                        ips.append(iptools.ipv4.long2ip(ip_int))
+            for ip in ips:
+                self.assertEqual(ip in index, ip in range_list, (ip, ranges))
+
+    def test_abbreviated_ipv4_notations(self):
+        index = IPRangeIndex('127/8', '10.1/16', ' 172.16/255.240.0.0', '192.168.1')
+        self.assertEqual(list(index.intervals[4]), [
+            (iptools.ipv4.ip2long('10.1.0.0'), iptools.ipv4.ip2long('10.1.255.255')),
+            (iptools.ipv4.ip2long('127.0.0.0'), iptools.ipv4.ip2long('127.255.255.255')),
+            (iptools.ipv4.ip2long('172.16.0.0'), iptools.ipv4.ip2long('172.31.255.255')),
+            (iptools.ipv4.ip2long('192.168.0.1'), iptools.ipv4.ip2long('192.168.0.1')),
+        ])
+
+    def test_ipv6(self):
+        index = IPRangeIndex('2001:db8::/32', '2001:db8:ffff::/48', 'fe80::1', '::/127')
+        self.assertEqual(index.intervals[6], [
+            (0, 1),
+            (0x20010db8 << 96, (0x20010db9 << 96) - 1),
+            (0xfe80 << 112 | 1, 0xfe80 << 112 | 1),
+        ])
+        for ip, expected in [('2001:db8::', True),
+                             ('2001:db8:ffff:ffff:ffff:ffff:ffff:ffff', True),
+                             ('2001:db9::', False),
+                             ('2001:db7:ffff:ffff:ffff:ffff:ffff:ffff', False),
+                             ('fe80::1', True),
+                             ('fe80::2', False),
+                             ('::1', True),
+                             ('::2', False),
+                             ('0.0.0.1', False)]:
+            self.assertEqual(ip in index, expected, ip)
+
+    def test_invalid_ranges(self):
+        for ip_range in ['', 'foo', '1.2.3.4.5', '1.2.3.4/', '1.2.3.4/-1', '1.2.3.4/33',
+                         '::1/129', '1.2.3.4/8/8', '1.2.3.256']:
+            with self.assertRaises(ValueError):
+                IPRangeIndex(ip_range)
+
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+import os.path as osp
+import random
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+
+import maxminddb.const
+import mock
+from geoip2 import database
+
+from n6.tests.utils._geoip_test_helpers import (
+    make_random_asn_record,
+    make_random_city_record,
+    make_random_networks,
+    write_mmdb,
+)
+from n6.tests.utils.test_enrich import MockConfig
+from n6.utils.enrich import Enricher, GeoIPCache
+from n6.utils.geoip_range_table import (
+    GeoIPRangeTable,
+    compile_range_table,
+)
+
+
+def _int_to_ip(ip_int):
+    return socket.inet_ntoa(struct.pack('!I', ip_int))
+
+
+class TestGeoIPRangeTable(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.rnd = random.Random(42)
+        self.asn_db_path, self.city_db_path = self._write_databases(800)
+        self.table_path = osp.join(self.tmp_dir, 'ranges.bin')
+
+    def _write_databases(self, network_count, suffix=''):
+        rnd = self.rnd
+        asn_networks = make_random_networks(network_count, rnd)
+        city_networks = make_random_networks(network_count, rnd)
+        asn_records = [make_random_asn_record(rnd) for _ in xrange(20)]
+        city_records = [make_random_city_record(rnd) for _ in xrange(20)]
+        asn_db_path = osp.join(self.tmp_dir, 'asn{}.mmdb'.format(suffix))
+        city_db_path = osp.join(self.tmp_dir, 'city{}.mmdb'.format(suffix))
+        write_mmdb(asn_db_path, 'GeoLite2-ASN',
+                   [(net, rnd.choice(asn_records)) for net in asn_networks])
+        write_mmdb(city_db_path, 'GeoLite2-City',
+                   [(net, rnd.choice(city_records)) for net in city_networks])
+        self.networks = asn_networks + city_networks
+        return asn_db_path, city_db_path
+
+    def _make_enricher(self, geoip_range_table=None, asn_db_path=None, city_db_path=None):
+        enricher = Enricher.__new__(Enricher)
+        if geoip_range_table is not None:
+            enricher.geoip_range_table = geoip_range_table
+        else:
+            enricher.gi_asn = database.Reader(asn_db_path, mode=maxminddb.const.MODE_MEMORY)
+            enricher.gi_cc = database.Reader(city_db_path, mode=maxminddb.const.MODE_MEMORY)
+        enricher._geoip_cache = GeoIPCache(enricher._lookup_asn_and_cc, max_size=0)
+        return enricher
+
+    def _ips_to_check(self):
+        ip_ints = {0, 2 ** 32 - 1}
+        for first, prefix_length in self.networks:
+            last = first | 0xffffffff >> prefix_length
+            ip_ints.update([first, last, max(first - 1, 0), min(last + 1, 2 ** 32 - 1)])
+        ip_ints.update(self.rnd.getrandbits(32) for _ in xrange(3000))
+        return sorted(_int_to_ip(ip_int) for ip_int in ip_ints)
+
+    def _assert_lookups_same_as_geoip2(self, table, asn_db_path, city_db_path):
+        geoip2_enricher = self._make_enricher(asn_db_path=asn_db_path,
+                                              city_db_path=city_db_path)
+        table_enricher = self._make_enricher(geoip_range_table=table)
+        results = []
+        for ip in self._ips_to_check():
+            expected = (geoip2_enricher.ip_to_asn(ip), geoip2_enricher.ip_to_cc(ip))
+            self.assertEqual((table_enricher.ip_to_asn(ip), table_enricher.ip_to_cc(ip)),
+                             expected, ip)
+            results.append(expected)
+        # (the test data are sensible: there are all kinds of results)
+        self.assertTrue(any(asn is None and cc is None for asn, cc in results))
+        self.assertTrue(any(asn is None and cc is not None for asn, cc in results))
+        self.assertTrue(any(asn is not None and cc is None for asn, cc in results))
+        self.assertTrue(any(asn is not None and cc is not None for asn, cc in results))
+
+    @mock.patch('n6.utils.enrich.LOGGER')
+    def test_lookups_same_as_geoip2(self, _):
+        range_count = compile_range_table(self.asn_db_path, self.city_db_path, self.table_path)
+        table = GeoIPRangeTable(self.table_path)
+        self.addCleanup(table.close)
+        self.assertEqual(len(table), range_count)
+        self._assert_lookups_same_as_geoip2(table, self.asn_db_path, self.city_db_path)
+
+    @mock.patch('n6.utils.enrich.LOGGER')
+    def test_recompiled_table_replaces_old_one(self, _):
+        compile_range_table(self.asn_db_path, self.city_db_path, self.table_path)
+        old_table = GeoIPRangeTable(self.table_path)
+        self.addCleanup(old_table.close)
+        old_networks = self.networks
+        new_asn_db_path, new_city_db_path = self._write_databases(300, suffix='-new')
+        compile_range_table(new_asn_db_path, new_city_db_path, self.table_path)
+        new_table = GeoIPRangeTable(self.table_path)
+        self.addCleanup(new_table.close)
+        self._assert_lookups_same_as_geoip2(new_table, new_asn_db_path, new_city_db_path)
+        # (the old table, still mapped, is not affected)
+        self.networks = old_networks
+        self._assert_lookups_same_as_geoip2(old_table, self.asn_db_path, self.city_db_path)
+
+    def test_invalid_file(self):
+        path = osp.join(self.tmp_dir, 'invalid.bin')
+        for content in ['', 'N6GEOIP1', 'N6GEOIP1\x01\0\0\0' + '\0' * 13, 'foo' * 100]:
+            with open(path, 'wb') as f:
+                f.write(content)
+            with self.assertRaises(ValueError):
+                GeoIPRangeTable(path)
+
+    def test_enricher_with_range_table(self):
+        compile_range_table(self.asn_db_path, self.city_db_path, self.table_path)
+        class Config(MockConfig):
+            config = dict(MockConfig.config, enrich=dict(MockConfig.config['enrich'],
+                                                         geoippath=self.tmp_dir,
+                                                         rangetablefilename='ranges.bin'))
+        with mock.patch('n6.base.queue.QueuedBase.get_connection_params_dict'), \
+             mock.patch('n6.utils.enrich.Config', Config), \
+             mock.patch.object(Enricher, '_setup_dnsresolver'):
+            enricher = Enricher()
+        self.addCleanup(enricher.geoip_range_table.close)
+        self.assertIsNone(enricher.gi_asn)
+        self.assertIsNone(enricher.gi_cc)
+        ip = _int_to_ip(self.networks[0][0])
+        self.assertEqual((enricher.ip_to_asn(ip), enricher.ip_to_cc(ip)),
+                         enricher.geoip_range_table.lookup(ip))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+import json
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+
+from n6.parsers.greensnow import GreenSnowParser
+from n6.utils.parser_replay import (
+    ParserReplay,
+    ReplayStats,
+    get_parser_class,
+    iter_input_paths,
+    run,
+)
+
+
+TIMESTAMP = 1389348840  # '2014-01-10 10:14:00'
+
+
+class TestGetParserClass(unittest.TestCase):
+
+    def test_by_class_name(self):
+        self.assertIs(get_parser_class('GreenSnowParser'), GreenSnowParser)
+
+    def test_by_script_name(self):
+        self.assertIs(get_parser_class('greensnow'), GreenSnowParser)
+
+    def test_abstract_or_unknown(self):
+        for name in ('BaseParser', 'BlackListTabDataParser', 'NoSuchParser'):
+            with self.assertRaises(ValueError):
+                get_parser_class(name)
+
+
+class TestParserReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def _write(self, filename, content):
+        path = osp.join(self.tmp_dir, filename)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_replay(self):
+        replay = ParserReplay(GreenSnowParser, timestamp=TIMESTAMP)
+        stats = ReplayStats()
+        outputs = []
+        result = replay.replay(
+            '1.1.1.1\n2.2.2.2\n', stats,
+            output_callback=lambda **kw: outputs.append(kw))
+        self.assertTrue(result)
+        self.assertEqual([kw['routing_key'] for kw in outputs],
+                         ['bl.parsed.greensnow-co.list-txt'] * 2)
+        events = [json.loads(kw['body']) for kw in outputs]
+        self.assertEqual([e['address'] for e in events],
+                         [[{'ip': '1.1.1.1'}], [{'ip': '2.2.2.2'}]])
+        self.assertEqual([e['time'] for e in events],
+                         ['2014-01-10 10:14:00'] * 2)
+        self.assertEqual(stats.input_count, 1)
+        self.assertEqual(stats.row_count, 2)
+        self.assertEqual(stats.failed_count, 0)
+
+    def test_replay_failure(self):
+        replay = ParserReplay(GreenSnowParser, timestamp=TIMESTAMP)
+        stats = ReplayStats()
+        outputs = []
+        result = replay.replay(
+            '\n', stats,  # no data -> ValueError raised by the parser
+            output_callback=lambda **kw: outputs.append(kw))
+        self.assertFalse(result)
+        self.assertEqual(outputs, [])
+        self.assertEqual(stats.input_count, 1)
+        self.assertEqual(stats.row_count, 0)
+        self.assertEqual(stats.failed_count, 1)
+
+    def test_iter_input_paths(self):
+        path_b = self._write('b', '')
+        path_a = self._write('a', '')
+        self._write('.hidden', '')
+        other_path = osp.join(self.tmp_dir, 'not-necessarily-existent')
+        self.assertEqual(list(iter_input_paths([self.tmp_dir, other_path])),
+                         [path_a, path_b, other_path])
+
+    def test_run(self):
+        self._write('1', '1.1.1.1\n2.2.2.2\n')
+        self._write('2', '3.3.3.3\n')
+        output_path = osp.join(self.tmp_dir, 'output')
+        stats = run(GreenSnowParser, [self.tmp_dir],
+                    output=output_path,
+                    timestamp=TIMESTAMP,
+                    repeat=3)
+        with open(output_path) as f:
+            output_lines = f.read().splitlines()
+        # (the output is written only during the first pass)
+        self.assertEqual([json.loads(line)['address'][0]['ip'] for line in output_lines],
+                         ['1.1.1.1', '2.2.2.2', '3.3.3.3'])
+        self.assertEqual(stats.input_count, 6)
+        self.assertEqual(stats.row_count, 9)
+        report = stats.as_dict()
+        self.assertEqual(report['rows'], 9)
+        self.assertLessEqual(report['row_time_ms_median'], report['row_time_ms_max'])
+        self.assertIsNotNone(report['max_rss_kb_after'])
+        self.assertIn('output rows:        9', stats.format_report())
+
+    def test_run_is_reproducible(self):
+        self._write('1', '1.1.1.1\n2.2.2.2\n')
+        output_contents = []
+        for filename in ('output1', 'output2'):
+            output_path = osp.join(self.tmp_dir, filename)
+            run(GreenSnowParser, [osp.join(self.tmp_dir, '1')],
+                output=output_path,
+                timestamp=TIMESTAMP)
+            with open(output_path) as f:
+                output_contents.append(f.read())
+        self.assertEqual(output_contents[0], output_contents[1])
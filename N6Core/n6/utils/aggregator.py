@@ -1,18 +1,26 @@
-# Copyright (c) 2013-2019 NASK. All rights reserved.
+# Copyright (c) 2013-2020 NASK. All rights reserved.
 
+import argparse
+import bisect
 import collections
 import cPickle
 import datetime
+import functools
+import hashlib
 import json
 import os
 import os.path
+import struct
 
 from n6.base.queue import (
     QueuedBase,
     n6QueueProcessingException,
 )
 from n6lib.config import Config
-from n6lib.datetime_helpers import parse_iso_datetime_to_utc
+from n6lib.datetime_helpers import (
+    datetime_to_utc_timestamp,
+    parse_iso_datetime_to_utc,
+)
 from n6lib.log_helpers import get_logger, logging_configured
 from n6lib.record_dict import RecordDict
 
@@ -22,6 +30,7 @@ LOGGER = get_logger(__name__)
 
 # in hours, time to wait for the next event before suppressed event is generated
 AGGREGATE_WAIT = 12
+AGGREGATE_WAIT_SECS = AGGREGATE_WAIT * 3600
 
 # in hours, when the source is considered inactive (cleanup should be triggered)
 SOURCE_INACTIVITY_TIMEOUT = 24
@@ -32,16 +41,178 @@ TICK_TIMEOUT = 3600
 # in seconds
 DEFAULT_TIME_TOLERANCE = 600
 
+# number of journal records after which a new snapshot of the state is made
+DEFAULT_SNAPSHOT_INTERVAL = 100000
+
+# journal record kinds
+JOURNAL_MESSAGE = 'message'
+JOURNAL_INACTIVE = 'inactive'
+
+_JOURNAL_RECORD_LENGTH = struct.Struct('!I')
+
+_SECONDS_PER_DAY = 24 * 3600
+
+# the exchange through which AggregatorRouter passes messages to
+# the partitions' input queues (in the source-partitioned mode)
+PARTITIONS_EXCHANGE = 'aggregator_partitions'
+
+# number of points on the hash ring per partition (see: SourcePartitioner)
+PARTITION_HASH_RING_POINTS = 128
+
+# the suffix of the (temporary) files the new partitions' states are
+# saved to by rebalance_partitioned_state() -- before being renamed
+REBALANCED_STATE_SUFFIX = '.rebalanced'
+
+
+def _day_of(timestamp):
+    # (the number of the UTC day since the epoch)
+    return timestamp // _SECONDS_PER_DAY
+
+
+def _parse_timestamp(iso_datetime_str):
+    return datetime_to_utc_timestamp(parse_iso_datetime_to_utc(iso_datetime_str))
+
+
+# (bound at import time -- to be independent of `datetime` being
+# mocked in some tests...)
+_utcfromtimestamp = datetime.datetime.utcfromtimestamp
+
+
+def _timestamp_to_datetime(timestamp):
+    return (_utcfromtimestamp(timestamp) if timestamp is not None else None)
+
+
+def _datetime_to_timestamp(dt):
+    return (datetime_to_utc_timestamp(dt) if dt is not None else None)
+
+
+def _timestamp_property(ts_attr_name):
+    # a property that provides (for convenience and compatibility)
+    # the value of the `ts_attr_name` attribute (a UTC timestamp,
+    # as a float, or None) as a `datetime.datetime` instance (or None)
+    def getter(self):
+        return _timestamp_to_datetime(getattr(self, ts_attr_name))
+    def setter(self, dt):
+        setattr(self, ts_attr_name, _datetime_to_timestamp(dt))
+    return property(getter, setter)
+
+
+class _SharedObjects(object):
+
+    """
+    A (size-limited) registry of hashable objects, making it possible
+    to replace equal objects with one shared instance.
+
+    >>> shared = _SharedObjects(max_size=2)
+    >>> a = shared.get(u'bots')
+    >>> b = shared.get(u''.join([u'bo', u'ts']))
+    >>> a is b
+    True
+    >>> c = shared.get(u'spam')
+    >>> d = shared.get(u'ham')         # (no more room -- not registered)
+    >>> d is shared.get(u''.join([u'h', u'am']))
+    False
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._objects = {}
+
+    def get(self, obj):
+        shared_obj = self._objects.get(obj)
+        if shared_obj is None:
+            if len(self._objects) >= self._max_size:
+                return obj
+            self._objects[obj] = shared_obj = obj
+        return shared_obj
+
+
+# tuples of payload keys (typically, there are only a few distinct
+# ones per source) -- to be shared by `HiFreqEventData` instances
+_shared_payload_keys = _SharedObjects(max_size=10000)
+
+# values of those payload items whose values typically repeat for
+# many groups -- to be shared by `HiFreqEventData` instances
+_SHARED_PAYLOAD_VALUE_KEYS = frozenset([
+    'category', 'confidence', 'name', 'origin', 'proto', 'restriction',
+    'source', 'status', 'target', 'type',
+])
+_shared_payload_values = _SharedObjects(max_size=100000)
+
 
 class HiFreqEventData(object):
 
-    def __init__(self, payload):
-        self.group = payload.get("_group")
-        self.until = parse_iso_datetime_to_utc(payload.get('time'))
-        self.first = parse_iso_datetime_to_utc(payload.get('time'))
+    # Note: to keep the memory footprint small (the aggregator may
+    # keep hundreds of thousands of groups for many hours):
+    #
+    # * instances have no `__dict__` (see: `__slots__`);
+    #
+    # * the payload is not kept as a dict but as a tuple of keys
+    #   (shared with other instances whose payloads have the same
+    #   layout) + a tuple of values (some of them, typically repeated
+    #   ones, are also shared; ASCII-only `unicode` ones are stored as
+    #   `str`); the `payload` property provides it as a (new) dict;
+    #
+    # * event times are kept as numeric UTC timestamps (see the `*_ts`
+    #   attributes), which also makes comparisons (and other operations
+    #   performed for each processed event) cheap; the `until` and
+    #   `first` properties provide them as `datetime.datetime` objects.
+
+    __slots__ = ('until_ts', 'first_ts', 'count', '_payload_keys', '_payload_values')
+
+    def __init__(self, payload, event_ts=None):
+        if event_ts is None:
+            event_ts = _parse_timestamp(payload.get('time'))
+        self.until_ts = event_ts
+        self.first_ts = event_ts
         self.count = 1  # XXX: see ticket #6243
         self.payload = payload
 
+    until = _timestamp_property('until_ts')
+    first = _timestamp_property('first_ts')
+
+    @property
+    def group(self):
+        return self.payload.get("_group")
+
+    @property
+    def payload(self):
+        return dict(zip(self._payload_keys, self._payload_values))
+
+    @payload.setter
+    def payload(self, payload):
+        values = []
+        for key, value in payload.iteritems():
+            if isinstance(value, unicode):
+                try:
+                    # (a `str` takes 1 byte per character, a `unicode` -- up to 4)
+                    value = value.encode('ascii')
+                except UnicodeError:
+                    pass
+            if key in _SHARED_PAYLOAD_VALUE_KEYS and isinstance(value, basestring):
+                value = _shared_payload_values.get(value)
+            values.append(value)
+        self._payload_keys = _shared_payload_keys.get(tuple(payload))
+        self._payload_values = tuple(values)
+
+    def __getstate__(self):
+        return {
+            'until_ts': self.until_ts,
+            'first_ts': self.first_ts,
+            'count': self.count,
+            'payload': self.payload,
+        }
+
+    def __setstate__(self, state):
+        if 'until' in state:
+            # (migrating an instance pickled by an older version)
+            state['until_ts'] = _datetime_to_timestamp(state.pop('until'))
+            state['first_ts'] = _datetime_to_timestamp(state.pop('first'))
+        self.until_ts = state['until_ts']
+        self.first_ts = state['first_ts']
+        self.count = state['count']
+        self.payload = state['payload']
+
     def to_dict(self):
         result = self.payload
         result['count'] = self.count
@@ -50,45 +221,68 @@ class HiFreqEventData(object):
         return result
 
     def update_payload(self, update_dict):
-        tmp = self.payload.copy()
+        tmp = self.payload
         tmp.update(update_dict)
         self.payload = tmp
 
 
 class SourceData(object):
 
+    # Info about the items generate_suppressed_events() would begin
+    # its scans with -- None or a tuple: (<key of the first group>,
+    # <`until_ts` of the first group>, <`until_ts` of the first buffered
+    # event>) (the latter two are None if there are no groups/buffered
+    # events). Both `groups` and `buffer` are ordered by the time of
+    # the last update, and each of the scans stops at the first item
+    # that is not due yet -- so, as long as these first items are not
+    # due, the scans can be skipped (None means: do not skip them).
+    # Note: it is defined as a class attribute, so that instances
+    # unpickled from older state files have it as well.
+    _suppression_heads = None
+
     def __init__(self, time_tolerance):
-        self.time = None # current time tracked for source (based on event time)
+        # current time tracked for source (based on event time), as a UTC timestamp
+        self.time_ts = None
         # utc time of the last event (used to trigger cleanup if source is inactive)
         self.last_event = None
         self.groups = collections.OrderedDict() # groups aggregated for a given source
         self.time_tolerance = datetime.timedelta(seconds=time_tolerance)
+        self.time_tolerance_secs = time_tolerance
         # buffer to store aggregated events until time_tolerance has passed
         self.buffer = collections.OrderedDict()
 
-    def update_time(self, event_time):
-        if event_time > self.time:
-            self.time = event_time
+    time = _timestamp_property('time_ts')
+
+    def __setstate__(self, state):
+        if 'time' in state:
+            # (migrating an instance pickled by an older version)
+            state['time_ts'] = _datetime_to_timestamp(state.pop('time'))
+            state['time_tolerance_secs'] = state['time_tolerance'].total_seconds()
+        self.__dict__.update(state)
+
+    def update_time(self, event_ts):
+        if event_ts > self.time_ts:
+            self.time_ts = event_ts
         self.last_event = datetime.datetime.utcnow()
 
     def process_event(self, data):
-        event_time = parse_iso_datetime_to_utc(data['time'])
+        event_ts = _parse_timestamp(data['time'])
         event = self.groups.get(data['_group'])
-        if self.time is None:
-            self.time = event_time
-        if event_time + self.time_tolerance < self.time:
-            if event is None or event.first > event_time:
+        if self.time_ts is None:
+            self.time_ts = event_ts
+        if event_ts + self.time_tolerance_secs < self.time_ts:
+            if event is None or event.first_ts > event_ts:
                 LOGGER.error('Event out of order. Ignoring. Data: %s', data)
                 raise n6QueueProcessingException('Event out of order.')
             else:
                 LOGGER.info('Event out of order, but not older than group\'s first event, '
                             'so it will be added to existing aggregate group. Data: %s', data)
-                event.until = max(event.until, event_time)
+                event.until_ts = max(event.until_ts, event_ts)
                 event.count += 1  # XXX: see ticket #6243
                 return False
 
         if event is None:
-            if event_time < self.time:
+            if event_ts < self.time_ts:
                 # unordered event, self.buffer may contain suppressed event
                 LOGGER.debug("Unordered event of the '%s' group, '%s' source within time "
                              "tolerance. Check and update buffer.", data['_group'], data['source'])
@@ -100,41 +294,48 @@ class SourceData(object):
             # Event not seen before - add new event to group
             LOGGER.debug("A new group '%s' for '%s' source began to be aggregated, "
                          "first event is being generated.", data['_group'], data['source'])
-            self.groups[data['_group']] = HiFreqEventData(data)  # XXX: see ticket #6243
-            self.update_time(parse_iso_datetime_to_utc(data['time']))
+            self._forget_suppression_heads_if_first_group(None)
+            self.groups[data['_group']] = HiFreqEventData(data, event_ts)  # XXX: see ticket #6243
+            self.update_time(event_ts)
             return True
 
-        if (event_time > event.until + datetime.timedelta(hours=AGGREGATE_WAIT) or
-            event_time.date() > self.time.date()):
+        if (event_ts > event.until_ts + AGGREGATE_WAIT_SECS or
+            _day_of(event_ts) > _day_of(self.time_ts)):
             LOGGER.debug("A suppressed event is generated for the '%s' group of "
                          "'%s' source due to passing of %s hours between events.",
                          data['_group'], data['source'], AGGREGATE_WAIT)
             # 24 hour aggregation or AGGREGATE_WAIT time passed between events in group
+            self._suppression_heads = None
             del self.groups[data['_group']]
-            self.groups[data['_group']] = HiFreqEventData(data)  # XXX: see ticket #6243
+            self.groups[data['_group']] = HiFreqEventData(data, event_ts)  # XXX: see ticket #6243
             self.buffer[data['_group']] = event
-            self.update_time(parse_iso_datetime_to_utc(data['time']))
+            self.update_time(event_ts)
             return True
 
         # Event for existing group and still aggregating
         LOGGER.debug("Event is being aggregated in the '%s' group of the '%s' source.",
                      data['_group'], data['source'])
         event.count += 1  # XXX: see ticket #6243
-        if event_time > event.until:
-            event.until = event_time
+        if event_ts > event.until_ts:
+            event.until_ts = event_ts
+        self._forget_suppression_heads_if_first_group(data['_group'])
         del self.groups[data['_group']]
         self.groups[data['_group']] = event
-        self.update_time(parse_iso_datetime_to_utc(data['time']))
+        self.update_time(event_ts)
         return False
 
     def generate_suppressed_events(self):
-        cutoff_time = self.time - datetime.timedelta(hours=AGGREGATE_WAIT)
+        if not self._is_any_suppression_due():
+            return
+        self._suppression_heads = None
+        cutoff_ts = self.time_ts - AGGREGATE_WAIT_SECS
+        current_day = _day_of(self.time_ts)
         cutoff_check_complete = False
         for_cleanup = []
         for k, v in self.groups.iteritems():
-            if v.until >= cutoff_time:
+            if v.until_ts >= cutoff_ts:
                 cutoff_check_complete = True
-            if cutoff_check_complete and v.until.date() == self.time.date():
+            if cutoff_check_complete and _day_of(v.until_ts) == current_day:
                 break
             for_cleanup.append(k)
             self.buffer[k] = v
@@ -143,16 +344,50 @@ class SourceData(object):
             del self.groups[k]
 
         # generate suppressed events from buffer
-        cutoff_time = self.time - self.time_tolerance
+        cutoff_ts = self.time_ts - self.time_tolerance_secs
         for_cleanup = []
         for k, v in self.buffer.iteritems():
-            if v.until >= cutoff_time:
+            if v.until_ts >= cutoff_ts:
                 break
             for_cleanup.append(k)
             # XXX: see ticket #6243 (check whether here is OK or also will need to be changed)
             yield 'suppressed', v.to_dict() if v.count > 1 else None
         for k in for_cleanup:
             del self.buffer[k]
+        self._suppression_heads = self._get_suppression_heads()
+
+    def _is_any_suppression_due(self):
+        if self._suppression_heads is None:
+            return True
+        _, first_group_until_ts, first_buffered_until_ts = self._suppression_heads
+        if first_group_until_ts is not None:
+            if (first_group_until_ts < self.time_ts - AGGREGATE_WAIT_SECS or
+                  _day_of(first_group_until_ts) != _day_of(self.time_ts)):
+                return True
+        if first_buffered_until_ts is not None:
+            if first_buffered_until_ts < self.time_ts - self.time_tolerance_secs:
+                return True
+        return False
+
+    def _get_suppression_heads(self):
+        first_group_key = first_group_until_ts = first_buffered_until_ts = None
+        for first_group_key, first_group in self.groups.iteritems():
+            first_group_until_ts = first_group.until_ts
+            break
+        for first_buffered in self.buffer.itervalues():
+            first_buffered_until_ts = first_buffered.until_ts
+            break
+        return first_group_key, first_group_until_ts, first_buffered_until_ts
+
+    def _forget_suppression_heads_if_first_group(self, group_key):
+        # (to be called before the group is moved or -- if `group_key`
+        # is None -- before a new group is added; note that `until` of
+        # a group is never decreased, so the other changes to groups
+        # can only make the stored info outdated in a harmless way:
+        # causing an unnecessary scan, but never a skipped necessary one)
+        if (self._suppression_heads is not None and
+              self._suppression_heads[0] == group_key):
+            self._suppression_heads = None
 
     def generate_suppressed_events_after_inactive(self):
         for k, v in self.buffer.iteritems():
@@ -163,6 +398,7 @@ class SourceData(object):
             yield 'suppressed', v.to_dict() if v.count > 1 else None
         self.groups.clear()
         self.buffer.clear()
+        self._suppression_heads = None
         self.last_event = datetime.datetime.utcnow()
 
     def __repr__(self):
@@ -171,6 +407,12 @@ class SourceData(object):
 
 class AggregatorData(object):
 
+    # the sequence number of the last journal record whose effects
+    # are included in this state (see: `AggregatorDataWrapper`)
+    # Note: it is defined as a class attribute, so that instances
+    # unpickled from older state files have it as well.
+    last_journal_seq = 0
+
     def __init__(self):
         self.sources = {}
 
@@ -188,27 +430,183 @@ class AggregatorData(object):
 
 class AggregatorDataWrapper(object):
 
-    def __init__(self, dbpath, time_tolerance):
+    """
+    The aggregator's state (an `AggregatorData` instance) + its persistence.
+
+    The state is persisted as a *snapshot* (the pickled `AggregatorData`
+    instance, in the `dbpath` file) + a *journal* (the `<dbpath>.journal`
+    file) of the state-changing operations performed since the snapshot
+    was made: processed messages (see: `record_processed_message()`)
+    and suppressions of inactive sources (recorded automatically by
+    `generate_suppresed_events_after_timeout()`). Journal records are
+    appended (and flushed) one by one, so after a crash the state can
+    be restored up to the last recorded operation -- by loading the
+    snapshot and replaying the journal. The journal records refer to
+    the input data rather than to the resultant group changes, so the
+    journal format does not depend on the in-memory representation of
+    the state.
+
+    A new snapshot is made (and the journal is truncated) every
+    `snapshot_interval` journal records -- so there is no need to make
+    it on stop (see: `close()`). Each journal record has a sequence
+    number, and the snapshot contains the number of the last record it
+    includes -- so records are never replayed twice (even if a crash
+    occurs between saving a snapshot and truncating the journal).
+    """
+
+    # (defined as class attributes, so that instances created with
+    # __new__() -- as in some tests -- can be used without a journal)
+    _journal_file = None
+    _journal_record_count = 0
+    snapshot_interval = DEFAULT_SNAPSHOT_INTERVAL
+
+    def __init__(self, dbpath, time_tolerance, snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL,
+                 strict=False):
+        # (`strict`: if true, an error of loading the existing state
+        # file is propagated -- instead of falling back to an empty state)
         self.aggr_data = None
         self.dbpath = dbpath
+        self.journal_path = dbpath + '.journal'
         self.time_tolerance = time_tolerance
+        self.snapshot_interval = snapshot_interval
         try:
             self.restore_state()
         except:
-            LOGGER.error("Error restoring state from: %r", self.dbpath)
+            if os.path.exists(self.dbpath):
+                LOGGER.error("Error restoring state from: %r", self.dbpath)
+                if strict:
+                    raise
             self.aggr_data = AggregatorData()
+        self._open_journal()
 
     def store_state(self):
+        """Make a new snapshot of the state and truncate the journal.
+
+        Returns:
+            True if the snapshot has been saved successfully.
+        """
+        tmp_path = self.dbpath + '.tmp'
         try:
-            with open(self.dbpath, "w") as f:
-                cPickle.dump(self.aggr_data, f)
-        except IOError:
+            with open(tmp_path, "wb") as f:
+                pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+                # (no memo -- which otherwise would keep a reference
+                # to each pickled object, significantly increasing the
+                # memory usage; the state contains no shared/recursive
+                # references of mutable objects, so it is not needed)
+                pickler.fast = True
+                pickler.dump(self.aggr_data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.dbpath)
+        except (IOError, OSError):
             LOGGER.error("Error saving state to: %r", self.dbpath)
+            return False
+        if self._journal_file is not None:
+            self._journal_file.truncate(0)
+            self._journal_file.flush()
+            self._journal_record_count = 0
+        return True
 
     def restore_state(self):
-        with open(self.dbpath, "r") as f:
+        with open(self.dbpath, "rb") as f:
             self.aggr_data = cPickle.load(f)
 
+    def close(self):
+        """Flush the journal to the disk and close it."""
+        if self._journal_file is not None:
+            try:
+                self._journal_file.flush()
+                os.fsync(self._journal_file.fileno())
+            finally:
+                self._journal_file.close()
+                self._journal_file = None
+
+    def record_processed_message(self, data):
+        """Append the message to the journal (to be called when the
+        message has been processed and the resultant events have been
+        published -- so that, after a restart, the message is either
+        replayed from the journal or redelivered, never both)."""
+        source_data = self.aggr_data.sources.get(data['source'])
+        last_event = (source_data.last_event if source_data is not None else None)
+        self._append_journal_record(JOURNAL_MESSAGE, data, last_event)
+
+    #
+    # Journal-related helpers
+
+    def _open_journal(self):
+        self._journal_file = open(self.journal_path, 'a+b')
+        valid_length = self._replay_journal()
+        self._journal_file.seek(0, os.SEEK_END)
+        if self._journal_file.tell() > valid_length:
+            LOGGER.warning("Truncating an incomplete record at the end of the journal %r",
+                           self.journal_path)
+            self._journal_file.truncate(valid_length)
+            self._journal_file.flush()
+
+    def _replay_journal(self):
+        f = self._journal_file
+        f.seek(0)
+        replayed_count = 0
+        valid_length = 0
+        while True:
+            header = f.read(_JOURNAL_RECORD_LENGTH.size)
+            if len(header) < _JOURNAL_RECORD_LENGTH.size:
+                break
+            [length] = _JOURNAL_RECORD_LENGTH.unpack(header)
+            pickled = f.read(length)
+            if len(pickled) < length:
+                break
+            try:
+                seq, kind, args = cPickle.loads(pickled)
+            except Exception:
+                LOGGER.error("Corrupted record in the journal %r (at offset %d)",
+                             self.journal_path, valid_length)
+                break
+            valid_length = f.tell()
+            self._journal_record_count += 1
+            if seq > self.aggr_data.last_journal_seq:
+                self._apply_journal_record(kind, *args)
+                self.aggr_data.last_journal_seq = seq
+                replayed_count += 1
+        if replayed_count:
+            LOGGER.info("Replayed %d record(s) from the journal %r",
+                        replayed_count, self.journal_path)
+        return valid_length
+
+    def _apply_journal_record(self, kind, *args):
+        if kind == JOURNAL_MESSAGE:
+            data, last_event = args
+            source_data = self.aggr_data.get_or_create_sourcedata(data, self.time_tolerance)
+            try:
+                source_data.process_event(data)
+            except n6QueueProcessingException:
+                # (should not happen, as only successfully processed
+                # messages are recorded -- but it does not prevent the
+                # rest of the journal from being replayed)
+                LOGGER.warning("Could not replay a journaled message: %r", data)
+            else:
+                for _ in source_data.generate_suppressed_events():
+                    pass
+        else:
+            assert kind == JOURNAL_INACTIVE
+            source, last_event = args
+            source_data = self.aggr_data.sources[source]
+            for _ in source_data.generate_suppressed_events_after_inactive():
+                pass
+        source_data.last_event = last_event
+
+    def _append_journal_record(self, kind, *args):
+        if self._journal_file is None:
+            return
+        seq = self.aggr_data.last_journal_seq + 1
+        pickled = cPickle.dumps((seq, kind, args), cPickle.HIGHEST_PROTOCOL)
+        self._journal_file.write(_JOURNAL_RECORD_LENGTH.pack(len(pickled)) + pickled)
+        self._journal_file.flush()
+        self.aggr_data.last_journal_seq = seq
+        self._journal_record_count += 1
+        if self._journal_record_count >= self.snapshot_interval:
+            self.store_state()
+
     def process_new_message(self, data):
         """Processes a message and validates agains db to detect suppressed event.
         Adds new entry to db if necessary (new) or updates entry.
@@ -236,13 +634,152 @@ class AggregatorDataWrapper(object):
         """
         LOGGER.debug('Detecting inactive sources after tick timout')
         time_now = datetime.datetime.utcnow()
-        for source in self.aggr_data.sources.itervalues():
+        for source_name, source in self.aggr_data.sources.items():
             LOGGER.debug('Checking source: %r', source)
             if source.last_event + datetime.timedelta(hours=SOURCE_INACTIVITY_TIMEOUT) < time_now:
                 LOGGER.debug('Source inactive. Generating suppressed events')
                 for type_, event in source.generate_suppressed_events_after_inactive():
                     LOGGER.debug('%r: %r', type_, event)
                     yield type_, event
+                self._append_journal_record(JOURNAL_INACTIVE, source_name, source.last_event)
+
+
+class SourcePartitioner(object):
+
+    """
+    Assigns sources to partitions (in the source-partitioned mode of
+    the aggregator) -- deterministically, by consistent hashing.
+
+    Each of the `partition_count` partitions is represented by
+    `PARTITION_HASH_RING_POINTS` points on a hash ring, and a source
+    belongs to the partition which owns the first point following the
+    hash of the source's name. Therefore, when the number of partitions
+    changes from N to N + 1, only about 1 / (N + 1) of all sources are
+    moved (each to the new partition).
+
+    >>> partitioner = SourcePartitioner(3)
+    >>> partitioner.get_partition('some-source.some-channel')
+    0
+    >>> partitioner.get_partition('another-source.some-channel')
+    2
+    >>> SourcePartitioner(1).get_partition('another-source.some-channel')
+    0
+    """
+
+    def __init__(self, partition_count):
+        if partition_count < 1:
+            raise ValueError('partition count must be at least 1 (got: {!r})'
+                             .format(partition_count))
+        self.partition_count = partition_count
+        ring = sorted(
+            (self._hash('partition-{}-{}'.format(partition, point)), partition)
+            for partition in xrange(partition_count)
+            for point in xrange(PARTITION_HASH_RING_POINTS))
+        self._ring_hashes = [h for h, _ in ring]
+        self._ring_partitions = [partition for _, partition in ring]
+
+    def get_partition(self, source):
+        i = bisect.bisect(self._ring_hashes, self._hash(source))
+        return self._ring_partitions[i % len(self._ring_partitions)]
+
+    @staticmethod
+    def _hash(s):
+        return int(hashlib.md5(s).hexdigest()[:16], 16)
+
+
+def get_partition_queue_name(partition):
+    return 'aggregator_partition_{}'.format(partition)
+
+
+def get_partition_dbpath(dbpath, partition_count, partition):
+    """
+    Get the state file path for the given partition (for the classic
+    single-instance mode, i.e., if `partition_count` is 1, just
+    `dbpath`).
+    """
+    if partition_count == 1:
+        return dbpath
+    return '{}.partition-{}'.format(dbpath, partition)
+
+
+class RebalancingError(Exception):
+    """Raised by rebalance_partitioned_state() if it cannot be done."""
+
+
+def rebalance_partitioned_state(dbpath, time_tolerance, old_partition_count, new_partition_count):
+    """
+    Redistribute the aggregator state among partitions, after a change
+    of the number of partitions.
+
+    The states of the old partitions are loaded, their sources are
+    reassigned to the new partitions (see: `SourcePartitioner`), and
+    the states of the new partitions are saved (the files of the old
+    partitions that are no longer used are removed).
+
+    If any old partition's state cannot be loaded, or any new
+    partition's state cannot be saved, `RebalancingError` is raised
+    and no old file is replaced or removed: the new states are first
+    saved to temporary files, and only when all of them have been
+    saved are they renamed into place (and then the old files that
+    are no longer used are removed).
+
+    It must be run when no aggregator instance is running (see: the
+    *rebalancing procedure* described in the docs of `rebalance_main()`).
+
+    A partition count of 1 means the classic single-instance mode --
+    so this function can also be used to switch from/to that mode.
+    """
+    partitioner = SourcePartitioner(new_partition_count)
+    new_aggr_data_list = [AggregatorData() for _ in xrange(new_partition_count)]
+    old_paths = set()
+    for old_partition in xrange(old_partition_count):
+        old_path = get_partition_dbpath(dbpath, old_partition_count, old_partition)
+        old_paths.add(old_path)
+        try:
+            old_wrapper = AggregatorDataWrapper(old_path, time_tolerance, strict=True)
+        except Exception as exc:
+            raise RebalancingError('cannot load the state of partition #{} from {!r} '
+                                   '({}) -- nothing changed'.format(old_partition,
+                                                                    old_path, exc))
+        old_wrapper.close()
+        for source, source_data in old_wrapper.aggr_data.sources.iteritems():
+            new_partition = partitioner.get_partition(source)
+            new_aggr_data_list[new_partition].sources[source] = source_data
+            if (new_partition_count, new_partition) != (old_partition_count, old_partition):
+                LOGGER.info('Source %r: partition #%d -> partition #%d',
+                            source, old_partition, new_partition)
+    new_paths = [get_partition_dbpath(dbpath, new_partition_count, new_partition)
+                 for new_partition in xrange(new_partition_count)]
+    try:
+        for new_partition, (new_path, aggr_data) in enumerate(zip(new_paths,
+                                                                  new_aggr_data_list)):
+            new_wrapper = AggregatorDataWrapper.__new__(AggregatorDataWrapper)
+            new_wrapper.dbpath = new_path + REBALANCED_STATE_SUFFIX
+            new_wrapper.aggr_data = aggr_data
+            if not new_wrapper.store_state():
+                raise RebalancingError('cannot save the new state of partition #{} to {!r} '
+                                       '-- nothing changed'.format(new_partition,
+                                                                   new_wrapper.dbpath))
+    except:
+        for new_path in new_paths:
+            _remove_file_if_exists(new_path + REBALANCED_STATE_SUFFIX)
+            _remove_file_if_exists(new_path + REBALANCED_STATE_SUFFIX + '.tmp')
+        raise
+    # (all new states have been saved, so now they can replace the old ones)
+    for new_path in new_paths:
+        os.rename(new_path + REBALANCED_STATE_SUFFIX, new_path)
+        _remove_file_if_exists(new_path + '.journal')
+    for old_path in old_paths.difference(new_paths):
+        _remove_file_if_exists(old_path)
+        _remove_file_if_exists(old_path + '.journal')
+
+
+def _remove_file_if_exists(path):
+    try:
+        os.remove(path)
+    except OSError:
+        if os.path.exists(path):
+            raise
 
 
 class Aggregator(QueuedBase):
@@ -256,10 +793,52 @@ class Aggregator(QueuedBase):
                     "exchange_type": "topic"
                     }
 
+    # (set by preinit_hook(): the partition number -- if
+    # running in the source-partitioned mode -- or None)
+    partition = None
+
+    def get_arg_parser(self):
+        arg_parser = super(Aggregator, self).get_arg_parser()
+        arg_parser.add_argument(
+            '--n6partition',
+            metavar='NUMBER',
+            type=int,
+            help=('run as the aggregator instance for the specified partition '
+                  '(0, 1, ..., <partitions from the config> - 1) -- in the '
+                  'source-partitioned mode, with n6aggregatorrouter running'))
+        return arg_parser
+
+    def preinit_hook(self):
+        # some unit tests are over-zealous about patching super()
+        from __builtin__ import super
+
+        self.partition = self.cmdline_args.n6partition
+        if self.partition is not None:
+            assert 'input_queue' in vars(self)  # ensured by QueuedBase.__new__()
+            queue_name = get_partition_queue_name(self.partition)
+            self.input_queue = {
+                "exchange": PARTITIONS_EXCHANGE,
+                "exchange_type": "direct",
+                "queue_name": queue_name,
+                "binding_keys": [queue_name],
+            }
+        super(Aggregator, self).preinit_hook()
+
     def __init__(self, **kwargs):
         config = Config(required={"aggregator": ("dbpath", "time_tolerance")})
         self.aggregator_config = config["aggregator"]
-        self.aggregator_config["dbpath"] = os.path.expanduser(self.aggregator_config["dbpath"])
+        partition_count = int(self.aggregator_config.get("partitions", 1))
+        if self.partition is None and partition_count != 1:
+            raise ValueError('the source-partitioned mode is configured '
+                             '(partitions={}) so the --n6partition option '
+                             'is required'.format(partition_count))
+        if self.partition is not None and not 0 <= self.partition < partition_count:
+            raise ValueError('partition number {} is out of range (partitions={})'
+                             .format(self.partition, partition_count))
+        self.aggregator_config["dbpath"] = get_partition_dbpath(
+            os.path.expanduser(self.aggregator_config["dbpath"]),
+            partition_count,
+            self.partition)
         dbpath_dirname = os.path.dirname(self.aggregator_config["dbpath"])
         try:
             os.makedirs(dbpath_dirname, 0700)
@@ -275,7 +854,10 @@ class Aggregator(QueuedBase):
             raise Exception('stop aggregator, remember to set the rights'
                             ' for user, which runs aggregator,  path:',
                             self.aggregator_config["dbpath"])
-        self.db = AggregatorDataWrapper(self.aggregator_config["dbpath"], int(self.aggregator_config["time_tolerance"]))
+        self.db = AggregatorDataWrapper(
+            self.aggregator_config["dbpath"],
+            int(self.aggregator_config["time_tolerance"]),
+            int(self.aggregator_config.get("snapshot_interval", DEFAULT_SNAPSHOT_INTERVAL)))
         self.timeout_id = None # id of the 'tick' timeout that executes source cleanup
 
     def run(self):
@@ -306,6 +888,7 @@ class Aggregator(QueuedBase):
         for type_, event in self.db.generate_suppresed_events_for_source(data):
             if event is not None:
                 self.publish_event((type_, event))
+        self.db.record_processed_message(data)
 
     # XXX: can be removed after resolving ticket #6324
     def _clean_count_related_stuff(self, cleaned_payload):
@@ -347,10 +930,85 @@ class Aggregator(QueuedBase):
             self.process_event(data)
 
     def stop(self):
-        self.db.store_state()
+        self.db.close()
         super(Aggregator, self).stop()
 
 
+class AggregatorRouter(QueuedBase):
+
+    """
+    The router for the source-partitioned mode of the aggregator.
+
+    It takes over the input queue of the (classic) aggregator and
+    passes each message to the input queue of the partition its source
+    belongs to (see: `SourcePartitioner`), where it is consumed by the
+    aggregator instance run with the `--n6partition <partition number>`
+    option. The source is taken from the routing key, so the messages
+    do not need to be deserialized.
+
+    The input queues of all partitions are declared (and bound) by the
+    router itself, before it starts publishing -- so that no messages
+    are lost (as unroutable) if the aggregator instance for some
+    partition has never been run yet.
+    """
+
+    input_queue = Aggregator.input_queue
+    output_queue = {"exchange": PARTITIONS_EXCHANGE,
+                    "exchange_type": "direct"
+                    }
+
+    def __init__(self, **kwargs):
+        config = Config(required={"aggregator": ("partitions",)})
+        self.partitioner = SourcePartitioner(int(config["aggregator"]["partitions"]))
+        super(AggregatorRouter, self).__init__(**kwargs)
+
+    def on_output_exchange_declared(self, exchange, frame):
+        queue_names = [get_partition_queue_name(partition)
+                       for partition in xrange(self.partitioner.partition_count)]
+        queues_to_bind = set(queue_names)
+        for queue_name in queue_names:
+            LOGGER.debug('Declaring partition queue %r', queue_name)
+            # (note: the same arguments as in QueuedBase.setup_queue())
+            self._channel_out.queue_declare(
+                functools.partial(self._on_partition_queue_declared,
+                                  exchange, frame, queues_to_bind, queue_name),
+                queue_name,
+                durable=True,
+                auto_delete=False,
+                arguments={"x-dead-letter-exchange": "dead"})
+
+    def _on_partition_queue_declared(self, exchange, frame, queues_to_bind, queue_name,
+                                     method_frame):
+        LOGGER.debug('Binding %r to %r with %r', exchange, queue_name, queue_name)
+        self._channel_out.queue_bind(
+            functools.partial(self._on_partition_queue_bound,
+                              exchange, frame, queues_to_bind, queue_name),
+            queue_name,
+            exchange,
+            queue_name)
+
+    def _on_partition_queue_bound(self, exchange, frame, queues_to_bind, queue_name,
+                                  unused_frame):
+        queues_to_bind.discard(queue_name)
+        if not queues_to_bind:
+            LOGGER.debug('All partition queues bound')
+            super(AggregatorRouter, self).on_output_exchange_declared(exchange, frame)
+
+    def input_callback(self, routing_key, body, properties):
+        try:
+            _, _, source_label, source_channel = routing_key.split('.')
+        except ValueError:
+            raise n6QueueProcessingException(
+                'unexpected routing key: {!r}'.format(routing_key))
+        partition = self.partitioner.get_partition(
+            '{}.{}'.format(source_label, source_channel))
+        prop_kwargs = ({'headers': properties.headers}
+                       if properties is not None and properties.headers else None)
+        self.publish_output(routing_key=get_partition_queue_name(partition),
+                            body=body,
+                            prop_kwargs=prop_kwargs)
+
+
 def main():
     with logging_configured():
         if os.environ.get('n6integration_test'):
@@ -366,5 +1024,49 @@ def main():
             a.stop()
 
 
+def router_main():
+    with logging_configured():
+        router = AggregatorRouter()
+        try:
+            router.run()
+        except KeyboardInterrupt:
+            router.stop()
+
+
+def rebalance_main():
+    """
+    Redistribute the aggregator state after the number of partitions
+    (the `partitions` option in the `aggregator` config section) has
+    been changed.
+
+    The rebalancing procedure:
+
+    1. stop n6aggregatorrouter;
+    2. wait until the input queues of all partitions are empty
+       (`aggregator_partition_<number>`), then stop all aggregator
+       instances;
+    3. run `n6aggregatorrebalance <old number of partitions>` (the new
+       number is taken from the config);
+    4. start the aggregator instances for the new partitions, then
+       n6aggregatorrouter.
+
+    A partition count of 1 means the classic single-instance mode.
+    """
+    arg_parser = argparse.ArgumentParser(
+        description='Redistribute the aggregator state among partitions.')
+    arg_parser.add_argument('old_partition_count', type=int,
+                            help=('the number of partitions the aggregator '
+                                  'has been run with so far'))
+    args = arg_parser.parse_args()
+    with logging_configured():
+        config = Config(required={"aggregator": ("dbpath", "time_tolerance")})
+        aggregator_config = config["aggregator"]
+        rebalance_partitioned_state(
+            os.path.expanduser(aggregator_config["dbpath"]),
+            int(aggregator_config["time_tolerance"]),
+            args.old_partition_count,
+            int(aggregator_config.get("partitions", 1)))
+
+
 if __name__ == '__main__':
     main()
@@ -1,11 +1,16 @@
-# Copyright (c) 2013-2018 NASK. All rights reserved.
+# Copyright (c) 2013-2020 NASK. All rights reserved.
 
 import datetime
+import hashlib
+import heapq
 import json
 import cPickle
 import os
 import os.path
+import time
+import urllib
 
+from n6lib.common_helpers import string_to_bool
 from n6lib.config import Config
 from n6lib.datetime_helpers import parse_iso_datetime_to_utc
 from n6lib.log_helpers import get_logger, logging_configured
@@ -39,13 +44,181 @@ class BlackListData(object):
         self.payload = tmp
 
 
+class CompactBlackListData(object):
+
+    """
+    A compact counterpart of `BlackListData` (see: `SourceData.compact`).
+
+    The payload is kept as a tuple of its keys (shared by entries) and
+    a pickled tuple of its values (it is unpickled on each access, so --
+    unlike in the case of `BlackListData` -- modifying the obtained dict
+    does not affect the entry); the `source`, `url` and `fqdn`
+    attributes are not kept (they can be taken from the payload).
+    """
+
+    __slots__ = ('id', 'ip', 'flag', 'generation', 'expires',
+                 '_payload_keys', '_payload_blob')
+
+    def __init__(self, payload):
+        self.id = payload.get("id")
+        self.ip = tuple(str(addr["ip"]) for addr in payload.get("address")) if payload.get("address") is not None else ()
+        self.flag = payload.get("flag")
+        self.generation = None
+        self.expires = parse_iso_datetime_to_utc(payload.get("expires"))
+        self.payload = payload
+
+    @property
+    def payload(self):
+        return dict(zip(self._payload_keys, cPickle.loads(self._payload_blob)))
+
+    @payload.setter
+    def payload(self, payload):
+        payload_keys = tuple(payload)
+        self._payload_keys = _shared_payload_keys.setdefault(payload_keys, payload_keys)
+        self._payload_blob = cPickle.dumps(tuple(payload[k] for k in payload_keys),
+                                           cPickle.HIGHEST_PROTOCOL)
+
+    def to_dict(self):
+        return self.payload
+
+    def update_payload(self, update_dict):
+        tmp = self.payload
+        tmp.update(update_dict)
+        self.payload = tmp
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+        self._payload_keys = _shared_payload_keys.setdefault(self._payload_keys,
+                                                             self._payload_keys)
+
+
+# {<tuple of payload keys>: <the same tuple>} (to share the tuples
+# between `CompactBlackListData` instances)
+_shared_payload_keys = {}
+
+# the marker of the keys of those compact blacklist entries whose
+# digests collide with the digests of other entries (see:
+# `SourceData._get_compact_key()`)
+_COLLIDING_KEY_MARKER = '<colliding>'
+
+
+def _get_key_digest(event_key):
+    if isinstance(event_key, tuple):
+        key_str = 't' + '\n'.join(event_key)
+    else:
+        if isinstance(event_key, unicode):
+            event_key = event_key.encode('utf-8')
+        key_str = 's' + event_key
+    return hashlib.md5(key_str).digest()
+
+
 class SourceData(object):
 
-    def __init__(self):
+    """
+    The state of a source's blacklist.
+
+    Each blacklist entry (a `BlackListData` instance) is stamped with
+    the *generation* in which it was last seen (i.e., flagged with the
+    id of a series), where the generation is the number of blacklist
+    series that have been finalized for the source (see:
+    `process_deleted()`). The entries are indexed by their generations,
+    by the series ids (only those seen in the current generation), and
+    by their expiry times -- so that finding the entries to be delisted
+    (not seen in the current generation, or cleared on a series timeout)
+    or expired does not require scanning the whole blacklist.
+
+    An entry is considered flagged if it has been seen in the current
+    generation and its flag has not been cleared (see: `clear_flags()`),
+    so advancing the generation makes all entries unflagged.
+    """
+
+    # whether the state has been changed since it was stored
+    # Note: it is defined as a class attribute, so that instances
+    # unpickled from older state files have it as well.
+    dirty = False
+
+    # whether the blacklist entries are `CompactBlackListData` instances
+    # keyed by 16-byte digests of the event keys (rather than
+    # `BlackListData` instances keyed by the event keys themselves);
+    # see: `set_compact()` (Note: it is defined as a class attribute,
+    # for the same reason as above.)
+    compact = False
+
+    # the real time of the last use of the state (see:
+    # `ComparatorDataWrapper.get_source_data()`; not pickled)
+    last_used = 0
+
+    def __init__(self, compact=False):
+        self.compact = compact
         self.time = None  # current time tracked for source (based on event _bl-time)
         # real time of the last event (used to trigger cleanup if source is inactive)
         self.last_event = None
         self.blacklist = {}  # current state of black list
+        self.generation = 0
+        self._init_indexes()
+
+    def __getstate__(self):
+        # (the indexes are not pickled -- they are rebuilt on unpickling)
+        state = self.__dict__.copy()
+        for name in self._INDEX_ATTRIBUTE_NAMES:
+            state.pop(name, None)
+        state.pop('last_used', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'generation' not in state:
+            # (migrating an instance pickled by an older version,
+            # when flags were reset by setting them to None)
+            self.generation = 0
+            for event in self.blacklist.itervalues():
+                event.generation = (self.generation if event.flag is not None else None)
+        self._init_indexes()
+        for key, event in self.blacklist.iteritems():
+            self._index_event(key, event)
+        self._rebuild_expiry_heap()
+
+    _INDEX_ATTRIBUTE_NAMES = (
+        '_keys_by_generation',
+        '_flagged_keys_by_series',
+        '_expiry_heap',
+        '_expiry_heap_counter',
+    )
+
+    def _init_indexes(self):
+        # {<generation (None for cleared flags)>: <set of keys>}
+        self._keys_by_generation = {}
+        # {<series id>: <set of keys>} (only for the current generation)
+        self._flagged_keys_by_series = {}
+        # [(<expires>, <counter>, <key>, <BlackListData>), ...] (a heap,
+        # possibly containing outdated items -- they are skipped)
+        self._expiry_heap = []
+        self._expiry_heap_counter = 0
+
+    def set_compact(self, compact):
+        """Convert the blacklist entries to the compact or to the
+        regular form (if they are not in that form already)."""
+        compact = bool(compact)
+        if compact == self.compact:
+            return
+        self.compact = compact
+        old_blacklist = self.blacklist
+        self.blacklist = {}
+        for event in old_blacklist.itervalues():
+            payload = event.payload
+            new_event = self._make_event(payload)
+            new_event.flag = event.flag
+            new_event.generation = event.generation
+            self.blacklist[self._get_blacklist_key(payload)] = new_event
+        self._init_indexes()
+        for key, event in self.blacklist.iteritems():
+            self._index_event(key, event)
+        self._rebuild_expiry_heap()
+        self.dirty = True
 
     def update_time(self, event_time):
         if event_time > self.time:
@@ -82,8 +255,33 @@ class SourceData(object):
                                              'must have at least one of `url`, `fqdn`, '
                                              '`address`, data: {}'.format(data['source'], data) )
 
+    def _get_blacklist_key(self, data):
+        event_key = self.get_event_key(data)
+        if self.compact:
+            return self._get_compact_key(event_key)
+        return event_key
+
+    def _get_compact_key(self, event_key):
+        # The key is the digest of the event key -- unless another
+        # entry (with a different event key) is already stored under
+        # that digest; then the key is a (<marker>, <event key>) tuple.
+        digest = _get_key_digest(event_key)
+        event = self.blacklist.get(digest)
+        if event is not None and self.get_event_key(event.payload) == event_key:
+            return digest
+        colliding_key = (_COLLIDING_KEY_MARKER, event_key)
+        if event is not None or colliding_key in self.blacklist:
+            return colliding_key
+        return digest
+
+    def _make_event(self, data):
+        if self.compact:
+            return CompactBlackListData(data)
+        return BlackListData(data)
+
     def process_event(self, data):
         event_time = parse_iso_datetime_to_utc(data['_bl-time'])
+        self.dirty = True
 
         if self.time is None:
             self.time = event_time
@@ -92,14 +290,13 @@ class SourceData(object):
             raise n6QueueProcessingException('Event belongs to blacklist'
                                              ' older than the last one processed.')
 
-        event_key = self.get_event_key(data)
+        event_key = self._get_blacklist_key(data)
         event = self.blacklist.get(event_key)
 
         if event is None:
             # new bl event
-            new_event = BlackListData(data)
-            new_event.flag = data.get("_bl-series-id")
-            self.blacklist[event_key] = new_event
+            new_event = self._make_event(data)
+            self._add_event(event_key, new_event, data.get("_bl-series-id"))
             return 'bl-new', new_event.payload
         else:
             # existing
@@ -107,51 +304,120 @@ class SourceData(object):
             ips_new = [x["ip"] for x in data.get("address")] if data.get("address") is not None else []
             if self._are_ips_different(ips_old, ips_new):
                 data["replaces"] = event.id
-                new_event = BlackListData(data)
-                new_event.flag = data.get("_bl-series-id")
-                self.blacklist[event_key] = new_event
+                new_event = self._make_event(data)
+                self._unindex_event(event_key, event)
+                self._add_event(event_key, new_event, data.get("_bl-series-id"))
                 return "bl-change", new_event.payload
             elif parse_iso_datetime_to_utc(data.get("expires")) != event.expires:
                 event.expires = parse_iso_datetime_to_utc(data.get("expires"))
-                event.flag = data.get("_bl-series-id")
                 event.update_payload({"expires": data.get("expires")})
-                self.blacklist[event_key] = event
+                self._push_expiry(event_key, event)
+                self._flag_event(event_key, event, data.get("_bl-series-id"))
                 return "bl-update", event.payload
             else:
-                event.flag = data.get("_bl-series-id")
-                self.blacklist[event_key] = event
+                self._flag_event(event_key, event, data.get("_bl-series-id"))
                 return None, event.payload
 
     def process_deleted(self):
+        """
+        Remove the entries that have not been seen in the current
+        generation (or whose flags have been cleared) -- as delisted --
+        and the expired ones, and begin a new generation.
 
+        Returns:
+            A list of ["bl-delist" or "bl-expire", <payload>] lists.
+        """
         ret_value = []
-        for key, event in list(self.blacklist.iteritems()):
-            if event.flag is None:
-                value = event.payload.copy()
-                if key in self.blacklist:
-                    del self.blacklist[key]
-                # yield "bl-delist", value
-                ret_value.append(["bl-delist", value])
-                continue
-            if event.expires < self.time:
-                value = event.payload.copy()
-                if key in self.blacklist:
-                    del self.blacklist[key]
-                # yield "bl-expire", value
-                ret_value.append(["bl-expire", value])
-                continue
-            event.flag = None
+        if self.blacklist:
+            self.dirty = True
+        for generation in list(self._keys_by_generation):
+            if generation != self.generation:
+                for key in self._keys_by_generation.pop(generation):
+                    event = self.blacklist.pop(key)
+                    # yield "bl-delist", value
+                    ret_value.append(["bl-delist", event.payload.copy()])
+        heap = self._expiry_heap
+        while heap and heap[0][0] < self.time:
+            expires, _, key, event = heapq.heappop(heap)
+            if self.blacklist.get(key) is not event or event.expires != expires:
+                continue  # (outdated heap item)
+            del self.blacklist[key]
+            self._unindex_event(key, event)
+            # yield "bl-expire", value
+            ret_value.append(["bl-expire", event.payload.copy()])
+        if len(heap) > 2 * len(self.blacklist) + 1000:
+            self._rebuild_expiry_heap()
+        # (all entries become unflagged)
+        self.generation += 1
+        self._flagged_keys_by_series = {}
         return ret_value
 
     def clear_flags(self, flag_id):
-        for key, event in list(self.blacklist.iteritems()):
-            if event.flag == flag_id:
-                event.flag = None
-                self.blacklist[key] = event
+        keys = self._flagged_keys_by_series.pop(flag_id, ())
+        if keys:
+            self.dirty = True
+        for key in keys:
+            event = self.blacklist[key]
+            self._discard_from_index(self._keys_by_generation, event.generation, key)
+            self._set_flag(event, None)
+            self._index_event(key, event)
 
     def __repr__(self):
         return repr(self.groups)
 
+    #
+    # Index-related helpers
+
+    def _add_event(self, key, event, series_id):
+        self.blacklist[key] = event
+        self._push_expiry(key, event)
+        self._set_flag(event, series_id)
+        self._index_event(key, event)
+
+    def _flag_event(self, key, event, series_id):
+        self._unindex_event(key, event)
+        self._set_flag(event, series_id)
+        self._index_event(key, event)
+
+    def _set_flag(self, event, series_id):
+        event.flag = series_id
+        # (an entry with no flag is not considered seen, as it
+        # would be delisted by the former flag-scanning algorithm)
+        event.generation = (self.generation if series_id is not None else None)
+
+    def _index_event(self, key, event):
+        generation = event.generation
+        self._keys_by_generation.setdefault(generation, set()).add(key)
+        if generation == self.generation:
+            self._flagged_keys_by_series.setdefault(event.flag, set()).add(key)
+
+    def _unindex_event(self, key, event):
+        # (note: expiry heap items are not removed but just become outdated)
+        generation = event.generation
+        self._discard_from_index(self._keys_by_generation, generation, key)
+        if generation == self.generation:
+            self._discard_from_index(self._flagged_keys_by_series, event.flag, key)
+
+    @staticmethod
+    def _discard_from_index(index, index_key, key):
+        keys = index.get(index_key)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[index_key]
+
+    def _push_expiry(self, key, event):
+        heapq.heappush(self._expiry_heap, self._make_expiry_heap_item(key, event))
+
+    def _make_expiry_heap_item(self, key, event):
+        self._expiry_heap_counter += 1
+        return event.expires, self._expiry_heap_counter, key, event
+
+    def _rebuild_expiry_heap(self):
+        self._expiry_heap = [self._make_expiry_heap_item(key, event)
+                             for key, event in self.blacklist.iteritems()]
+        heapq.heapify(self._expiry_heap)
+
 
 class ComparatorData(object):
 
@@ -171,32 +437,192 @@ class ComparatorData(object):
 
 class ComparatorDataWrapper(object):
 
-    def __init__(self, dbpath):
+    """
+    The comparator's state (a `ComparatorData` instance) + its persistence.
+
+    Each source's state (a `SourceData` instance) is stored in its own
+    file, in the `<dbpath>.sources` directory. A source's state is
+    loaded lazily, when it is used for the first time (see:
+    `get_source_data()`), and -- if `source_idle_timeout` is not 0 --
+    it is evicted from memory (after being stored, if needed) at the
+    first checkpoint after it has not been used for that many seconds
+    (see: `evict_idle_sources()`). So the startup time and the memory
+    usage depend only on the sources that are active. Only the sources whose
+    state has changed since it was stored (*dirty* ones) are written.
+    They are written at *checkpoints*: at the end of a series (see:
+    `clear_flags()` and `process_deleted()`), if at least
+    `checkpoint_interval` seconds have passed since the previous
+    checkpoint (0 means: at the end of each series), and on stop (see:
+    `store_state()`). A state file in the former format (the whole
+    state pickled into the `dbpath` file) is migrated on the first
+    load (and then renamed, by appending the ".migrated" suffix); if
+    storing some sources fails, the migration is repeated on the next
+    load -- but only for the sources that still have no files.
+
+    Crash-consistency guarantees:
+
+    * each source's file is replaced atomically (it is written to
+      a temporary file which is fsync'ed and then renamed), so -- after
+      a crash -- it contains the source's state as of some checkpoint
+      (no partially written or mixed states);
+
+    * a source is no longer dirty only once its file has been replaced
+      successfully; a source whose file could not be written stays
+      dirty, so it is retried at the next checkpoint;
+
+    * the changes made after the last checkpoint are lost on a crash
+      (as before: with the default `checkpoint_interval`, it is the
+      same point at which the whole state used to be stored); the
+      states of different sources are independent, so each of them is
+      restored as of the last checkpoint at which it was dirty.
+    """
+
+    # (defined as class attributes, so that instances created
+    # with __new__() -- as in some tests -- work as well)
+    checkpoint_interval = 0
+    source_idle_timeout = 0
+    compact_blacklists = False
+    _last_checkpoint_time = 0
+
+    def __init__(self, dbpath, checkpoint_interval=0, source_idle_timeout=0,
+                 compact_blacklists=False):
         self.comp_data = None
         self.dbpath = dbpath
+        self.checkpoint_interval = checkpoint_interval
+        self.source_idle_timeout = source_idle_timeout
+        self.compact_blacklists = compact_blacklists
+        self._last_checkpoint_time = time.time()
         try:
             self.restore_state()
         except:
             LOGGER.error("Error restoring state from: %r", self.dbpath)
             self.comp_data = ComparatorData()
 
+    @property
+    def sources_dir(self):
+        return self.dbpath + '.sources'
+
     def store_state(self):
-        try:
-            with open(self.dbpath, "w") as f:
-                cPickle.dump(self.comp_data, f)
-        except IOError:
-            LOGGER.error("Error saving state to: %r", self.dbpath)
+        """Store the states of all dirty sources.
+
+        Returns:
+            True if all of them have been stored successfully.
+        """
+        self._last_checkpoint_time = time.time()
+        all_stored = True
+        for source_name, source_data in self.comp_data.sources.iteritems():
+            if source_data.dirty:
+                try:
+                    self._store_source_data(source_name, source_data)
+                except Exception:
+                    LOGGER.exception("Error saving state of %r to: %r",
+                                     source_name, self.sources_dir)
+                    all_stored = False
+        return all_stored
+
+    def checkpoint(self):
+        """Store the states of dirty sources if a checkpoint is due;
+        evict the states of idle sources."""
+        if time.time() - self._last_checkpoint_time >= self.checkpoint_interval:
+            self.store_state()
+        self.evict_idle_sources()
+
+    def evict_idle_sources(self):
+        """Remove from memory the states of the sources that have not
+        been used for `source_idle_timeout` seconds (if it is not 0).
+
+        A dirty source's state is stored before being evicted (if that
+        fails, the state is kept in memory).
+        """
+        if not self.source_idle_timeout:
+            return
+        used_before = time.time() - self.source_idle_timeout
+        for source_name, source_data in self.comp_data.sources.items():
+            if source_data.last_used > used_before:
+                continue
+            if source_data.dirty:
+                try:
+                    self._store_source_data(source_name, source_data)
+                except Exception:
+                    LOGGER.exception("Error saving state of %r to: %r",
+                                     source_name, self.sources_dir)
+                    continue
+            del self.comp_data.sources[source_name]
+            LOGGER.debug("Evicted idle source state: %r", source_name)
 
     def restore_state(self):
+        # (note: the states of sources are loaded lazily -- see:
+        # `get_source_data()`)
+        if os.path.exists(self.dbpath):
+            self._migrate_former_state_file()
+            return
+        self.comp_data = ComparatorData()
+
+    def get_source_data(self, source_name):
+        """Get the state of the source (loading it if needed)."""
+        source_data = self.comp_data.sources.get(source_name)
+        if source_data is None:
+            source_data = self._load_source_data(source_name)
+            self.comp_data.sources[source_name] = source_data
+        source_data.last_used = time.time()
+        return source_data
+
+    def _load_source_data(self, source_name):
+        path = self._get_source_data_path(source_name)
+        if not os.path.exists(path):
+            return SourceData(compact=self.compact_blacklists)
+        try:
+            with open(path, 'rb') as f:
+                source_data = cPickle.load(f)
+        except Exception:
+            LOGGER.exception("Error restoring state of %r from: %r", source_name, path)
+            return SourceData(compact=self.compact_blacklists)
+        source_data.set_compact(self.compact_blacklists)
+        return source_data
+
+    def _get_source_data_path(self, source_name):
+        return os.path.join(self.sources_dir,
+                            urllib.quote(source_name, safe='') + '.pickle')
+
+    def _migrate_former_state_file(self):
         with open(self.dbpath, "r") as f:
             self.comp_data = cPickle.load(f)
+        for source_name, source_data in self.comp_data.sources.items():
+            if os.path.exists(self._get_source_data_path(source_name)):
+                # the source's file has been stored by a former run (in
+                # which the migration was not completed) -- so its state
+                # is newer than the migrated one and must not be replaced
+                # (it will be loaded from that file when needed)
+                del self.comp_data.sources[source_name]
+                continue
+            source_data.set_compact(self.compact_blacklists)
+            source_data.dirty = True
+        if self.store_state():
+            os.rename(self.dbpath, self.dbpath + '.migrated')
+            LOGGER.info("Migrated state from %r to %r", self.dbpath, self.sources_dir)
+
+    def _store_source_data(self, source_name, source_data):
+        if not os.path.isdir(self.sources_dir):
+            os.makedirs(self.sources_dir, 0700)
+        path = self._get_source_data_path(source_name)
+        tmp_path = path + '.tmp'
+        source_data.dirty = False
+        try:
+            with open(tmp_path, 'wb') as f:
+                cPickle.dump(source_data, f, cPickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, path)
+        except:
+            source_data.dirty = True
+            raise
 
     def process_new_message(self, data):
         """Processes a message and validates agains db to detect new/change/update.
         Adds new entry to db if necessary (new) or updates entry (change/update) and
         stores flag in db for processed event.
         """
-        source_data = self.comp_data.get_or_create_sourcedata(data['source'])
+        source_data = self.get_source_data(data['source'])
         result = source_data.process_event(data)
         source_data.update_time(parse_iso_datetime_to_utc(data['_bl-time']))
         return result
@@ -204,19 +630,19 @@ class ComparatorDataWrapper(object):
     def clear_flags(self, source, flag_id):
         """Cleans up flags in the db after processing complete blacklist
         """
-        source_data = self.comp_data.get_or_create_sourcedata(source)
+        source_data = self.get_source_data(source)
         source_data.clear_flags(flag_id)
-        self.store_state()
+        self.checkpoint()
 
     def process_deleted(self, source):
         """Finds unflagged and expired messages for a bl_name (deleted) and generates delist/expire messages.
         Removes entries from db.
         """
 
-        source_data = self.comp_data.get_or_create_sourcedata(source)
+        source_data = self.get_source_data(source)
         for event in source_data.process_deleted():
             yield event
-        self.store_state()
+        self.checkpoint()
 
 
 class ComparatorState(object):
@@ -227,7 +653,7 @@ class ComparatorState(object):
                          ...}
         open_series = {series-id: {"total": int, #total number of messages in a series
                                    "msg-count": int #number of messages seen so far
-                                   "msg-nums": [int, ...], #message numbers of seen messages
+                                   "msg-nums": {int, ...}, #message numbers of seen messages
                                    "msg-ids": [str, ...], #ids of the seen messages
                                    "timeout-id": str, #id of the created timeout for a serie
                                     }
@@ -253,6 +679,7 @@ class ComparatorState(object):
             #    return False
             if message["_bl-series-total"] != self.open_series[message["_bl-series-id"]]["total"]:
                 return False
+            # (note: "msg-nums" is a set, so this check is O(1))
             if message["_bl-series-no"] in self.open_series[message["_bl-series-id"]]["msg-nums"]:
                 return False
             if self.open_series[message["_bl-series-id"]]["msg-count"] + 1 > self.open_series[message["_bl-series-id"]]["total"]:
@@ -269,11 +696,11 @@ class ComparatorState(object):
             self.open_series[message["_bl-series-id"]] = {"total": int(message["_bl-series-total"]),
                                                          "timeout-id": None,
                                                          "msg-count": 0,
-                                                         "msg-nums": [],
+                                                         "msg-nums": set(),
                                                          "msg-ids": []
                                                          }
         self.open_series[message["_bl-series-id"]]["msg-count"] += 1
-        self.open_series[message["_bl-series-id"]]["msg-nums"].append(int(message["_bl-series-no"]))
+        self.open_series[message["_bl-series-id"]]["msg-nums"].add(int(message["_bl-series-no"]))
         self.open_series[message["_bl-series-id"]]["msg-ids"].append(message["id"])
         # print "received message series %s: %d of %d" % (message["_bl-series-id"],
         #                                                 self.open_series[message["_bl-series-id"]]["msg-count"],
@@ -329,7 +756,11 @@ class Comparator(QueuedBase):
                             ' for user, which runs comparator,  path:',
                             self.comparator_config["dbpath"])
         self.state = ComparatorState(int(self.comparator_config["cleanup_time"]))
-        self.db = ComparatorDataWrapper(self.comparator_config["dbpath"])
+        self.db = ComparatorDataWrapper(
+            self.comparator_config["dbpath"],
+            int(self.comparator_config.get("checkpoint_interval", 0)),
+            int(self.comparator_config.get("source_idle_timeout", 0)),
+            string_to_bool(self.comparator_config.get("compact_blacklists", "false")))
 
     def on_series_timeout(self, source, series_id):
         """Callback called when the messages for a given series have
@@ -1,17 +1,25 @@
-# Copyright (c) 2013-2019 NASK. All rights reserved.
+# Copyright (c) 2013-2020 NASK. All rights reserved.
 
+import bisect
 import collections
+import json
 import os
+import socket
+import struct
+import time
 import urlparse
+from multiprocessing.pool import ThreadPool
 
 import dns.resolver
 import iptools
 import maxminddb.const
+from bson.json_util import dumps
 from dns.exception import DNSException
 from geoip2 import database, errors
 
 from n6.base.queue import QueuedBase
-from n6lib.common_helpers import replace_segment, is_ipv4
+from n6.utils.geoip_range_table import GeoIPRangeTable
+from n6lib.common_helpers import replace_segment, is_ipv4, string_to_bool
 from n6lib.config import Config
 from n6lib.log_helpers import get_logger, logging_configured
 from n6lib.record_dict import RecordDict
@@ -20,6 +28,290 @@ from n6lib.record_dict import RecordDict
 LOGGER = get_logger(__name__)
 
 
+DEFAULT_GEOIP_CACHE_SIZE = 100000
+
+
+class IPRangeIndex(object):
+
+    """
+    A set of IPv4 and IPv6 address ranges, compiled for fast lookups.
+
+    The ranges (given as single addresses or as networks in the CIDR
+    notation -- for IPv4, also in other notations accepted by
+    `iptools.IpRangeList`, e.g., '127/8') are converted to integer intervals which are merged (if
+    overlapping or adjacent) and kept sorted -- so that the membership
+    test is a binary search (unlike in `iptools.IpRangeList`, whose
+    membership test scans all ranges).
+
+    >>> index = IPRangeIndex('10.0.0.0/8', '192.168.1.1', '10.20.0.0/16', '2001:db8::/32')
+    >>> '10.1.2.3' in index
+    True
+    >>> '192.168.1.1' in index, '192.168.1.2' in index, '11.0.0.0' in index
+    (True, False, False)
+    >>> '2001:db8::1' in index, '2001:db9::1' in index, '::ffff:10.1.2.3' in index
+    (True, False, False)
+    >>> index.intervals[4]      # (note: merged)
+    [(167772160, 184549375), (3232235777, 3232235777)]
+    >>> IPRangeIndex('127/8', '10.1/16', '172.16/255.240.0.0', '192.168.1').intervals[4]
+    [(167837696, 167903231), (2130706432, 2147483647), (2886729728, 2887778303), (3232235521, 3232235521)]
+    >>> list(IPRangeIndex('10.0.0.1/31', '::1'))
+    ['10.0.0.0', '10.0.0.1', '::1']
+    >>> bool(IPRangeIndex())
+    False
+    >>> IPRangeIndex('10.0.0.0/33')
+    Traceback (most recent call last):
+      ...
+    ValueError: invalid IP range: '10.0.0.0/33'
+    >>> 'foo' in index
+    Traceback (most recent call last):
+      ...
+    ValueError: invalid IP address: 'foo'
+    """
+
+    def __init__(self, *ranges):
+        intervals = {4: [], 6: []}
+        for ip_range in ranges:
+            version, first, last = self._parse_range(ip_range)
+            intervals[version].append((first, last))
+        self.intervals = {version: self._merge(version_intervals)
+                          for version, version_intervals in intervals.iteritems()}
+        self._starts = {version: [first for first, _ in version_intervals]
+                        for version, version_intervals in self.intervals.iteritems()}
+        self._ends = {version: [last for _, last in version_intervals]
+                      for version, version_intervals in self.intervals.iteritems()}
+
+    def __contains__(self, ip):
+        version, ip_int = self._ip_to_int(ip)
+        i = bisect.bisect_right(self._starts[version], ip_int) - 1
+        return i >= 0 and ip_int <= self._ends[version][i]
+
+    def __iter__(self):
+        for version in (4, 6):
+            for first, last in self.intervals[version]:
+                ip_int = first
+                while ip_int <= last:
+                    yield self._int_to_ip(version, ip_int)
+                    ip_int += 1
+
+    def __nonzero__(self):
+        return any(self.intervals.itervalues())
+
+    @classmethod
+    def _parse_range(cls, ip_range):
+        ip_range = ip_range.strip()
+        if ':' not in ip_range:
+            return cls._parse_ipv4_range(ip_range)
+        ip, sep, prefix_length = ip_range.partition('/')
+        try:
+            version, ip_int = cls._ip_to_int(ip)
+            prefix_length = int(prefix_length) if sep else 128
+            if not 0 <= prefix_length <= 128:
+                raise ValueError
+        except ValueError:
+            raise ValueError('invalid IP range: {!r}'.format(ip_range))
+        host_mask = (1 << (128 - prefix_length)) - 1
+        first = ip_int & ~host_mask
+        return version, first, first | host_mask
+
+    @staticmethod
+    def _parse_ipv4_range(ip_range):
+        # (all IPv4 notations accepted by `iptools.IpRangeList` are
+        # accepted, including the abbreviated ones, such as '127/8',
+        # '10.1/16', '127/255.0.0.0' or '127.1')
+        if iptools.ipv4.validate_cidr(ip_range):
+            first, last = iptools.ipv4.cidr2block(ip_range)
+        elif iptools.ipv4.validate_subnet(ip_range):
+            first, last = iptools.ipv4.subnet2block(ip_range)
+        elif iptools.ipv4.validate_ip(ip_range):
+            first = last = ip_range
+        else:
+            raise ValueError('invalid IP range: {!r}'.format(ip_range))
+        return 4, iptools.ipv4.ip2long(first), iptools.ipv4.ip2long(last)
+
+    @staticmethod
+    def _merge(intervals):
+        merged = []
+        for first, last in sorted(intervals):
+            if merged and first <= merged[-1][1] + 1:
+                if last > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], last)
+            else:
+                merged.append((first, last))
+        return merged
+
+    @staticmethod
+    def _ip_to_int(ip):
+        try:
+            if ':' not in ip:
+                return 4, struct.unpack('!I', socket.inet_pton(socket.AF_INET, ip))[0]
+            high, low = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6, ip))
+            return 6, (high << 64) | low
+        except (socket.error, TypeError):
+            raise ValueError('invalid IP address: {!r}'.format(ip))
+
+    @staticmethod
+    def _int_to_ip(version, ip_int):
+        if version == 4:
+            return socket.inet_ntop(socket.AF_INET, struct.pack('!I', ip_int))
+        return socket.inet_ntop(socket.AF_INET6, struct.pack('!QQ', ip_int >> 64,
+                                                             ip_int & (2 ** 64 - 1)))
+
+
+class PrevalidatedRecord(dict):
+
+    """
+    A lightweight stand-in for `RecordDict`, used by the Enricher's
+    JSON-level fast path (see: the `json_fast_path` config option).
+
+    The input JSON is assumed to have been produced (upstream, e.g.,
+    by a parser or the aggregator) by `RecordDict.get_ready_json()`,
+    so its items are already adjusted: they are *not* adjusted again.
+    Only the items set later (by the Enricher: `fqdn`, `address` and
+    `enriched`) are adjusted -- by the `RecordDict`'s adjusters. The
+    items are set (and the output dict is made) in the same order as
+    by `RecordDict`, so that the output JSON is exactly the same.
+
+    >>> record = PrevalidatedRecord.from_json(
+    ...     '{"id": "0123456789abcdef0123456789abcdef", '
+    ...     '"rid": "0123456789abcdef0123456789abcdef", '
+    ...     '"source": "foo.bar", "restriction": "public", '
+    ...     '"confidence": "low", "category": "bots", '
+    ...     '"time": "2020-01-01 00:00:00"}')
+    >>> record['source']                  # (not adjusted again)
+    u'foo.bar'
+    >>> record['fqdn'] = 'Example.COM'    # (adjusted)
+    >>> record['fqdn']
+    u'example.com'
+    >>> PrevalidatedRecord.from_json('{"source": "foo.bar"}') is None     # missing keys
+    True
+    """
+
+    # (the legacy item which is silently ignored by `RecordDict`)
+    _IGNORED_KEY = '__preserved_custom_keys__'
+
+    # (items whose input values are replaced anyway or always adjusted
+    # again -- see: `Enricher.enrich()`)
+    _NON_FLAT_KEYS_ALLOWED = frozenset({'address', 'enriched'})
+
+    _SETTABLE_KEYS = RecordDict.required_keys | RecordDict.optional_keys
+
+    _adjusting_record_dict = RecordDict()
+
+    @classmethod
+    def from_json(cls, json_string):
+        """
+        Get a new instance, or None if the input contains items whose
+        values would not necessarily be output the same way as by
+        `RecordDict` (then the regular path needs to be used).
+        """
+        items = json.loads(json_string)
+        items.pop(cls._IGNORED_KEY, None)
+        keys = items.viewkeys()
+        if not (RecordDict.required_keys <= keys <= cls._SETTABLE_KEYS
+                and not keys & RecordDict.setitem_key_to_target_key.viewkeys()):
+            return None
+        record = cls()
+        setitem = super(PrevalidatedRecord, record).__setitem__
+        # (setting items in the same order as `RecordDict.update()`)
+        for key, value in sorted(items.iteritems()):
+            if key not in cls._NON_FLAT_KEYS_ALLOWED and not cls._is_flat(value):
+                return None
+            setitem(key, value)
+        return record
+
+    @staticmethod
+    def _is_flat(value):
+        if isinstance(value, list):
+            return not any(isinstance(v, (list, dict)) for v in value)
+        return not isinstance(value, dict)
+
+    def __setitem__(self, key, value):
+        adjusting_record_dict = self._adjusting_record_dict
+        adjusting_record_dict[key] = value
+        # (an invalid value may have been omitted -- see:
+        # `RecordDict.without_adjuster_error`)
+        if key in adjusting_record_dict:
+            super(PrevalidatedRecord, self).__setitem__(key, adjusting_record_dict.pop(key))
+
+    def get_ready_json(self):
+        # (a new dict made in the same way as `copy.deepcopy()` makes
+        # the copy of the `RecordDict`'s dict in `get_ready_dict()`)
+        ready_dict = {key: value for key, value in self.iteritems()}
+        used_custom_keys = RecordDict.data_spec.custom_field_keys.intersection(ready_dict)
+        if used_custom_keys:
+            ready_dict[self._IGNORED_KEY] = sorted(used_custom_keys)
+        return dumps(ready_dict)
+
+
+class GeoIPCache(object):
+
+    """
+    A bounded LRU cache of GeoIP lookup results, keyed by IP address.
+
+    Each result is an (<ASN or None>, <CC or None>) pair, obtained with
+    one call of the given `lookup` function (so both values are looked
+    up together, even if only one of them is requested at first).
+
+    The cache also keeps statistics: the numbers of hits and misses and
+    the total time of the lookups made on misses; they are logged every
+    `stats_log_interval` requests.
+
+    >>> cache = GeoIPCache(lambda ip: (42, ip[:2]), max_size=2)
+    >>> cache.get('PL.1')
+    (42, 'PL')
+    >>> cache.get('DE.1')
+    (42, 'DE')
+    >>> cache.get('PL.1')           # hit
+    (42, 'PL')
+    >>> cache.get('US.1')           # miss (and 'DE.1' is evicted)
+    (42, 'US')
+    >>> sorted(cache._results)
+    ['PL.1', 'US.1']
+    >>> cache.hits, cache.misses, cache.hit_ratio
+    (1, 3, 0.25)
+    """
+
+    def __init__(self, lookup, max_size=DEFAULT_GEOIP_CACHE_SIZE, stats_log_interval=100000):
+        self._lookup = lookup
+        self._max_size = max_size
+        self._stats_log_interval = stats_log_interval
+        self._results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lookup_time = 0.0
+
+    @property
+    def hit_ratio(self):
+        requests = self.hits + self.misses
+        return (float(self.hits) / requests if requests else 0.0)
+
+    def get(self, ip):
+        results = self._results
+        try:
+            result = results.pop(ip)
+        except KeyError:
+            start = time.time()
+            result = self._lookup(ip)
+            self.lookup_time += time.time() - start
+            self.misses += 1
+            if len(results) >= self._max_size > 0:
+                results.popitem(last=False)
+        else:
+            self.hits += 1
+        if self._max_size > 0:
+            results[ip] = result
+        if not (self.hits + self.misses) % self._stats_log_interval:
+            self.log_stats()
+        return result
+
+    def log_stats(self):
+        LOGGER.info('GeoIP cache: %d hits, %d misses (hit ratio: %.3f), '
+                    'average lookup time on miss: %.1f us, cached addresses: %d',
+                    self.hits, self.misses, self.hit_ratio,
+                    (self.lookup_time / self.misses * 1e6 if self.misses else 0.0),
+                    len(self._results))
+
+
 class Enricher(QueuedBase):
 
     input_queue = {
@@ -41,6 +333,22 @@ class Enricher(QueuedBase):
 
     single_instance = False
 
+    # the interval (in seconds) of checking whether the DNS lookups
+    # for the pending messages have been completed (when concurrent
+    # DNS lookups are enabled -- see: `on_message()`)
+    dns_pending_check_interval = 0.005
+
+    # (used -- only in the consumer thread -- to adjust a FQDN taken
+    # from a URL, see: `_get_fqdn_to_resolve()`)
+    _fqdn_adjusting_record_dict = RecordDict()
+
+    # (defined as class attributes, so that instances created
+    # with __new__() -- as in some tests -- work as well)
+    _dns_pool = None
+    _prefetched = None
+    _json_fast_path = False
+    geoip_range_table = None
+
     #
     # Initialization
 
@@ -52,14 +360,19 @@ class Enricher(QueuedBase):
             "dnshost", "dnsport", "geoippath", "asndatabasefilename", "citydatabasefilename")})
         self._enrich_config = config["enrich"]
         self.excluded_ips = self._get_excluded_ips()
+        self._geoip_cache = GeoIPCache(
+            self._lookup_asn_and_cc,
+            int(self._enrich_config.get('geoip_cache_size', DEFAULT_GEOIP_CACHE_SIZE)))
         self._setup_geodb()
         self._setup_dnsresolver(self._enrich_config["dnshost"], int(self._enrich_config["dnsport"]))
+        self._setup_dns_pool(int(self._enrich_config.get("dns_concurrency", 1)))
+        self._json_fast_path = string_to_bool(self._enrich_config.get("json_fast_path", "false"))
         super(Enricher, self).__init__(**kwargs)
 
     def _get_excluded_ips(self):
         if self._enrich_config.get('excluded_ips'):
             excluded_ips = [_ip.strip() for _ip in self._enrich_config['excluded_ips'].split(',')]
-            return iptools.IpRangeList(*excluded_ips)
+            return IPRangeIndex(*excluded_ips)
         return None
 
     def _setup_dnsresolver(self, dnshost, dnsport):
@@ -67,8 +380,24 @@ class Enricher(QueuedBase):
         self._resolver.nameservers = [dnshost]
         self._resolver.port = dnsport
 
+    def _setup_dns_pool(self, dns_concurrency):
+        if dns_concurrency > 1:
+            self._dns_pool = ThreadPool(dns_concurrency)
+            # [(<on_message() args>, <RecordDict/PrevalidatedRecord or None>, <fqdn or None>,
+            #   <AsyncResult of fqdn_to_ip() or None>), ...]
+            self._pending_messages = collections.deque()
+            self._pending_check_scheduled = False
+
     def _setup_geodb(self):
         geoipdb_path = self._enrich_config["geoippath"]
+        range_table_file = self._enrich_config.get("rangetablefilename")
+        if range_table_file:
+            # the range table compiled (by `n6geoiprangetable`) from the
+            # databases is used instead of them; being memory-mapped, it
+            # is shared by all enricher processes on the host
+            self.geoip_range_table = GeoIPRangeTable(os.path.join(geoipdb_path,
+                                                                  range_table_file))
+            return
         geoipdb_asn_file = self._enrich_config["asndatabasefilename"]
         geoipdb_city_file = self._enrich_config["citydatabasefilename"]
         self.gi_asn = database.Reader(fileish=os.path.join(geoipdb_path, geoipdb_asn_file),
@@ -79,14 +408,105 @@ class Enricher(QueuedBase):
     #
     # Main activity
 
+    def on_message(self, channel, basic_deliver, properties, body):
+        """
+        If concurrent DNS lookups are enabled (i.e., the `dns_concurrency`
+        config option is greater than 1), the DNS lookup needed for the
+        message (if any) is started in the DNS thread pool, and the
+        message becomes pending. The pending messages are processed --
+        by the superclass's `on_message()` (with the DNS lookup result
+        taken from the completed lookup), so also published and acked
+        -- strictly in the order in which they have been received, as
+        soon as their DNS lookups are completed.
+
+        So a slow DNS lookup does not delay the DNS lookups for the
+        next messages (up to the `prefetch_count` of messages).
+        """
+        if self._dns_pool is None:
+            super(Enricher, self).on_message(channel, basic_deliver, properties, body)
+            return
+        try:
+            data = self._get_input_data(body)
+            fqdn = self._get_fqdn_to_resolve(data)
+        except Exception:
+            # (the message will be processed in the regular way,
+            # so that the error is handled in the regular way)
+            data = fqdn = None
+        # (note: the DNS thread pool workers must not touch any state
+        # of the Enricher, so the resolver-only method is used there)
+        dns_result = (self._dns_pool.apply_async(self._resolve_fqdn_to_ip, (fqdn,))
+                      if fqdn is not None else None)
+        self._pending_messages.append(
+            ((channel, basic_deliver, properties, body), data, fqdn, dns_result))
+        self._process_pending_messages()
+
+    def _get_fqdn_to_resolve(self, data):
+        # (see: `_maybe_set_fqdn()` and `_maybe_set_address_ips()`)
+        if data.get('address') or data.get('_do_not_resolve_fqdn_to_ip'):
+            return None
+        if data.get('fqdn') is not None:
+            return data['fqdn']
+        _, fqdn_from_url = self._extract_ip_or_fqdn(data)
+        if not fqdn_from_url:
+            return None
+        # (the FQDN passed to `fqdn_to_ip()` is the one set in the
+        # record, i.e., adjusted -- or omitted if invalid)
+        adjusting_record_dict = self._fqdn_adjusting_record_dict
+        adjusting_record_dict['fqdn'] = fqdn_from_url
+        return adjusting_record_dict.pop('fqdn', None)
+
+    def _on_pending_check_timeout(self):
+        self._pending_check_scheduled = False
+        self._process_pending_messages()
+
+    def _process_pending_messages(self):
+        if self._closing:
+            return
+        pending_messages = self._pending_messages
+        while pending_messages:
+            on_message_args, data, fqdn, dns_result = pending_messages[0]
+            if dns_result is not None and not dns_result.ready():
+                if not self._pending_check_scheduled:
+                    self._pending_check_scheduled = True
+                    self._connection.add_timeout(self.dns_pending_check_interval,
+                                                 self._on_pending_check_timeout)
+                break
+            pending_messages.popleft()
+            self._prefetched = (data, fqdn, dns_result)
+            try:
+                super(Enricher, self).on_message(*on_message_args)
+            finally:
+                self._prefetched = None
+
     def input_callback(self, routing_key, body, properties):
-        data = RecordDict.from_json(body)
+        if self._prefetched is not None and self._prefetched[0] is not None:
+            data = self._prefetched[0]
+        else:
+            data = self._get_input_data(body)
         with self.setting_error_event_info(data):
             enriched = self.enrich(data)
             rk = replace_segment(routing_key, 1, 'enriched')
             body = enriched.get_ready_json()
             self.publish_output(routing_key=rk, body=body)
 
+    def _get_input_data(self, body):
+        """
+        If the JSON-level fast path is enabled (i.e., the `json_fast_path`
+        config option is true -- which is appropriate only if all input
+        messages are produced by n6 components, from `RecordDict`s), get
+        a `PrevalidatedRecord` (if applicable to the input; otherwise --
+        as well as if the fast path is disabled -- get a `RecordDict`).
+
+        Then the items of the input are not adjusted again, and
+        `_final_sanity_assertions()` is skipped; only the items set by
+        the Enricher are adjusted. The output is the same.
+        """
+        if self._json_fast_path:
+            data = PrevalidatedRecord.from_json(body)
+            if data is not None:
+                return data
+        return RecordDict.from_json(body)
+
     def enrich(self, data):
         enriched_keys = []
         ip_to_enriched_address_keys = collections.defaultdict(list)
@@ -107,7 +527,8 @@ class Enricher(QueuedBase):
         #   (["fqdn"], {"127.0.0.1": ["ip"], "1.2.3.4": ["asn", "cc", "ip"]})
         data['enriched'] = (enriched_keys, ip_to_enriched_address_keys)
         self._ensure_address_is_clean(data)
-        self._final_sanity_assertions(data)  # <- can be commented out for efficiency
+        if not isinstance(data, PrevalidatedRecord):
+            self._final_sanity_assertions(data)  # <- can be commented out for efficiency
         return data
 
     def _extract_ip_or_fqdn(self, data):
@@ -231,6 +652,13 @@ class Enricher(QueuedBase):
         return parsed_url.hostname
 
     def fqdn_to_ip(self, fqdn):
+        if self._prefetched is not None:
+            _, prefetched_fqdn, dns_result = self._prefetched
+            if dns_result is not None and fqdn == prefetched_fqdn:
+                return dns_result.get()
+        return self._resolve_fqdn_to_ip(fqdn)
+
+    def _resolve_fqdn_to_ip(self, fqdn):
         try:
             dns_result = self._resolver.query(fqdn, 'A')
         except DNSException:
@@ -241,20 +669,34 @@ class Enricher(QueuedBase):
         return sorted(ip_set)
 
     def ip_to_asn(self, ip):
+        return self._geoip_cache.get(ip)[0]
+
+    def ip_to_cc(self, ip):
+        return self._geoip_cache.get(ip)[1]
+
+    def _lookup_asn_and_cc(self, ip):
+        if self.geoip_range_table is not None:
+            asn, cc = self.geoip_range_table.lookup(ip)
+            if asn is None:
+                LOGGER.info("%r cannot be resolved by GeoIP (to ASN)", ip)
+            if cc is None:
+                LOGGER.info("%r cannot be resolved by GeoIP (to CC)", ip)
+            return asn, cc
         try:
             geoip_asn = self.gi_asn.asn(ip)
         except errors.GeoIP2Error:
             LOGGER.info("%r cannot be resolved by GeoIP (to ASN)", ip)
-            return None
-        return geoip_asn.autonomous_system_number
-
-    def ip_to_cc(self, ip):
+            asn = None
+        else:
+            asn = geoip_asn.autonomous_system_number
         try:
             geoip_city = self.gi_cc.city(ip)
         except errors.GeoIP2Error:
             LOGGER.info("%r cannot be resolved by GeoIP (to CC)", ip)
-            return None
-        return geoip_city.country.iso_code
+            cc = None
+        else:
+            cc = geoip_city.country.iso_code
+        return asn, cc
 
 
 def main():
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+"""
+Compiled, memory-mapped GeoIP range table (for the Enricher).
+
+The GeoIP ASN and City MaxMind databases are compiled (by the
+`n6geoiprangetable` tool) into one file which contains a sorted table
+of IPv4 address ranges, each with its ASN and country code. The file
+is memory-mapped (read-only) by `GeoIPRangeTable` -- so all enricher
+processes on a host share one physical copy of it (instead of loading
+both databases into the memory of each process).
+
+The lookup results are the same as the results of the respective
+geoip2 database lookups (`autonomous_system_number` of `asn()`,
+`country.iso_code` of `city()`), for IPv4 addresses (note: the ASN 0,
+being reserved, is treated as absent -- the Enricher ignores it
+anyway).
+
+Example usage:
+
+    n6geoiprangetable /usr/share/GeoIP/GeoLite2-ASN.mmdb \\
+        /usr/share/GeoIP/GeoLite2-City.mmdb /usr/share/GeoIP/n6-geoip-ranges.bin
+
+(The output file is replaced atomically, so the processes which still
+use the old one are not affected.)
+"""
+
+import argparse
+import array
+import logging
+import mmap
+import os
+import os.path as osp
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+import maxminddb
+import maxminddb.const
+from maxminddb.errors import InvalidDatabaseError
+
+from n6lib.log_helpers import get_logger
+
+
+LOGGER = get_logger(__name__)
+
+
+# the file format:
+# * header: magic (8 bytes), number of ranges (uint32),
+# * ranges' first addresses (uint32 array, sorted),
+# * ranges' last addresses (uint32 array),
+# * ASNs (uint32 array; 0 means no ASN),
+# * country codes (array of 2-byte strings; '\0\0' means no CC),
+# all integers being little-endian.
+
+_MAGIC = 'N6GEOIP1'
+_HEADER = struct.Struct('<8sI')
+_UINT32 = struct.Struct('<I')
+_CC_SIZE = 2
+_NO_CC = '\0' * _CC_SIZE
+
+
+class GeoIPRangeTable(object):
+
+    """
+    A read-only, memory-mapped GeoIP range table.
+
+    >>> import tempfile
+    >>> path = tempfile.mktemp()
+    >>> write_range_table(path, [(16777216, 16777471, 13335, 'AU'),
+    ...                          (16777472, 16778239, None, 'CN'),
+    ...                          (16778240, 16779263, 38803, None)])
+    3
+    >>> table = GeoIPRangeTable(path)
+    >>> len(table)
+    3
+    >>> table.lookup('1.0.0.1')
+    (13335, u'AU')
+    >>> table.lookup('1.0.2.255')
+    (None, u'CN')
+    >>> table.lookup('1.0.4.0')
+    (38803, None)
+    >>> table.lookup('1.0.8.0'), table.lookup('0.255.255.255')
+    ((None, None), (None, None))
+    >>> table.lookup('foo')
+    Traceback (most recent call last):
+      ...
+    ValueError: invalid IPv4 address: 'foo'
+    >>> table.close()
+    >>> os.remove(path)
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self._mmap) < _HEADER.size:
+                raise ValueError('{!r} is not a GeoIP range table file'.format(path))
+            magic, self._count = _HEADER.unpack_from(self._mmap)
+            if (magic != _MAGIC or
+                  len(self._mmap) != _HEADER.size + self._count * (3 * _UINT32.size + _CC_SIZE)):
+                raise ValueError('{!r} is not a GeoIP range table file'.format(path))
+        except:
+            self._mmap.close()
+            raise
+        self._firsts_offset = _HEADER.size
+        self._lasts_offset = self._firsts_offset + self._count * _UINT32.size
+        self._asns_offset = self._lasts_offset + self._count * _UINT32.size
+        self._ccs_offset = self._asns_offset + self._count * _UINT32.size
+
+    def __len__(self):
+        return self._count
+
+    def lookup(self, ip):
+        """
+        Get an (<ASN or None>, <CC or None>) pair for the given IPv4
+        address (a string).
+        """
+        try:
+            ip_int = struct.unpack('!I', socket.inet_pton(socket.AF_INET, ip))[0]
+        except (socket.error, TypeError):
+            raise ValueError('invalid IPv4 address: {!r}'.format(ip))
+        buf = self._mmap
+        unpack_from = _UINT32.unpack_from
+        firsts_offset = self._firsts_offset
+        # (binary search for the last range whose first address is <= ip_int)
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ip_int < unpack_from(buf, firsts_offset + mid * 4)[0]:
+                hi = mid
+            else:
+                lo = mid + 1
+        i = lo - 1
+        if i < 0 or ip_int > unpack_from(buf, self._lasts_offset + i * 4)[0]:
+            return None, None
+        asn = unpack_from(buf, self._asns_offset + i * 4)[0] or None
+        cc_offset = self._ccs_offset + i * _CC_SIZE
+        cc = buf[cc_offset:cc_offset + _CC_SIZE]
+        return asn, (cc.decode('ascii') if cc != _NO_CC else None)
+
+    def close(self):
+        self._mmap.close()
+
+
+#
+# Compilation
+
+def compile_range_table(asn_db_path, city_db_path, output_path):
+    """
+    Compile the given GeoIP ASN and City databases into a range table
+    file (replacing the `output_path` file atomically, if it exists).
+
+    Returns the number of ranges.
+    """
+    asn_reader = _open_database(asn_db_path)
+    city_reader = _open_database(city_db_path)
+    try:
+        asn_ranges = iter_ipv4_ranges(asn_reader, _get_asn)
+        cc_ranges = iter_ipv4_ranges(city_reader, _get_cc)
+        ranges = iter_merged_ranges(asn_ranges, cc_ranges)
+        return write_range_table(output_path, ranges)
+    finally:
+        asn_reader.close()
+        city_reader.close()
+
+
+def _open_database(path):
+    # (note: the pure Python reader is needed, as its search tree
+    # internals are used by `iter_ipv4_ranges()`)
+    return maxminddb.open_database(path, maxminddb.const.MODE_MMAP)
+
+
+def _get_asn(record):
+    return record.get('autonomous_system_number') or None
+
+
+def _get_cc(record):
+    cc = record.get('country', {}).get('iso_code')
+    if cc is not None and len(cc) != _CC_SIZE:
+        raise InvalidDatabaseError('unexpected country code: {!r}'.format(cc))
+    return cc
+
+
+def iter_ipv4_ranges(reader, get_value):
+    """
+    Walk the search tree of the given MaxMind database (a pure Python
+    `maxminddb.reader.Reader`) -- its IPv4 part, the one used for IPv4
+    address lookups -- and generate sorted (<first address as int>,
+    <last address as int>, <get_value(record)>) tuples, one for each
+    network which has a record.
+    """
+    node_count = reader.metadata().node_count
+    values_by_pointer = {}
+    stack = [(reader._start_node(32), 0, 0)]
+    while stack:
+        node, depth, first = stack.pop()
+        if node < node_count:
+            if depth >= 32:
+                raise InvalidDatabaseError('invalid node in the search tree')
+            stack.append((reader._read_node(node, 1), depth + 1, first | 1 << (31 - depth)))
+            stack.append((reader._read_node(node, 0), depth + 1, first))
+        elif node > node_count:
+            try:
+                value = values_by_pointer[node]
+            except KeyError:
+                value = values_by_pointer[node] = get_value(reader._resolve_data_pointer(node))
+            yield first, first | ((1 << (32 - depth)) - 1), value
+
+
+def iter_merged_ranges(asn_ranges, cc_ranges):
+    """
+    Merge the sorted (<first>, <last>, <ASN or None>) and (<first>,
+    <last>, <CC or None>) ranges into sorted (<first>, <last>, <ASN or
+    None>, <CC or None>) ranges (omitting those without ASN and CC, and
+    joining adjacent ones with the same ASN and CC).
+
+    >>> list(iter_merged_ranges(iter([(0, 9, 1), (10, 19, 1), (30, 39, 2), (40, 49, None)]),
+    ...                         iter([(5, 14, 'PL'), (15, 34, 'DE')])))
+    [(0, 4, 1, None), (5, 14, 1, 'PL'), (15, 19, 1, 'DE'), (20, 29, None, 'DE'), (30, 34, 2, 'DE'), (35, 39, 2, None)]
+    """
+    iterators = [asn_ranges, cc_ranges]
+    currents = [next(it, None) for it in iterators]
+    pending = None
+    pos = 0
+    while True:
+        active = [r for r in currents if r is not None]
+        if not active:
+            break
+        first = max(pos, min(r[0] for r in active))
+        last = min((r[1] if r[0] <= first else r[0] - 1) for r in active)
+        asn, cc = [(r[2] if r is not None and r[0] <= first else None) for r in currents]
+        if asn is not None or cc is not None:
+            if (pending is not None and pending[1] + 1 == first
+                  and pending[2] == asn and pending[3] == cc):
+                pending = (pending[0], last, asn, cc)
+            else:
+                if pending is not None:
+                    yield pending
+                pending = (first, last, asn, cc)
+        pos = last + 1
+        for i, r in enumerate(currents):
+            if r is not None and r[1] <= last:
+                currents[i] = next(iterators[i], None)
+    if pending is not None:
+        yield pending
+
+
+def write_range_table(path, ranges):
+    """
+    Write the given sorted (<first>, <last>, <ASN or None>, <CC or
+    None>) ranges to a range table file (replacing the `path` file
+    atomically, if it exists).
+
+    Returns the number of ranges.
+    """
+    firsts = _make_uint32_array()
+    lasts = _make_uint32_array()
+    asns = _make_uint32_array()
+    ccs = []
+    for first, last, asn, cc in ranges:
+        firsts.append(first)
+        lasts.append(last)
+        asns.append(asn or 0)
+        ccs.append(str(cc) if cc is not None else _NO_CC)
+    if sys.byteorder != 'little':
+        for uint32_array in (firsts, lasts, asns):
+            uint32_array.byteswap()
+    dir_path = osp.dirname(osp.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.tmp-', suffix=osp.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, len(firsts)))
+            firsts.tofile(f)
+            lasts.tofile(f)
+            asns.tofile(f)
+            f.write(''.join(ccs))
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+    return len(firsts)
+
+
+def _make_uint32_array():
+    for typecode in ('I', 'L'):
+        uint32_array = array.array(typecode)
+        if uint32_array.itemsize == 4:
+            return uint32_array
+    raise RuntimeError('no 4-byte array typecode')
+
+
+#
+# Command-line interface
+
+def get_arg_parser():
+    arg_parser = argparse.ArgumentParser(
+        description='Compile the GeoIP ASN and City databases into a range table '
+                    'file, to be memory-mapped by the Enricher (see the '
+                    '`rangetablefilename` option in the [enrich] config section).')
+    arg_parser.add_argument('asn_db', metavar='ASN_DB',
+                            help='path to the GeoIP ASN database (e.g., GeoLite2-ASN.mmdb)')
+    arg_parser.add_argument('city_db', metavar='CITY_DB',
+                            help='path to the GeoIP City database (e.g., GeoLite2-City.mmdb)')
+    arg_parser.add_argument('output', metavar='OUTPUT',
+                            help='path to the output range table file')
+    return arg_parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    # (note: no n6 logging configuration files are needed)
+    logging.basicConfig()
+    start = time.time()
+    range_count = compile_range_table(args.asn_db, args.city_db, args.output)
+    print >> sys.stderr, '{} ranges written to {} ({} bytes) in {:.1f}s'.format(
+        range_count, args.output, osp.getsize(args.output), time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
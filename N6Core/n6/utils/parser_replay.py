@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+"""
+Offline parser replay + benchmarking tool.
+
+Raw input bodies are read from local files (or directories) and fed
+into the parser's input_callback() -- together with stand-in AMQP
+properties -- so neither RabbitMQ nor any collector is needed.  The
+output bodies are written to a local file, and some basic performance
+figures (rows per second, per-row processing time, peak memory usage)
+are reported.
+
+Example usage:
+
+    n6parserreplay AbuseChFeodoTracker201908Parser samples/feodo/ \\
+        --output /tmp/feodo.out --timestamp 1577836800 --repeat 5
+"""
+
+import argparse
+import contextlib
+import hashlib
+import importlib
+import json
+import logging
+import os
+import os.path as osp
+import pkgutil
+import resource
+import sys
+import time
+
+import pika
+
+import n6.parsers
+from n6.parsers.generic import iter_parser_classes
+from n6lib.common_helpers import make_exc_ascii_str
+from n6lib.log_helpers import get_logger
+
+
+LOGGER = get_logger(__name__)
+
+
+#
+# Parser discovery
+
+def import_parser_modules():
+    for _, module_name, _ in pkgutil.iter_modules(n6.parsers.__path__):
+        importlib.import_module('n6.parsers.' + module_name)
+
+
+def get_parser_class(name):
+    """
+    Get the parser class specified by its name.
+
+    Args:
+        `name` (str):
+            The parser class name (e.g., 'AbuseChFeodoTrackerParser'),
+            or the name used in the parser's script name (e.g.,
+            'abusechfeodotracker' -- as in 'n6parser_abusechfeodotracker').
+
+    Returns:
+        The parser class (one of those for which the standard
+        `n6parser_*` entry points are generated).
+
+    Raises:
+        ValueError if no parser class matches the given name.
+    """
+    import_parser_modules()
+    for parser_class in iter_parser_classes():
+        class_name = parser_class.__name__
+        if name in (class_name, class_name.lower().replace('parser', '')):
+            return parser_class
+    raise ValueError('no parser class matches the name {!r}'.format(name))
+
+
+#
+# Input/output helpers
+
+def iter_input_paths(paths):
+    """
+    Yield paths of input files: each of the given `paths` that is a
+    directory is replaced with its (non-hidden) files, sorted by name.
+    """
+    for path in paths:
+        if osp.isdir(path):
+            for filename in sorted(os.listdir(path)):
+                file_path = osp.join(path, filename)
+                if not filename.startswith('.') and osp.isfile(file_path):
+                    yield file_path
+        else:
+            yield path
+
+
+def parse_header_arg(header_arg):
+    key, sep, value = header_arg.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(
+            '{!r} is not in the KEY=VALUE format'.format(header_arg))
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return key, value
+
+
+def parse_timestamp_arg(timestamp_arg):
+    try:
+        return int(timestamp_arg)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            '{!r} is not a UNIX timestamp (an integer)'.format(timestamp_arg))
+
+
+@contextlib.contextmanager
+def _argv_cleared():
+    # (QueuedBase.__new__() parses sys.argv -- and the replay tool's
+    # own arguments are not intended for the parser instance)
+    orig_argv = sys.argv
+    sys.argv = orig_argv[:1]
+    try:
+        yield
+    finally:
+        sys.argv = orig_argv
+
+
+def _get_max_rss_kb():
+    # (note: on Linux `ru_maxrss` is expressed in kilobytes)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+#
+# Actual replay stuff
+
+class ReplayStats(object):
+
+    """
+    Performance figures collected by ParserReplay.
+    """
+
+    def __init__(self):
+        self.input_count = 0
+        self.input_bytes = 0
+        self.failed_count = 0
+        self.row_count = 0
+        self.total_time = 0.0
+        # list of (<per-row time of an input>, <number of rows of the input>)
+        self.per_row_times = []
+        self.max_rss_kb_before = _get_max_rss_kb()
+        self.max_rss_kb_after = None
+
+    def register_input(self, body, row_count, elapsed):
+        self.input_count += 1
+        self.input_bytes += len(body)
+        self.row_count += row_count
+        self.total_time += elapsed
+        if row_count:
+            self.per_row_times.append((elapsed / row_count, row_count))
+
+    def register_failure(self, body):
+        self.input_count += 1
+        self.input_bytes += len(body)
+        self.failed_count += 1
+
+    def finish(self):
+        self.max_rss_kb_after = _get_max_rss_kb()
+
+    def as_dict(self):
+        return {
+            'inputs': self.input_count,
+            'input_bytes': self.input_bytes,
+            'failed_inputs': self.failed_count,
+            'rows': self.row_count,
+            'total_time_s': self.total_time,
+            'rows_per_s': (self.row_count / self.total_time if self.total_time
+                           else None),
+            'row_time_ms_mean': self._get_row_time_ms(None),
+            'row_time_ms_median': self._get_row_time_ms(0.5),
+            'row_time_ms_p95': self._get_row_time_ms(0.95),
+            'row_time_ms_max': self._get_row_time_ms(1.0),
+            'max_rss_kb_before': self.max_rss_kb_before,
+            'max_rss_kb_after': self.max_rss_kb_after,
+        }
+
+    def _get_row_time_ms(self, quantile):
+        if not self.row_count:
+            return None
+        if quantile is None:
+            return 1000.0 * self.total_time / self.row_count
+        # (each per-row time is weighted by the number of rows it concerns)
+        threshold = quantile * self.row_count
+        cumulative = 0
+        for row_time, row_count in sorted(self.per_row_times):
+            cumulative += row_count
+            if cumulative >= threshold:
+                return 1000.0 * row_time
+        return 1000.0 * max(self.per_row_times)[0]
+
+    def format_report(self):
+        d = self.as_dict()
+        lines = [
+            'inputs:             {inputs} ({input_bytes} bytes, '
+            '{failed_inputs} failed)',
+            'output rows:        {rows}',
+            'total parse time:   {total_time_s:.3f} s',
+        ]
+        if d['rows']:
+            lines.extend([
+                'rows per second:    {rows_per_s:.1f}',
+                'per-row time [ms]:  mean {row_time_ms_mean:.4f}, '
+                'median {row_time_ms_median:.4f}, '
+                'p95 {row_time_ms_p95:.4f}, '
+                'max {row_time_ms_max:.4f}',
+            ])
+        lines.append('max RSS [kB]:       {max_rss_kb_before} (before), '
+                     '{max_rss_kb_after} (after)')
+        return '\n'.join(lines).format(**d)
+
+
+class ParserReplay(object):
+
+    """
+    Feed raw bodies into a parser, without any AMQP communication.
+
+    Constructor args/kwargs:
+        `parser_class`:
+            The parser class (a concrete BaseParser subclass).
+
+    Constructor kwargs (optional):
+        `routing_key` (str):
+            The stand-in input routing key; by default the parser's
+            `default_binding_key` is used.
+        `headers` (dict):
+            Stand-in custom AMQP headers (e.g., {'meta': {...}});
+            default: empty.
+        `timestamp` (int):
+            Stand-in value of the `timestamp` AMQP property; if not
+            given, the modification time of each input file is used
+            (for the replay_file() method; for the replay() method the
+            current time is used).
+
+    The stand-in `message_id` AMQP property is the MD5 hex digest of
+    the input body -- so, provided that `timestamp` is specified, the
+    output for given inputs is deterministic (and can be compared with
+    the output of another run, e.g., in a regression test).
+
+    Note: the parser instance is created without calling its
+    __init__() (just as in parser unit tests), so no configuration
+    files or broker connection parameters are needed.
+    """
+
+    message_type = 'file'
+
+    def __init__(self, parser_class, routing_key=None, headers=None, timestamp=None):
+        self.parser_class = parser_class
+        self.routing_key = (routing_key if routing_key is not None
+                            else parser_class.default_binding_key)
+        self.headers = (headers if headers is not None else {})
+        self.timestamp = timestamp
+        self.parser = self.make_parser()
+
+    def make_parser(self):
+        with _argv_cleared():
+            return self.parser_class.__new__(self.parser_class)
+
+    def make_properties(self, body, timestamp=None):
+        if timestamp is None:
+            timestamp = (self.timestamp if self.timestamp is not None
+                         else int(time.time()))
+        return pika.BasicProperties(
+            message_id=hashlib.md5(body).hexdigest(),
+            type=self.message_type,
+            timestamp=timestamp,
+            headers=json.loads(json.dumps(self.headers)))  # (deep copy)
+
+    def replay(self, body, stats, output_callback=None, timestamp=None):
+        """
+        Feed the given raw body into the parser.
+
+        Args:
+            `body` (str):
+                The raw input data body.
+            `stats` (ReplayStats):
+                The object to register the performance figures in.
+
+        Kwargs:
+            `output_callback` (optional):
+                If not None: a callable to be called with the keyword
+                arguments `routing_key` and `body` for each output
+                message (instead of publishing it).
+            `timestamp` (optional):
+                See the description of the ParserReplay's constructor.
+
+        Returns:
+            True if the input has been processed successfully; False
+            if an exception was raised by the parser (then it is
+            logged and registered as a failure in `stats`).
+        """
+        outputs = []
+        properties = self.make_properties(body, timestamp)
+        self.parser.publish_output = lambda routing_key, body: outputs.append(
+            (routing_key, body))
+        start = time.time()
+        try:
+            self.parser.input_callback(self.routing_key, body, properties)
+        except Exception as exc:
+            LOGGER.error('parser %s failed to process input with message id %r: %s',
+                         self.parser_class.__name__,
+                         properties.message_id,
+                         make_exc_ascii_str(exc))
+            stats.register_failure(body)
+            return False
+        finally:
+            del self.parser.publish_output
+        stats.register_input(body, len(outputs), time.time() - start)
+        if output_callback is not None:
+            for routing_key, output_body in outputs:
+                output_callback(routing_key=routing_key, body=output_body)
+        return True
+
+    def replay_file(self, path, stats, output_callback=None):
+        with open(path, 'rb') as f:
+            body = f.read()
+        timestamp = (self.timestamp if self.timestamp is not None
+                     else int(osp.getmtime(path)))
+        return self.replay(body, stats, output_callback, timestamp)
+
+
+#
+# Script stuff
+
+def get_arg_parser():
+    arg_parser = argparse.ArgumentParser(
+        description=('Feed raw data from local files into an n6 parser '
+                     '(without any AMQP communication), write the output '
+                     'to a local file and report performance figures.'))
+    arg_parser.add_argument(
+        'parser',
+        help=('parser class name (e.g., AbuseChFeodoTrackerParser) '
+              'or parser script name suffix (e.g., abusechfeodotracker)'))
+    arg_parser.add_argument(
+        'paths',
+        nargs='+',
+        metavar='PATH',
+        help=('input file (containing one raw message body), or '
+              'directory (all its non-hidden files are taken)'))
+    arg_parser.add_argument(
+        '-o', '--output',
+        help=('output file path (each output message body is written '
+              'in a separate line); if not given, the output is discarded'))
+    arg_parser.add_argument(
+        '-r', '--routing-key',
+        help="input routing key (default: parser's default binding key)")
+    arg_parser.add_argument(
+        '-H', '--header',
+        action='append',
+        default=[],
+        type=parse_header_arg,
+        metavar='KEY=VALUE',
+        help=('custom AMQP header (VALUE is parsed as JSON, if possible); '
+              'can be given multiple times, e.g.: '
+              """-H 'meta={"http_last_modified": "2020-01-01 00:00:00"}'"""))
+    arg_parser.add_argument(
+        '-t', '--timestamp',
+        type=parse_timestamp_arg,
+        help=('AMQP `timestamp` property value (UNIX time); default: '
+              'the modification time of each input file (specify it '
+              'to get output that is reproducible between runs)'))
+    arg_parser.add_argument(
+        '-n', '--repeat',
+        type=int,
+        default=1,
+        metavar='N',
+        help=('replay all inputs N times (default: 1; output is written '
+              'only during the first pass)'))
+    arg_parser.add_argument(
+        '--json-report',
+        action='store_true',
+        help='print the report (to stdout) as JSON')
+    return arg_parser
+
+
+def run(parser_class, paths, output=None, routing_key=None, headers=None,
+        timestamp=None, repeat=1):
+    replay = ParserReplay(parser_class,
+                          routing_key=routing_key,
+                          headers=headers,
+                          timestamp=timestamp)
+    input_paths = list(iter_input_paths(paths))
+    stats = ReplayStats()
+    output_file = (open(output, 'wb') if output is not None else None)
+    try:
+        for pass_no in xrange(repeat):
+            if output_file is not None and pass_no == 0:
+                def output_callback(routing_key, body):
+                    output_file.write(body)
+                    output_file.write('\n')
+            else:
+                output_callback = None
+            for path in input_paths:
+                replay.replay_file(path, stats, output_callback)
+    finally:
+        if output_file is not None:
+            output_file.close()
+    stats.finish()
+    return stats
+
+
+def main():
+    arg_parser = get_arg_parser()
+    args = arg_parser.parse_args()
+    if args.repeat < 1:
+        arg_parser.error('the --repeat value must be a positive integer')
+    # (note: no n6 logging configuration files are needed)
+    logging.basicConfig()
+    try:
+        parser_class = get_parser_class(args.parser)
+    except ValueError as exc:
+        arg_parser.error(make_exc_ascii_str(exc))
+    stats = run(parser_class, args.paths,
+                output=args.output,
+                routing_key=args.routing_key,
+                headers=dict(args.header),
+                timestamp=args.timestamp,
+                repeat=args.repeat)
+    if args.json_report:
+        print json.dumps(stats.as_dict(), sort_keys=True, indent=4)
+    else:
+        print >> sys.stderr, stats.format_report()
+    sys.exit(1 if stats.failed_count else 0)
+
+
+if __name__ == "__main__":
+    main()
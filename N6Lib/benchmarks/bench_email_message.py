@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+"""
+Benchmark: getting files from multi-attachment messages with EmailMessage.
+
+Generates a message with one small CSV attachment and several large
+ZIP and GZip attachments, and then measures the time and the peak
+memory usage of: getting the CSV file, getting the first of several
+matching files, getting (the first file from) one of the ZIP archives,
+getting one (matching) file from each ZIP archive and getting all files
+(both with multi-file unpacking). Each case is run in a separate
+(forked) process, so that its peak memory usage can be measured
+separately.
+
+Usage:
+
+    python bench_email_message.py [--archives N] [--archive-members N]
+        [--member-size N]
+"""
+
+import argparse
+import gzip
+import logging
+import os
+import random
+import resource
+import time
+import zipfile
+from cStringIO import StringIO
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from n6lib.email_message import EmailMessage
+
+
+def make_file_content(size, rnd):
+    lines = []
+    total = 0
+    while total < size:
+        line = '"{}.{}.{}.{}","2020-01-01 00:00:00","{:016x}"\n'.format(
+            rnd.randrange(256), rnd.randrange(256), rnd.randrange(256), rnd.randrange(256),
+            rnd.getrandbits(64))
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines)
+
+
+def make_zip(names_and_contents):
+    f = StringIO()
+    with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zfile:
+        for name, content in names_and_contents:
+            zfile.writestr(name, content)
+    return f.getvalue()
+
+
+def make_gzip(content):
+    f = StringIO()
+    with gzip.GzipFile(fileobj=f, mode='wb') as gzfile:
+        gzfile.write(content)
+    return f.getvalue()
+
+
+def make_attachment(filename, content):
+    part = MIMEApplication(content)
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    return part
+
+
+def make_message(archive_count, archive_member_count, member_size):
+    rnd = random.Random(42)
+    mime_msg = MIMEMultipart()
+    mime_msg.attach(MIMEText('Some report...'))
+    for i in xrange(archive_count):
+        mime_msg.attach(make_attachment('archive-{}.zip'.format(i), make_zip(
+            ('file-{}.csv'.format(j), make_file_content(member_size, rnd))
+            for j in xrange(archive_member_count))))
+        mime_msg.attach(make_attachment('data-{}.csv.gz'.format(i), make_gzip(
+            make_file_content(member_size, rnd))))
+    mime_msg.attach(make_attachment('report.csv', make_file_content(1000, rnd)))
+    return mime_msg.as_string()
+
+
+def run_in_child(func, *args):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        max_rss_kb_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        func(*args)
+        duration = time.time() - start
+        max_rss_kb_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, '{} {}'.format(duration, max_rss_kb_after - max_rss_kb_before))
+        os._exit(0)
+    os.close(write_fd)
+    result = os.read(read_fd, 1000)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    duration, max_rss_kb_growth = result.split()
+    return float(duration), int(max_rss_kb_growth)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--archives', type=int, default=5)
+    arg_parser.add_argument('--archive-members', type=int, default=4)
+    arg_parser.add_argument('--member-size', type=int, default=5 * 2 ** 20)
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    msg = EmailMessage.from_string(make_message(args.archives,
+                                                args.archive_members,
+                                                args.member_size))
+    cases = [
+        ('get the small CSV file',
+         lambda: msg.get_matching_file_content(r'\Areport\.csv\Z')),
+        ('get the first of matching files',
+         lambda: msg.get_matching_file_content(r'\.csv')),
+        ('get the first file from a ZIP',
+         lambda: msg.get_matching_file_content(r'\Aarchive-0\.zip\Z')),
+        ('get the first file from each ZIP',
+         lambda: list(msg.iter_filenames_and_contents(multifile_unpacking=True,
+                                                      filename_regex=r'/file-0\.csv\Z'))),
+        ('get all files',
+         lambda: list(msg.iter_filenames_and_contents(multifile_unpacking=True))),
+    ]
+    print ('{} ZIP archives (each with {} files) + {} GZip files, '
+           'each file size: {} bytes'.format(args.archives, args.archive_members,
+                                              args.archives, args.member_size))
+    print '  {:<32} {:>10} {:>16}'.format('', 'time', 'peak RSS growth')
+    for label, func in cases:
+        duration, max_rss_kb_growth = run_in_child(func)
+        print '  {:<32} {:>9.3f}s {:>13} KiB'.format(label, duration, max_rss_kb_growth)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+"""
+Benchmark: FilePagedSequence vs. CompactFilePagedSequence.
+
+Measures the time of: appending items (write), sequential reading
+and random reading -- for sequences of JSON strings (i.e., what
+parsers keep in their working sequences) and of dicts.
+
+Usage:
+
+    python bench_file_paged_sequence.py [--items N] [--page-size N]
+        [--max-resident-pages N]
+"""
+
+import argparse
+import json
+import random
+import time
+
+from n6lib.common_helpers import (
+    CompactFilePagedSequence,
+    FilePagedSequence,
+)
+
+
+def make_items(count, as_json):
+    rnd = random.Random(42)
+    for i in xrange(count):
+        item = {
+            'id': '{:032x}'.format(rnd.getrandbits(128)),
+            'source': 'example-source.channel',
+            'category': 'cnc',
+            'address': [{'ip': '10.{}.{}.{}'.format(i % 256, i // 256 % 256, rnd.randrange(256))}],
+            'time': '2020-01-01 00:00:00',
+            'url': 'http://example.com/{}/{}'.format(i, 'x' * rnd.randrange(100)),
+        }
+        yield (json.dumps(item) if as_json else item)
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def bench(seq_factory, items, random_indexes):
+    with seq_factory() as seq:
+        def write():
+            for item in items:
+                seq.append(item)
+        def read_sequentially():
+            for _ in seq:
+                pass
+        def read_randomly():
+            for i in random_indexes:
+                seq[i]
+        return (timed(write),
+                timed(read_sequentially),
+                timed(read_randomly))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--items', type=int, default=200000)
+    arg_parser.add_argument('--page-size', type=int, default=1000)
+    arg_parser.add_argument('--max-resident-pages', type=int, default=4)
+    arg_parser.add_argument('--random-reads', type=int, default=2000)
+    args = arg_parser.parse_args()
+
+    rnd = random.Random(0)
+    random_indexes = [rnd.randrange(args.items) for _ in xrange(args.random_reads)]
+    variants = [
+        ('FilePagedSequence',
+         lambda: FilePagedSequence(page_size=args.page_size)),
+        ('CompactFilePagedSequence',
+         lambda: CompactFilePagedSequence(page_size=args.page_size,
+                                          max_resident_pages=args.max_resident_pages)),
+    ]
+    print ('{} items, page size: {}, max resident pages (compact): {}, '
+           'random reads: {}'.format(args.items, args.page_size,
+                                     args.max_resident_pages, args.random_reads))
+    for items_label, as_json in [('JSON strings', True), ('dicts', False)]:
+        items = list(make_items(args.items, as_json))
+        print
+        print '{}:'.format(items_label)
+        print '  {:<26} {:>10} {:>10} {:>10}'.format('', 'write', 'seq. read', 'rand. read')
+        for label, seq_factory in variants:
+            results = bench(seq_factory, items, random_indexes)
+            print '  {:<26} {:>9.3f}s {:>9.3f}s {:>9.3f}s'.format(label, *results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+"""
+Benchmark: pickle file vs. SQLiteStateStore as a collector state store.
+
+Simulates a collector whose state includes a growing set of handled
+items (such as the sets of handled payload filenames): for each of
+the given state sizes, measures the time of saving the state after
+adding a small batch of new items to it (that is what collectors
+do repeatedly), and the time of loading the state.
+
+Usage:
+
+    python bench_state_store.py [--sizes N,N,...] [--batch N]
+"""
+
+import argparse
+import cPickle
+import os
+import os.path as osp
+import shutil
+import tempfile
+import time
+
+from n6lib.state_store import SQLiteStateStore
+
+
+def make_state(size):
+    return {
+        'newest_row_time': '2020-01-01 00:00:00',
+        'handled': set('{:08}.payload.bin'.format(i) for i in xrange(size)),
+    }
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+class PickleFileStore(object):
+
+    def __init__(self, path):
+        self._path = path
+
+    def load(self):
+        with open(self._path, 'rb') as f:
+            return cPickle.load(f)
+
+    def save(self, state):
+        with open(self._path, 'wb') as f:
+            cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        pass
+
+
+def bench(store_factory, size, batch):
+    store = store_factory()
+    try:
+        store.save(make_state(size))
+        state = store.load()
+        next_i = size
+        save_times = []
+        for _ in xrange(5):
+            for i in xrange(next_i, next_i + batch):
+                state['handled'].add('{:08}.payload.bin'.format(i))
+            next_i += batch
+            save_times.append(timed(store.save, state))
+        load_time = timed(store.load)
+    finally:
+        store.close()
+    return sum(save_times) / len(save_times), load_time
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--sizes', default='1000,10000,100000,500000')
+    arg_parser.add_argument('--batch', type=int, default=10)
+    args = arg_parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        variants = [
+            ('pickle file',
+             lambda: PickleFileStore(osp.join(tmp_dir, 'state.pickle'))),
+            ('SQLiteStateStore',
+             lambda: SQLiteStateStore(osp.join(tmp_dir, 'state.sqlite'))),
+        ]
+        print 'items added between saves: {}'.format(args.batch)
+        print '  {:<10} {:<18} {:>12} {:>12}'.format('size', '', 'save', 'load')
+        for size in sizes:
+            for label, store_factory in variants:
+                for name in os.listdir(tmp_dir):
+                    os.remove(osp.join(tmp_dir, name))
+                save_time, load_time = bench(store_factory, size, args.batch)
+                print '  {:<10} {:<18} {:>11.4f}s {:>11.4f}s'.format(
+                    size, label, save_time, load_time)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,7 @@ import cPickle
 import functools
 import hashlib
 import itertools
+import marshal
 import operator
 import os
 import os.path as osp
@@ -29,6 +30,7 @@ import time
 import traceback
 import weakref
 from importlib import import_module
+from multiprocessing.pool import ThreadPool
 
 from pkg_resources import cleanup_resources
 from pyramid.decorator import reify
@@ -855,6 +857,191 @@ class FilePagedSequence(collections.MutableSequence):
         return m
 
 
+class CompactFilePagedSequence(FilePagedSequence):
+
+    """
+    A FilePagedSequence variant that uses a compact page storage format.
+
+    The interface is the same as FilePagedSequence's one, except that
+    the constructor accepts an additional argument: `max_resident_pages`
+    -- being the maximum number of pages kept in memory at the same
+    time (its default value is 4; it must be at least 1).
+
+    Differences in the storage:
+
+    * pages that consist only of `str`/`unicode` items (such as
+      serialized events in parsers) are stored in the compact `marshal`
+      format, which is cheaper to load than pickle (other pages are
+      still pickled, as only pickle supports arbitrary item types);
+
+    * all pages are written to one append-only data file (always
+      at its end, so writes are sequential);
+
+    * up to `max_resident_pages` recently used pages are kept in
+      memory; a page is written to disk only when it is evicted from
+      memory and has been modified since it was loaded (so, e.g.,
+      re-reading already written pages does not cause any writes).
+
+    Note that a modified page is written again (at the end of the data
+    file), so the stale version of it occupies some disk space until
+    the sequence is cleared or closed.
+
+    >>> seq = CompactFilePagedSequence(page_size=2, max_resident_pages=2)
+    >>> seq.extend([b'foo', u'b\xe1r', {'a': [None]}, 42, ('x', 4.5)])
+    >>> sorted(seq._resident_pages), sorted(seq._page_locations)
+    ([1, 2], [0])
+    >>> sorted(os.listdir(seq._dir))  # (one data file for all pages)
+    ['data']
+    >>> len(seq)
+    5
+    >>> list(seq) == [b'foo', u'b\xe1r', {'a': [None]}, 42, ('x', 4.5)]
+    True
+    >>> type(seq[0]), type(seq[1])
+    (<type 'str'>, <type 'unicode'>)
+    >>> data_file_size = osp.getsize(osp.join(seq._dir, 'data'))
+    >>> list(seq) == list(seq)   # re-reading -> no writes
+    True
+    >>> osp.getsize(osp.join(seq._dir, 'data')) == data_file_size
+    True
+
+    >>> seq[0] = b'spam'
+    >>> seq[-1] = b'ham'
+    >>> seq.pop()
+    'ham'
+    >>> seq.append(43)
+    >>> list(seq) == [b'spam', u'b\xe1r', {'a': [None]}, 42, 43]
+    True
+    >>> osp.getsize(osp.join(seq._dir, 'data')) > data_file_size
+    True
+
+    >>> seq.clear()
+    >>> list(seq)
+    []
+    >>> osp.getsize(osp.join(seq._dir, 'data'))
+    0
+    >>> seq.extend('abcde')
+    >>> list(seq)
+    ['a', 'b', 'c', 'd', 'e']
+    >>> seq.close()
+    >>> list(seq)
+    []
+    >>> osp.exists(seq._dir)
+    False
+
+    >>> with CompactFilePagedSequence('abc', page_size=3) as seq2:
+    ...     list(seq2)
+    ...     seq2._filesystem_used()   # all items in one page -> no disk op.
+    ...
+    ['a', 'b', 'c']
+    False
+
+    >>> CompactFilePagedSequence(max_resident_pages=0)   # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+      ...
+    ValueError: `max_resident_pages` must be at least 1 (got: 0)
+    """
+
+    # (note: `marshal` is used only for pages whose *all* items are of
+    # these exact types, as it does not preserve subclasses of them)
+    _MARSHALLED_ITEM_TYPES = (str, unicode)
+
+    _TAG_MARSHALLED = 'm'
+    _TAG_PICKLED = 'p'
+
+    def __init__(self, iterable=(), page_size=1000, max_resident_pages=4):
+        if max_resident_pages < 1:
+            raise ValueError('`max_resident_pages` must be at least 1 (got: {!r})'
+                             .format(max_resident_pages))
+        self._max_resident_pages = max_resident_pages
+        # page number -> page data (a list), the most recently used last
+        self._resident_pages = collections.OrderedDict()
+        # numbers of the resident pages modified since they were loaded
+        self._dirty_page_nos = set()
+        # page number -> (offset, size) of the page within the data file
+        self._page_locations = {}
+        super(CompactFilePagedSequence, self).__init__(iterable, page_size)
+
+    def __setitem__(self, index, value):
+        super(CompactFilePagedSequence, self).__setitem__(index, value)
+        self._dirty_page_nos.add(self._cur_page_no)
+
+    def append(self, value):
+        super(CompactFilePagedSequence, self).append(value)
+        self._dirty_page_nos.add(self._cur_page_no)
+
+    def pop(self, index=-1):
+        value = super(CompactFilePagedSequence, self).pop(index)
+        self._dirty_page_nos.add(self._cur_page_no)
+        return value
+
+    def clear(self):
+        super(CompactFilePagedSequence, self).clear()
+        self._resident_pages.clear()
+        self._dirty_page_nos.clear()
+        self._page_locations.clear()
+        if self._data_file_opened():
+            self._data_file.seek(0)
+            self._data_file.truncate()
+
+    def close(self):
+        if not self._closed:
+            self.clear()
+            if self._data_file_opened():
+                self._data_file.close()
+        super(CompactFilePagedSequence, self).close()
+
+    #
+    # Non-public stuff
+
+    @reify
+    def _data_file(self):
+        return open(osp.join(self._dir, 'data'), 'w+b')
+
+    def _data_file_opened(self):
+        return '_data_file' in self.__dict__ and not self._data_file.closed
+
+    def _switch_to(self, page_no, new=False):
+        if new:
+            page_data = []
+            self._resident_pages.pop(page_no, None)
+            self._dirty_page_nos.add(page_no)
+        elif page_no in self._resident_pages:
+            page_data = self._resident_pages.pop(page_no)
+        else:
+            page_data = self._load_page(page_no)
+        # (re)inserting as the most recently used one
+        self._resident_pages[page_no] = page_data
+        while len(self._resident_pages) > self._max_resident_pages:
+            evicted_page_no, evicted_page_data = self._resident_pages.popitem(last=False)
+            if evicted_page_no in self._dirty_page_nos:
+                self._save_page(evicted_page_no, evicted_page_data)
+                self._dirty_page_nos.discard(evicted_page_no)
+        self._cur_page_data = page_data
+        self._cur_page_no = page_no
+
+    def _save_page(self, page_no, page_data):
+        if all(type(item) in self._MARSHALLED_ITEM_TYPES for item in page_data):
+            page_bytes = self._TAG_MARSHALLED + marshal.dumps(page_data)
+        else:
+            page_bytes = self._TAG_PICKLED + cPickle.dumps(page_data, -1)
+        f = self._data_file
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        f.write(page_bytes)
+        self._page_locations[page_no] = (offset, len(page_bytes))
+
+    def _load_page(self, page_no):
+        offset, size = self._page_locations[page_no]
+        f = self._data_file
+        f.seek(offset)
+        page_bytes = f.read(size)
+        tag = page_bytes[0]
+        if tag == self._TAG_MARSHALLED:
+            return marshal.loads(page_bytes[1:])
+        assert tag == self._TAG_PICKLED
+        return cPickle.loads(page_bytes[1:])
+
+
 class DictWithSomeHooks(dict):
 
     """
@@ -2284,6 +2471,60 @@ def exiting_on_exception(func=None,
     return wrapper
 
 
+def iter_results_concurrently(func, iterable, max_workers):
+    """
+    Like `itertools.imap()` (for one iterable), but the `func` calls
+    are made concurrently -- by at most `max_workers` threads.
+
+    The results are yielded in the order of the corresponding input
+    items. If any `func` call raises an exception, it is propagated
+    (when the corresponding result is to be yielded) and all pending
+    calls are abandoned.
+
+    The input items are consumed lazily, and at most `2 * max_workers`
+    results are kept waiting to be yielded (so the memory usage does
+    not depend on the total number of items).
+
+    If `max_workers` is less than 2, the calls are made sequentially,
+    in the current thread.
+
+    >>> import time
+    >>> def slowly_square(x):
+    ...     time.sleep(0.05 * (5 - x))
+    ...     return x * x
+    ...
+    >>> list(iter_results_concurrently(slowly_square, xrange(5), max_workers=3))
+    [0, 1, 4, 9, 16]
+    >>> list(iter_results_concurrently(slowly_square, xrange(5), max_workers=1))
+    [0, 1, 4, 9, 16]
+
+    >>> it = iter_results_concurrently(lambda x: 1 // x, [1, 0, 2], max_workers=3)
+    >>> next(it)
+    1
+    >>> next(it)  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+      ...
+    ZeroDivisionError: integer division or modulo by zero
+    """
+    if max_workers < 2:
+        for item in iterable:
+            yield func(item)
+        return
+    max_pending = 2 * max_workers
+    pending = collections.deque()
+    pool = ThreadPool(max_workers)
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def picklable(func_or_class):
     """
     Make the given (possibly non-top-level) function or class picklable.
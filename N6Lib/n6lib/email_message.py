@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-# Copyright (c) 2013-2019 NASK. All rights reserved.
+# Copyright (c) 2013-2020 NASK. All rights reserved.
 #
 # For some code in this module:
 # Copyright (c) 2001-2013 Python Software Foundation. All rights reserved.
@@ -8,19 +8,22 @@
 
 import base64
 import binascii
+import contextlib
 import datetime
 import email.iterators
 import email.message
 import email.utils
+import functools
 import os
 import quopri
 import re
 import uu
 import zipfile
+import zlib
 from cStringIO import StringIO
 
 from n6lib.log_helpers import get_logger
-from n6lib.unpacking_helpers import iter_unzip_from_string, gunzip_from_string
+from n6lib.unpacking_helpers import gunzip_from_string
 
 
 LOGGER = get_logger(__name__)
@@ -60,6 +63,9 @@ class EmailMessage(email.message.Message):
         '.gz',
     ])
 
+    # (the "encrypted" bit of a ZIP archive file's general purpose flags)
+    _ZIP_ENCRYPTED_FLAG = 0x1
+
     #
     # Instantiation helpers
 
@@ -110,22 +116,24 @@ class EmailMessage(email.message.Message):
                                   maintype=None, subtype=None):
         messages = self.iter_matching_messages(filename_regex,
                                                maintype, subtype)
-        items = ((name, content)
+        # (note: the content of a file is decoded/unpacked only if
+        # that file is the one whose content is to be returned)
+        items = (item
                  for msg in messages
-                     for name, content in msg.iter_filenames_and_contents())
+                     for item in msg.iter_filenames_and_content_getters())
         first_item = next(items, None)
         if first_item is None:
             raise NoMatchingFileError('No file matches the criteria: '
                                       'filename_regex={0!r}, maintype={1!r}, '
                                       'subtype={2!r}'.format(
                                           filename_regex, maintype, subtype))
-        name, content = first_item
+        name, get_content = first_item
         second_item = next(items, None)
         if second_item is not None:
             ### CR: rethink if an exception shouldn't be raised
             LOGGER.warning('More than one file matched but only '
                            'one (named: %r) will be used', name)
-        return content
+        return get_content()
 
     def iter_matching_messages(self, filename_regex=None,
                                maintype=None, subtype=None):
@@ -141,61 +149,165 @@ class EmailMessage(email.message.Message):
                 if (filename is not None and
                     filename_regex.search(filename) is not None))
 
-    def iter_filenames_and_contents(self, multifile_unpacking=False):
+    def iter_filenames_and_contents(self, multifile_unpacking=False,
+                                    filename_regex=None):
+        """
+        Iterate over files (attachments) contained in the message.
+
+        Kwargs:
+            `multifile_unpacking` (bool; default: False):
+                If false -- for a ZIP archive, only the first file from
+                the archive is yielded (named as the archive); if true
+                -- all files from the archive are yielded (named
+                '<archive name>/<file name>'), except those which
+                turn out to be broken (skipped, with a warning).
+            `filename_regex` (optional):
+                A regular expression (a string or a compiled regex);
+                if specified, only files whose (yielded) names match
+                it are yielded (other ones are neither decoded nor
+                unpacked).
+
+        Yields:
+            Pairs: (<file name or None>, <file content>) -- the content
+            being decoded and (if it is a GZip file or ZIP archive)
+            unpacked.
+        """
+        for name, get_content in self.iter_filenames_and_content_getters(
+                multifile_unpacking=multifile_unpacking,
+                filename_regex=filename_regex):
+            try:
+                content = get_content()
+            except zipfile.BadZipfile as exc:
+                # (only a file from a ZIP archive, with `multifile_unpacking`)
+                LOGGER.warning('Skipping file %r (%s)', name, exc)
+                continue
+            LOGGER.debug('Yielding file %r...', name)
+            yield name, content
+
+    def iter_filenames_and_content_getters(self, multifile_unpacking=False,
+                                           filename_regex=None):
+        """
+        Like iter_filenames_and_contents() but lazy.
+
+        Yields:
+            Pairs: (<file name or None>, <argumentless callable that
+            returns the file content>) -- the content is decoded and
+            unpacked only when the callable is called.
+
+        Note: for a ZIP archive, its file names can be obtained only
+        after decoding the payload of the archive (but the files are
+        not decompressed until their contents are requested). If any
+        of the files to be yielded is encrypted, the archive is yielded
+        as a whole (with its raw payload as the content). If a file
+        turns out to be broken (e.g., has a bad CRC) when its content
+        is requested: with `multifile_unpacking`, `zipfile.BadZipfile`
+        is raised by the callable; otherwise, the raw payload of the
+        archive is returned (as the content of the archive).
+        """
+        if isinstance(filename_regex, basestring):
+            filename_regex = re.compile(filename_regex)
         if self.is_multipart():
             for msg in self.get_payload():
                 # recursive calls on sub-messages
                 # (NOTE that all of them are instances of this class
                 # because all have been created within a call of this
                 # class' from_string()/from_file())
-                for name, content in msg.iter_filenames_and_contents(
-                             multifile_unpacking=multifile_unpacking):
-                    yield name, content
+                for name, get_content in msg.iter_filenames_and_content_getters(
+                             multifile_unpacking=multifile_unpacking,
+                             filename_regex=filename_regex):
+                    yield name, get_content
+            return
+        content_type = self.get_content_type()
+        filename = self.get_filename(None)
+        ext = os.path.splitext(filename or '')[1].lower()
+        if (ext in self.GZIP_FILENAME_EXTENSIONS or
+              content_type in self.GZIP_CONTENT_TYPES):
+            if self._filename_matches(filename, filename_regex):
+                yield filename, functools.partial(self._get_gunzipped_payload, filename)
+        elif (ext in self.ZIP_FILENAME_EXTENSIONS or
+              content_type in self.ZIP_CONTENT_TYPES):
+            if multifile_unpacking or self._filename_matches(filename, filename_regex):
+                for name, get_content in self._iter_zip_member_names_and_content_getters(
+                             filename, multifile_unpacking, filename_regex):
+                    yield name, get_content
+        elif self._filename_matches(filename, filename_regex):
+            yield filename, self.get_decoded_payload
+
+    @staticmethod
+    def _filename_matches(name, filename_regex):
+        return (filename_regex is None or
+                (name is not None and filename_regex.search(name) is not None))
+
+    def _get_gunzipped_payload(self, filename):
+        payload = self.get_decoded_payload()
+        try:
+            return gunzip_from_string(payload)
+        except (IOError, EOFError) as exc:
+            LOGGER.warning('Could not decompress file %r using GZip '
+                           'decoder (%s)', filename, exc)
+            return payload
+
+    def _iter_zip_member_names_and_content_getters(self, filename, multifile_unpacking,
+                                                   filename_regex):
+        payload = self.get_decoded_payload()
+        try:
+            with contextlib.closing(zipfile.ZipFile(StringIO(payload))) as zfile:
+                infos = zfile.infolist()
+        except zipfile.BadZipfile as exc:
+            LOGGER.warning('Could not unpack file %r using ZIP '
+                           'decoder (%s)', filename, exc)
+            if self._filename_matches(filename, filename_regex):
+                yield filename, lambda: payload
+            return
+        if not infos:
+            LOGGER.warning('No files in archive %r', filename)
+            # yielding nothing
+            return
+        if multifile_unpacking:
+            # all (matching) files from the archive will be yielded
+            # (with their names prefixed with archive file name + '/')
+            name_pattern = (filename or '') + '/{0}'
+            names_and_infos = [
+                (name, info)
+                for name, info in ((name_pattern.format(os.path.basename(info.filename)), info)
+                                   for info in infos)
+                if self._filename_matches(name, filename_regex)]
         else:
-            content_type = self.get_content_type()
-            payload = self.get_decoded_payload()
-            filename = self.get_filename(None)
-            ext = os.path.splitext(filename or '')[1].lower()
-            # un-Gzip if necessary
-            if (ext in self.GZIP_FILENAME_EXTENSIONS or
-                  content_type in self.GZIP_CONTENT_TYPES):
-                try:
-                    payload = gunzip_from_string(payload)
-                except (IOError, EOFError) as exc:
-                    LOGGER.warning('Could not decompress file %r using GZip '
-                                   'decoder (%s)', filename, exc)
-            # un-ZIP if necessary
-            elif (ext in self.ZIP_FILENAME_EXTENSIONS or
-                  content_type in self.ZIP_CONTENT_TYPES):
-                try:
-                    names_and_contents = list(iter_unzip_from_string(payload))
-                except (zipfile.BadZipfile, RuntimeError) as exc:
-                    LOGGER.warning('Could not unpack file %r using ZIP '
-                                   'decoder (%s)', filename, exc)
-                else:
-                    if not names_and_contents:
-                        LOGGER.warning('No files in archive %r', filename)
-                        # yielding nothing
-                        return
-                    if multifile_unpacking:
-                        # all files from the archive will be yielded (with
-                        # their names prefixed with archive file name + '/')
-                        name_pattern = (filename or '') + '/{0}'
-                        for name, content in names_and_contents:
-                            yielded_name = name_pattern.format(name)
-                            LOGGER.debug('Yielding file %r...', yielded_name)
-                            yield yielded_name, content
-                        return
-                    # only one file from the archive will be yielded
-                    name, payload = names_and_contents[0]
-                    if len(names_and_contents) > 1:
-                        LOGGER.warning('Archive %r contains more than '
-                                       'one file but only one (named '
-                                       '%r in the archive) will be '
-                                       'yielded as the payload of %r',
-                                       filename, name, filename)
-            LOGGER.debug('Yielding file %r...', filename)
-            yield filename, payload
+            # only one file from the archive will be yielded
+            if len(infos) > 1:
+                LOGGER.warning('Archive %r contains more than '
+                               'one file but only one (named '
+                               '%r in the archive) will be '
+                               'yielded as the payload of %r',
+                               filename, os.path.basename(infos[0].filename), filename)
+            names_and_infos = [(filename, infos[0])]
+        # (encrypted files are detected without decompressing anything --
+        # from the archive's central directory)
+        encrypted_names = [info.filename for _, info in names_and_infos
+                           if info.flag_bits & self._ZIP_ENCRYPTED_FLAG]
+        if encrypted_names:
+            LOGGER.warning('Could not unpack file %r using ZIP '
+                           'decoder (encrypted files: %s)',
+                           filename, ', '.join(map(repr, encrypted_names)))
+            if self._filename_matches(filename, filename_regex):
+                yield filename, lambda: payload
+            return
+        for name, info in names_and_infos:
+            yield name, functools.partial(self._get_unzipped_file_content,
+                                          filename, payload, info, multifile_unpacking)
+
+    @staticmethod
+    def _get_unzipped_file_content(filename, payload, info, multifile_unpacking):
+        try:
+            with contextlib.closing(zipfile.ZipFile(StringIO(payload))) as zfile:
+                return zfile.read(info)
+        except (zipfile.BadZipfile, RuntimeError, zlib.error) as exc:
+            if multifile_unpacking:
+                raise zipfile.BadZipfile('could not unpack file {0!r} from archive '
+                                         '{1!r} ({2})'.format(info.filename, filename, exc))
+            LOGGER.warning('Could not unpack file %r using ZIP '
+                           'decoder (%s)', filename, exc)
+            return payload
 
     def get_decoded_payload(self):
         """
@@ -8,6 +8,14 @@ from requests.packages.urllib3.util.retry import Retry
 from n6lib.datetime_helpers import parse_iso_datetime_to_utc
 
 
+class ResponseTooLargeError(ValueError):
+
+    """
+    Raised by `RequestPerformer` when the size of the response content
+    exceeds the `max_size` limit (see the `RequestPerformer` docs).
+    """
+
+
 class RequestPerformer(object):
 
     """
@@ -43,11 +51,22 @@ class RequestPerformer(object):
             print perf.session.cookies    # get cookies (as a CookieJar instance)
             # etc...
 
-    The (2) and (3) ways can be combined, except that -- if the `stream`
+    (4) using its *context manager* interface and the `iter_lines()`
+        method to process downloaded text data line by line, as soon as
+        consecutive chunks arrive (without keeping the whole content in
+        memory):
+
+        with RequestPerformer('GET', 'https://example.com',
+                              max_size=2 ** 30) as perf:
+            for line in perf.iter_lines():  # `line` is a str
+                process_line(line)
+
+    The (2), (4) and (3) ways can be combined, except that -- if the `stream`
     keyword argument is true (see below) -- you can **either** use the
-    *iterator* interface [see above: (2)] **or** get directly the `content`
-    attribute of the `response` attribute [see above: (3)], but should
-    **not** do both.
+    *iterator* interface [see above: (2)] **or** the `iter_lines()`
+    method [see above: (4)] **or** get directly the `content` attribute
+    of the `response` attribute [see above: (3)], but should **not** do
+    more than one of them.
 
     Apart from specifying the HTTP method and the URL, you can also pass in a
     lot of other arguments (see the constructor args/kwargs described below),
@@ -151,6 +170,19 @@ class RequestPerformer(object):
             Note: it is not necessarily the length of each yielded data
             chunk (because of decoding...).
 
+        `max_size` (int or `None`; default: `None`):
+            If not `None`, the maximum allowed size (in bytes) of the
+            response content. If the `Content-Length` response header
+            declares a greater size, `ResponseTooLargeError` is raised
+            immediately (when entering the `with` block); otherwise,
+            the size is checked as the content is being downloaded
+            (when iterating over the RequestPerformer instance or over
+            the result of `iter_lines()`) -- `ResponseTooLargeError`
+            is raised as soon as the limit is exceeded. Note that if
+            the `stream` argument is false, all content is downloaded
+            before its size is checked (so it is recommended to use
+            `max_size` only together with `stream=True`).
+
         `custom_session_attrs` (dict; default: `None`):
             Custom `requests.Session()` instance attribute values.
             (see:
@@ -161,6 +193,8 @@ class RequestPerformer(object):
             To be passed into `requests.Session.request()`.
 
     Exceptions raised by the constructor and/or methods:
+        * ResponseTooLargeError (a ValueError subclass) -- if `max_size`
+          was specified and the size of the response content exceeds it.
         * ValueError -- for:
             * unsupported `method`/`url` values;
             * `data` being a file-like object whose content's length
@@ -223,6 +257,7 @@ class RequestPerformer(object):
                  stream=True,
                  chunk_size=(2 ** 16),
                  custom_session_attrs=None,
+                 max_size=None,
                  **extra_request_kwargs):
 
         method = self._get_valid_method(method=method)
@@ -242,6 +277,7 @@ class RequestPerformer(object):
         self._retry_conf = self._get_retry_conf(retries=retries,
                                                 backoff_factor=backoff_factor)
         self._chunk_size = chunk_size if stream else None
+        self._max_size = max_size
 
     @classmethod
     def fetch(cls, *args, **kwargs):
@@ -256,12 +292,16 @@ class RequestPerformer(object):
             The downloaded content (str).
 
         Raises:
+            * ResponseTooLargeError: if `max_size` was specified and
+              the content is larger.
             * ValueError: for unsupported `method`/`url` values.
             * Any exception that can be raised by the `requests` or `urrlib3`
               libraries.
         """
         with RequestPerformer(*args, stream=False, **kwargs) as perf:
-            return perf.response.content
+            content = perf.response.content
+            perf._check_size(len(content))
+            return content
 
     def __enter__(self):
         self.session = requests.Session()
@@ -270,14 +310,20 @@ class RequestPerformer(object):
             self._set_up_retries()
             self.response = self.session.request(**self._request_kwargs)
             self.response.raise_for_status()
-            self._actual_iterator = self.response.iter_content(chunk_size=self._chunk_size)
+            self._check_declared_size()
+            self._actual_iterator = self._iter_content()
         except:
             self.session.close()
             raise
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.session.close()
+        try:
+            # (needed to release the connection if the content
+            # has not been downloaded entirely)
+            self.response.close()
+        finally:
+            self.session.close()
 
     def __iter__(self):
         return self
@@ -285,6 +331,30 @@ class RequestPerformer(object):
     def next(self):
         return next(self._actual_iterator)
 
+    def iter_lines(self):
+        """
+        Iterate over the content's lines, downloading it chunk by chunk.
+
+        Yields:
+            Consecutive lines (str), *without* the trailing newline
+            characters -- exactly the same items that would be got
+            with `self.response.content.split('\\n')` (in particular,
+            if the content ends with a newline, the last yielded line
+            is an empty string).
+
+        Note that this method consumes the *iterator* interface (see
+        the class docs), so those two ways should *not* be combined.
+        """
+        pending = ''
+        for chunk in self:
+            if pending:
+                chunk = pending + chunk
+            lines = chunk.split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line
+        yield pending
+
     def get_dt_header(self, header_key):
         """
         A helper method to retrieve a response header as a date+time.
@@ -318,6 +388,26 @@ class RequestPerformer(object):
                 pass
         return None
 
+    def _check_declared_size(self):
+        if self._max_size is not None:
+            declared_size = self.response.headers.get('Content-Length', '').strip()
+            if declared_size.isdigit():
+                self._check_size(int(declared_size))
+
+    def _check_size(self, size):
+        if self._max_size is not None and size > self._max_size:
+            raise ResponseTooLargeError(
+                'the size of the response content from {!r} exceeds '
+                'the limit of {} bytes'.format(self._request_kwargs['url'],
+                                               self._max_size))
+
+    def _iter_content(self):
+        size = 0
+        for chunk in self.response.iter_content(chunk_size=self._chunk_size):
+            size += len(chunk)
+            self._check_size(size)
+            yield chunk
+
     def _get_valid_method(self, method):
         method = method.upper()
         if method not in self.SUPPORTED_HTTP_METHODS:
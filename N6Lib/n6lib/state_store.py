@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+"""
+SQLite-based storage of (collector) state objects, being an alternative
+to pickling the whole state on every save.
+"""
+
+import cPickle
+import sqlite3
+import time
+
+from n6lib.log_helpers import get_logger
+
+
+LOGGER = get_logger(__name__)
+
+
+class StateNotFoundError(LookupError):
+    """Raised by SQLiteStateStore.load() if no state has been saved."""
+
+
+class SQLiteStateStore(object):
+
+    """
+    A store of a state object, backed by an SQLite database file.
+
+    The state object can be any picklable object. However, if it is
+    a `dict` (as states of most collectors are), it is not stored as
+    a whole but item by item:
+
+    * each item (key + value) is stored in its own row (indexed by the
+      pickled key), so saving the state causes writes only for the
+      items that have been added, removed or changed since the last
+      load/save;
+
+    * if a value is a `set` or `frozenset` (such as a set of handled
+      file names or of the newest rows), its members are stored in
+      separate rows as well, so that saving the state causes writes
+      only for the members that have been added or removed.
+
+    Each save is performed in one transaction, so it is atomic.
+
+    Constructor args:
+        `db_path`:
+            The path of the database file (it is created if needed).
+
+    Constructor kwargs:
+        `retention_period` (default: None):
+            None or the number of seconds; if specified, items of a
+            `dict` state that have not been changed for that long
+            are removed when the state is loaded (this option should
+            be used only if the keys of the state refer to things the
+            owner of the state will not need to know about when they
+            become that old).
+
+    >>> store = SQLiteStateStore(':memory:')
+    >>> store.is_empty()
+    True
+    >>> store.save({'newest_time': '2020-01-01', 'newest_rows': {'a', 'b'}})
+    >>> state = store.load()
+    >>> state == {'newest_time': '2020-01-01', 'newest_rows': {'a', 'b'}}
+    True
+    >>> state['newest_rows'].add('c')
+    >>> store.save(state)          # (just one row is written: 'c')
+    >>> store.load()['newest_rows'] == {'a', 'b', 'c'}
+    True
+    >>> store.save(['any', 'picklable', 'object'])
+    >>> store.load()
+    ['any', 'picklable', 'object']
+    >>> store.close()
+    """
+
+    _SCHEMA_SCRIPT = '''
+        CREATE TABLE IF NOT EXISTS state_meta (
+            name TEXT PRIMARY KEY,
+            value BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS state_item (
+            key BLOB PRIMARY KEY,
+            kind TEXT NOT NULL,
+            value BLOB,
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS state_item_updated ON state_item (updated);
+        CREATE TABLE IF NOT EXISTS state_set_member (
+            key BLOB NOT NULL,
+            member BLOB NOT NULL,
+            PRIMARY KEY (key, member)
+        );
+    '''
+
+    # values of the `layout` meta field
+    _WHOLE_LAYOUT = 'whole'   # the `whole_state` meta field contains the pickled state
+    _ITEMS_LAYOUT = 'items'   # the state is a dict stored in `state_item`/`state_set_member`
+
+    # values of `state_item.kind`
+    _PLAIN_KIND = 'plain'
+    _SET_KIND = 'set'
+    _FROZENSET_KIND = 'frozenset'
+
+    def __init__(self, db_path, retention_period=None):
+        self._db_path = db_path
+        self._retention_period = retention_period
+        self._conn = sqlite3.connect(db_path)
+        self._conn.text_factory = str
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(self._SCHEMA_SCRIPT)
+        # the current content of the database, as a dict that maps
+        # state keys to (<key blob>, <kind>, <value info>) tuples, where
+        # <value info> is the pickled value (for the "plain" kind) or a
+        # dict that maps set members to their blobs (for the set kinds);
+        # None means that the layout is not `_ITEMS_LAYOUT` (or that
+        # the database content has not been read yet)
+        self._stored_items = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def is_empty(self):
+        return self._get_layout() is None
+
+    def load(self):
+        """
+        Load the state.
+
+        Returns:
+            The state object (a new one on each call).
+
+        Raises:
+            StateNotFoundError -- if no state has been saved.
+        """
+        layout = self._get_layout()
+        if layout is None:
+            raise StateNotFoundError('no state stored in {!r}'.format(self._db_path))
+        if layout == self._WHOLE_LAYOUT:
+            self._stored_items = None
+            return cPickle.loads(self._get_meta('whole_state'))
+        assert layout == self._ITEMS_LAYOUT
+        if self._retention_period is not None:
+            self._remove_expired_items()
+        self._stored_items = self._read_stored_items()
+        return {key: self._make_value(kind, value_info)
+                for key, (_, kind, value_info) in self._stored_items.iteritems()}
+
+    def save(self, state):
+        """
+        Save the state (atomically).
+
+        Args:
+            `state`: any picklable object.
+        """
+        with self._conn:
+            if type(state) is dict:
+                self._save_items(state)
+            else:
+                self._save_whole(state)
+
+    #
+    # Private helpers
+
+    def _get_layout(self):
+        return self._get_meta('layout')
+
+    def _get_meta(self, name):
+        row = self._conn.execute(
+            'SELECT value FROM state_meta WHERE name = ?', (name,)).fetchone()
+        return (str(row[0]) if row is not None else None)
+
+    def _set_meta(self, name, value):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO state_meta (name, value) VALUES (?, ?)',
+            (name, sqlite3.Binary(value)))
+
+    def _remove_expired_items(self):
+        expiry_time = time.time() - self._retention_period
+        with self._conn:
+            self._conn.execute(
+                'DELETE FROM state_set_member WHERE key IN '
+                '(SELECT key FROM state_item WHERE updated < ?)', (expiry_time,))
+            removed_count = self._conn.execute(
+                'DELETE FROM state_item WHERE updated < ?', (expiry_time,)).rowcount
+        if removed_count:
+            LOGGER.info('Removed %d expired state item(s) from %r',
+                        removed_count, self._db_path)
+
+    def _read_stored_items(self):
+        stored_items = {}
+        members_by_key_blob = {}
+        for key_blob, member_blob in self._conn.execute(
+                'SELECT key, member FROM state_set_member'):
+            # (note: BLOB values are retrieved as `buffer` objects)
+            key_blob = str(key_blob)
+            member_blob = str(member_blob)
+            member = cPickle.loads(member_blob)
+            members_by_key_blob.setdefault(key_blob, {})[member] = member_blob
+        for key_blob, kind, value_blob in self._conn.execute(
+                'SELECT key, kind, value FROM state_item'):
+            key_blob = str(key_blob)
+            kind = str(kind)
+            if kind == self._PLAIN_KIND:
+                value_info = str(value_blob)
+            else:
+                value_info = members_by_key_blob.get(key_blob, {})
+            stored_items[cPickle.loads(key_blob)] = (key_blob, kind, value_info)
+        return stored_items
+
+    def _make_value(self, kind, value_info):
+        if kind == self._PLAIN_KIND:
+            return cPickle.loads(value_info)
+        if kind == self._SET_KIND:
+            return set(value_info)
+        assert kind == self._FROZENSET_KIND
+        return frozenset(value_info)
+
+    def _save_whole(self, state):
+        if self._get_layout() != self._WHOLE_LAYOUT:
+            self._clear()
+            self._set_meta('layout', self._WHOLE_LAYOUT)
+        self._set_meta('whole_state', self._dumps(state))
+
+    def _save_items(self, state):
+        if self._get_layout() != self._ITEMS_LAYOUT:
+            self._clear()
+            self._set_meta('layout', self._ITEMS_LAYOUT)
+            self._stored_items = {}
+        elif self._stored_items is None:
+            self._stored_items = self._read_stored_items()
+        now = time.time()
+        stored_items = self._stored_items
+        new_stored_items = {}
+        try:
+            for key, value in state.iteritems():
+                stored = stored_items.get(key)
+                new_stored_items[key] = self._save_item(key, value, stored, now)
+            for key in set(stored_items).difference(state):
+                self._delete_item(stored_items[key][0])
+        except:
+            # (the transaction will be rolled back, so the information
+            # about the database content needs to be read again)
+            self._stored_items = None
+            raise
+        self._stored_items = new_stored_items
+
+    def _save_item(self, key, value, stored, now):
+        if isinstance(value, frozenset):
+            kind = self._FROZENSET_KIND
+        elif isinstance(value, set):
+            kind = self._SET_KIND
+        else:
+            kind = self._PLAIN_KIND
+        if stored is not None and stored[1] != kind:
+            self._delete_item(stored[0])
+            stored = None
+        if stored is None:
+            key_blob = self._dumps(key)
+            old_value_info = (None if kind == self._PLAIN_KIND else {})
+        else:
+            key_blob, _, old_value_info = stored
+        if kind == self._PLAIN_KIND:
+            value_info = self._dumps(value)
+            changed = (value_info != old_value_info)
+            if changed:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO state_item (key, kind, value, updated) '
+                    'VALUES (?, ?, ?, ?)',
+                    (sqlite3.Binary(key_blob), kind, sqlite3.Binary(value_info), now))
+        else:
+            value_info, changed = self._save_set_members(key_blob, value, old_value_info)
+            if changed or stored is None:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO state_item (key, kind, value, updated) '
+                    'VALUES (?, ?, NULL, ?)',
+                    (sqlite3.Binary(key_blob), kind, now))
+        return key_blob, kind, value_info
+
+    def _save_set_members(self, key_blob, members, old_member_to_blob):
+        key_blob = sqlite3.Binary(key_blob)
+        added = members.difference(old_member_to_blob)
+        if len(members) - len(added) < len(old_member_to_blob):
+            removed = old_member_to_blob.viewkeys() - members
+        else:
+            removed = None   # (no need to compute it -- nothing removed)
+        if not (added or removed):
+            return old_member_to_blob, False
+        # (modifying it in place is OK: if the transaction fails,
+        # `_stored_items` is discarded -- see: `_save_items()`)
+        member_to_blob = old_member_to_blob
+        if removed:
+            self._conn.executemany(
+                'DELETE FROM state_set_member WHERE key = ? AND member = ?',
+                [(key_blob, sqlite3.Binary(member_to_blob.pop(m))) for m in removed])
+        if added:
+            for m in added:
+                member_to_blob[m] = self._dumps(m)
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO state_set_member (key, member) VALUES (?, ?)',
+                [(key_blob, sqlite3.Binary(member_to_blob[m])) for m in added])
+        return member_to_blob, True
+
+    def _delete_item(self, key_blob):
+        key_blob = sqlite3.Binary(key_blob)
+        self._conn.execute('DELETE FROM state_set_member WHERE key = ?', (key_blob,))
+        self._conn.execute('DELETE FROM state_item WHERE key = ?', (key_blob,))
+
+    def _clear(self):
+        self._conn.execute('DELETE FROM state_set_member')
+        self._conn.execute('DELETE FROM state_item')
+        self._conn.execute('DELETE FROM state_meta')
+        self._stored_items = None
+
+    @staticmethod
+    def _dumps(obj):
+        return cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
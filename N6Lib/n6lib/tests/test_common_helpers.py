@@ -3,6 +3,7 @@
 # Copyright (c) 2013-2020 NASK. All rights reserved.
 
 import os
+import random
 import re
 import subprocess
 import sys
@@ -23,6 +24,8 @@ from unittest_expander import (
 
 from n6lib.common_helpers import (
     EMAIL_OVERRESTRICTED_SIMPLE_REGEX,
+    CompactFilePagedSequence,
+    FilePagedSequence,
     RsyncFileContextManager,
     SimpleNamespace,
     dump_condensed_debug_msg,
@@ -586,6 +589,75 @@ class Test__read_file(unittest.TestCase):
 
 
 
+class _StrSubclass(str):
+    pass
+
+
+@expand
+class TestFilePagedSequence_randomized(unittest.TestCase):
+
+    ITEMS = [
+        'foo',
+        '',
+        '\x00\xff' * 100,
+        u'za\u017c\xf3\u0142\u0107',
+        42,
+        3.5,
+        None,
+        {'a': [1, (2, u'3')]},
+        ('bar', {'x'}),
+    ]
+
+    @foreach(
+        param(seq_class=FilePagedSequence, seq_kwargs=dict(page_size=1)),
+        param(seq_class=FilePagedSequence, seq_kwargs=dict(page_size=7)),
+        param(seq_class=CompactFilePagedSequence, seq_kwargs=dict(page_size=1)),
+        param(seq_class=CompactFilePagedSequence, seq_kwargs=dict(page_size=7)),
+        param(seq_class=CompactFilePagedSequence,
+              seq_kwargs=dict(page_size=7, max_resident_pages=1)),
+        param(seq_class=CompactFilePagedSequence,
+              seq_kwargs=dict(page_size=3, max_resident_pages=10)),
+    )
+    def test_behaves_like_list(self, seq_class, seq_kwargs):
+        rnd = random.Random(1234)
+        li = []
+        with seq_class(**seq_kwargs) as seq:
+            for _ in xrange(3000):
+                action = rnd.randint(0, 9)
+                if action <= 3:
+                    item = rnd.choice(self.ITEMS)
+                    li.append(item)
+                    seq.append(item)
+                elif action == 4 and li:
+                    self.assertEqual(seq.pop(), li.pop())
+                elif action <= 6 and li:
+                    index = rnd.randrange(-len(li), len(li))
+                    item = rnd.choice(self.ITEMS)
+                    li[index] = item
+                    seq[index] = item
+                elif action <= 8 and li:
+                    index = rnd.randrange(-len(li), len(li))
+                    self.assertEqual(seq[index], li[index])
+                    self.assertIs(type(seq[index]), type(li[index]))
+                elif rnd.random() < 0.05:
+                    seq.clear()
+                    del li[:]
+                self.assertEqual(len(seq), len(li))
+            self.assertEqual(list(seq), li)
+            self.assertEqual(list(reversed(seq)), li[::-1])
+
+    def test_compact_item_types_preserved(self):
+        str_page = ['a', u'b', 'c']
+        mixed_page = ['d', _StrSubclass('e'), bytearray('f')]
+        with CompactFilePagedSequence(str_page + mixed_page + str_page,
+                                      page_size=3,
+                                      max_resident_pages=1) as seq:
+            self.assertEqual(
+                [type(item) for item in seq],
+                [str, unicode, str, str, _StrSubclass, bytearray, str, unicode, str])
+            self.assertEqual(list(seq), str_page + mixed_page + str_page)
+
+
 class TestMakeDebugMsg(unittest.TestCase):
 
     @classmethod
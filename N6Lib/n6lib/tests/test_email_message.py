@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+import gzip
+import unittest
+import zipfile
+from cStringIO import StringIO
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from mock import patch
+
+from n6lib.email_message import (
+    EmailMessage,
+    NoMatchingFileError,
+)
+
+
+def _make_zip(*names_and_contents):
+    f = StringIO()
+    with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zfile:
+        for name, content in names_and_contents:
+            zfile.writestr(name, content)
+    return f.getvalue()
+
+
+def _make_zip_with_bad_crc(*bad_names):
+    raw = _make_zip_stored(('a.txt', 'AAAA'), ('b.txt', 'BBBB'))
+    for name in bad_names:
+        content = name[0].upper() * 4
+        raw = raw.replace(content, content[:-1] + 'X')
+    return raw
+
+
+def _make_zip_with_encrypted_files(*encrypted_names):
+    f = StringIO()
+    with zipfile.ZipFile(f, 'w') as zfile:
+        for name, content in [('a.txt', 'AAAA'), ('b.txt', 'BBBB')]:
+            info = zipfile.ZipInfo(name)
+            if name in encrypted_names:
+                info.flag_bits |= 0x1
+            zfile.writestr(info, content)
+    return f.getvalue()
+
+
+def _make_zip_stored(*names_and_contents):
+    f = StringIO()
+    with zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED) as zfile:
+        for name, content in names_and_contents:
+            zfile.writestr(name, content)
+    return f.getvalue()
+
+
+def _make_gzip(content):
+    f = StringIO()
+    with gzip.GzipFile(fileobj=f, mode='wb') as gzfile:
+        gzfile.write(content)
+    return f.getvalue()
+
+
+def _make_attachment(filename, content):
+    part = MIMEApplication(content)
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    return part
+
+
+class TestEmailMessage__files(unittest.TestCase):
+
+    def setUp(self):
+        mime_msg = MIMEMultipart()
+        mime_msg.attach(MIMEText('Hello!'))
+        mime_msg.attach(_make_attachment('small.csv', '1,2,3\n'))
+        mime_msg.attach(_make_attachment('archive.zip', _make_zip(
+            ('dir/first.txt', 'first'),
+            ('second.csv', 'second'))))
+        mime_msg.attach(_make_attachment('data.csv.gz', _make_gzip('gzipped')))
+        mime_msg.attach(_make_attachment('broken.gz', 'not really gzipped'))
+        self.msg = EmailMessage.from_string(mime_msg.as_string())
+        self.decoded_filenames = []
+        self.unzipped_names = []
+        orig_get_decoded_payload = EmailMessage.get_decoded_payload
+        orig_zipfile_read = zipfile.ZipFile.read
+        def get_decoded_payload(msg):
+            self.decoded_filenames.append(msg.get_filename())
+            return orig_get_decoded_payload(msg)
+        def zipfile_read(zfile, name, *args, **kwargs):
+            self.unzipped_names.append(getattr(name, 'filename', name))
+            return orig_zipfile_read(zfile, name, *args, **kwargs)
+        patcher = patch.multiple(EmailMessage, get_decoded_payload=get_decoded_payload)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(zipfile.ZipFile, 'read', zipfile_read)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_iter_filenames_and_contents(self):
+        self.assertEqual(list(self.msg.iter_filenames_and_contents()), [
+            (None, 'Hello!'),
+            ('small.csv', '1,2,3\n'),
+            ('archive.zip', 'first'),
+            ('data.csv.gz', 'gzipped'),
+            ('broken.gz', 'not really gzipped'),
+        ])
+        self.assertEqual(self.unzipped_names, ['dir/first.txt'])
+
+    def test_iter_filenames_and_contents_with_multifile_unpacking(self):
+        self.assertEqual(list(self.msg.iter_filenames_and_contents(multifile_unpacking=True)), [
+            (None, 'Hello!'),
+            ('small.csv', '1,2,3\n'),
+            ('archive.zip/first.txt', 'first'),
+            ('archive.zip/second.csv', 'second'),
+            ('data.csv.gz', 'gzipped'),
+            ('broken.gz', 'not really gzipped'),
+        ])
+
+    def test_iter_filenames_and_contents_with_filename_regex(self):
+        self.assertEqual(list(self.msg.iter_filenames_and_contents(multifile_unpacking=True,
+                                                                   filename_regex=r'\.csv$')), [
+            ('small.csv', '1,2,3\n'),
+            ('archive.zip/second.csv', 'second'),
+        ])
+        # (the archive needs to be decoded to get the names of its files...)
+        self.assertEqual(self.decoded_filenames, ['small.csv', 'archive.zip'])
+        # (...but only the matching file is unpacked)
+        self.assertEqual(self.unzipped_names, ['second.csv'])
+
+    def test_get_matching_file_content(self):
+        self.assertEqual(self.msg.get_matching_file_content(r'\.gz$'), 'gzipped')
+        # (the other matching file has not been decoded)
+        self.assertEqual(self.decoded_filenames, ['data.csv.gz'])
+
+    def test_get_matching_file_content_from_zip(self):
+        self.assertEqual(self.msg.get_matching_file_content(r'\.zip$'), 'first')
+        self.assertEqual(self.decoded_filenames, ['archive.zip'])
+        self.assertEqual(self.unzipped_names, ['dir/first.txt'])
+
+    def test_get_matching_file_content_by_type(self):
+        self.assertEqual(self.msg.get_matching_file_content(maintype='text'), 'Hello!')
+        self.assertEqual(self.decoded_filenames, [None])
+
+    def test_no_matching_file(self):
+        with self.assertRaises(NoMatchingFileError):
+            self.msg.get_matching_file_content(r'\.pdf$')
+        self.assertEqual(self.decoded_filenames, [])
+
+
+class TestEmailMessage__broken_zip_files(unittest.TestCase):
+
+    def setUp(self):
+        self.unzipped_names = []
+        orig_zipfile_read = zipfile.ZipFile.read
+        def zipfile_read(zfile, name, *args, **kwargs):
+            self.unzipped_names.append(getattr(name, 'filename', name))
+            return orig_zipfile_read(zfile, name, *args, **kwargs)
+        for patcher in [patch.object(zipfile.ZipFile, 'read', zipfile_read),
+                        patch('n6lib.email_message.LOGGER')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _make_msg(self, zip_content):
+        mime_msg = MIMEMultipart()
+        mime_msg.attach(_make_attachment('x.zip', zip_content))
+        mime_msg.attach(_make_attachment('small.csv', '1,2,3\n'))
+        return EmailMessage.from_string(mime_msg.as_string())
+
+    def _get_files(self, zip_content, **kwargs):
+        return list(self._make_msg(zip_content).iter_filenames_and_contents(**kwargs))
+
+    def test_zip_with_all_files_encrypted(self):
+        zip_content = _make_zip_with_encrypted_files('a.txt', 'b.txt')
+        expected = [('x.zip', zip_content), ('small.csv', '1,2,3\n')]
+        self.assertEqual(self._get_files(zip_content), expected)
+        self.assertEqual(self._get_files(zip_content, multifile_unpacking=True), expected)
+        self.assertEqual(self._get_files(zip_content, multifile_unpacking=True,
+                                         filename_regex=r'\.txt$'), [])
+        self.assertEqual(self._make_msg(zip_content).get_matching_file_content(r'\.zip$'),
+                         zip_content)
+        # (encrypted files are detected without trying to unpack them)
+        self.assertEqual(self.unzipped_names, [])
+
+    def test_zip_with_one_file_encrypted(self):
+        zip_content = _make_zip_with_encrypted_files('b.txt')
+        self.assertEqual(self._get_files(zip_content), [
+            ('x.zip', 'AAAA'),
+            ('small.csv', '1,2,3\n'),
+        ])
+        self.assertEqual(self._get_files(zip_content, multifile_unpacking=True), [
+            ('x.zip', zip_content),
+            ('small.csv', '1,2,3\n'),
+        ])
+        self.assertEqual(self._get_files(zip_content, multifile_unpacking=True,
+                                         filename_regex=r'a\.txt$'), [
+            ('x.zip/a.txt', 'AAAA'),
+        ])
+        self.assertEqual(self.unzipped_names, ['a.txt', 'a.txt'])
+
+    def test_zip_with_bad_crc_of_first_file(self):
+        zip_content = _make_zip_with_bad_crc('a.txt')
+        self.assertEqual(self._get_files(zip_content), [
+            ('x.zip', zip_content),
+            ('small.csv', '1,2,3\n'),
+        ])
+        self.assertEqual(self._make_msg(zip_content).get_matching_file_content(r'\.zip$'),
+                         zip_content)
+        self.assertEqual(self._get_files(zip_content, multifile_unpacking=True), [
+            ('x.zip/b.txt', 'BBBB'),
+            ('small.csv', '1,2,3\n'),
+        ])
+
+    def test_zip_with_bad_crc_of_other_file(self):
+        zip_content = _make_zip_with_bad_crc('b.txt')
+        self.assertEqual(self._get_files(zip_content), [
+            ('x.zip', 'AAAA'),
+            ('small.csv', '1,2,3\n'),
+        ])
+        # (only the file to be yielded has been unpacked)
+        self.assertEqual(self.unzipped_names, ['a.txt'])
+        self.assertEqual(self._get_files(zip_content, multifile_unpacking=True), [
+            ('x.zip/a.txt', 'AAAA'),
+            ('small.csv', '1,2,3\n'),
+        ])
+        getters = dict(self._make_msg(zip_content).iter_filenames_and_content_getters(
+            multifile_unpacking=True))
+        self.assertEqual(getters['x.zip/a.txt'](), 'AAAA')
+        with self.assertRaises(zipfile.BadZipfile):
+            getters['x.zip/b.txt']()
+
+    def test_zip_with_bad_crc_of_not_matching_file(self):
+        zip_content = _make_zip_with_bad_crc('b.txt')
+        self.assertEqual(self._get_files(zip_content, multifile_unpacking=True,
+                                         filename_regex=r'a\.txt$'), [
+            ('x.zip/a.txt', 'AAAA'),
+        ])
+        self.assertEqual(self.unzipped_names, ['a.txt'])
+
+    def test_zip_without_broken_files(self):
+        zip_content = _make_zip_stored(('a.txt', 'AAAA'), ('b.txt', 'BBBB'))
+        self.assertEqual(self._get_files(zip_content), [
+            ('x.zip', 'AAAA'),
+            ('small.csv', '1,2,3\n'),
+        ])
+        self.assertEqual(self._get_files(zip_content, multifile_unpacking=True), [
+            ('x.zip/a.txt', 'AAAA'),
+            ('x.zip/b.txt', 'BBBB'),
+            ('small.csv', '1,2,3\n'),
+        ])
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+import unittest
+
+from unittest_expander import (
+    expand,
+    foreach,
+    param,
+)
+
+from n6lib.http_helpers import (
+    RequestPerformer,
+    ResponseTooLargeError,
+)
+from n6lib.unit_test_helpers import LocalHTTPServer
+
+
+LINE_COUNT = 100000
+LINE_PATTERN = '"{0}", "2020-01-01 00:00:{1:02}", "some data..."\n'
+
+
+def _generate_lines(lines_per_chunk=1000):
+    for start in xrange(0, LINE_COUNT, lines_per_chunk):
+        yield ''.join(LINE_PATTERN.format(i, i % 60)
+                      for i in xrange(start, start + lines_per_chunk))
+
+
+def _generated_content_provider(request_headers, request_body):
+    # (no Content-Length -- so the size limit can be
+    # checked only as the content is being downloaded)
+    return 200, {}, _generate_lines()
+
+
+@expand
+class TestRequestPerformer_streaming(unittest.TestCase):
+
+    def setUp(self):
+        self.content = ''.join(_generate_lines())
+        self.server = LocalHTTPServer({
+            '/static': self.content,
+            '/generated': _generated_content_provider,
+            '/no-trailing-newline': 'foo\nbar',
+        })
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+    @foreach(['/static', '/generated'])
+    def test_iteration(self, path):
+        with RequestPerformer('GET', self.server.url(path), chunk_size=1000) as perf:
+            chunks = list(perf)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks), self.content)
+
+    @foreach(['/static', '/generated', '/no-trailing-newline'])
+    def test_iter_lines(self, path):
+        with RequestPerformer('GET', self.server.url(path), chunk_size=1000) as perf:
+            lines = list(perf.iter_lines())
+        expected_content = RequestPerformer.fetch('GET', self.server.url(path))
+        self.assertEqual(lines, expected_content.split('\n'))
+
+    @foreach(['/static', '/generated'])
+    def test_max_size_not_exceeded(self, path):
+        with RequestPerformer('GET', self.server.url(path),
+                              max_size=len(self.content)) as perf:
+            self.assertEqual(''.join(perf), self.content)
+        self.assertEqual(RequestPerformer.fetch('GET', self.server.url(path),
+                                                max_size=len(self.content)),
+                         self.content)
+
+    def test_max_size_exceeded_according_to_content_length(self):
+        with self.assertRaises(ResponseTooLargeError):
+            with RequestPerformer('GET', self.server.url('/static'), max_size=1000):
+                pass
+
+    def test_max_size_exceeded_during_download(self):
+        received = []
+        with RequestPerformer('GET', self.server.url('/generated'),
+                              chunk_size=1000, max_size=5000) as perf:
+            with self.assertRaises(ResponseTooLargeError):
+                for chunk in perf:
+                    received.append(chunk)
+        self.assertLessEqual(sum(map(len, received)), 5000)
+
+    @foreach(
+        param(path='/static'),
+        param(path='/generated'),
+    )
+    def test_max_size_exceeded_when_fetching(self, path):
+        with self.assertRaises(ResponseTooLargeError):
+            RequestPerformer.fetch('GET', self.server.url(path), max_size=1000)
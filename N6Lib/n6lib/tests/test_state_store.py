@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2020 NASK. All rights reserved.
+
+import cPickle
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from n6lib.state_store import (
+    SQLiteStateStore,
+    StateNotFoundError,
+)
+
+
+class TestSQLiteStateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.db_path = osp.join(self.tmp_dir, 'state.sqlite')
+
+    def _open_store(self, **kwargs):
+        store = SQLiteStateStore(self.db_path, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def _count_rows(self, store, table):
+        return store._conn.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0]
+
+    def test_nothing_saved(self):
+        store = self._open_store()
+        self.assertTrue(store.is_empty())
+        with self.assertRaises(StateNotFoundError):
+            store.load()
+
+    def test_dict_state_persisted(self):
+        state = {
+            'newest_row_time': '2020-01-02 03:04:05',
+            'newest_rows': {'"1", "foo"', '"2", "bar"'},
+            ('tuple', 'key'): frozenset([1, 2]),
+            'nested': {'a': [1, 2, None]},
+            'empty_set': set(),
+        }
+        self._open_store().save(state)
+        loaded = self._open_store().load()
+        self.assertEqual(loaded, state)
+        self.assertIs(type(loaded['newest_rows']), set)
+        self.assertIs(type(loaded[('tuple', 'key')]), frozenset)
+
+    def test_non_dict_state_persisted(self):
+        store = self._open_store()
+        store.save({'a': 1})
+        store.save(['foo', {'bar'}])
+        self.assertEqual(self._open_store().load(), ['foo', {'bar'}])
+        self.assertEqual(self._count_rows(store, 'state_item'), 0)
+        store.save({'b': {2}})
+        self.assertEqual(self._open_store().load(), {'b': {2}})
+
+    def test_incremental_updates(self):
+        store = self._open_store()
+        state = {
+            'time': 1,
+            'handled': set('file{}'.format(i) for i in xrange(1000)),
+            'other': 'x',
+            'to-be-removed': 'y',
+        }
+        store.save(state)
+        state = store.load()
+        state['time'] = 2
+        state['handled'].add('file1000')
+        state['handled'].discard('file0')
+        del state['to-be-removed']
+        changes_before = store._conn.total_changes
+        store.save(state)
+        # rows written: the 'time' item, the 'handled' item (its update
+        # time), 'file1000' (added), 'file0' (deleted), 'to-be-removed'
+        self.assertEqual(store._conn.total_changes - changes_before, 5)
+        self.assertEqual(self._open_store().load(), state)
+        self.assertEqual(self._count_rows(store, 'state_set_member'), 1000)
+        self.assertEqual(self._count_rows(store, 'state_item'), 3)
+
+    def test_set_value_replaced_with_plain_one_and_back(self):
+        store = self._open_store()
+        store.save({'k': {1, 2}})
+        store.save({'k': 'COMPLETED'})
+        self.assertEqual(self._open_store().load(), {'k': 'COMPLETED'})
+        self.assertEqual(self._count_rows(store, 'state_set_member'), 0)
+        store.save({'k': {3}})
+        self.assertEqual(self._open_store().load(), {'k': {3}})
+
+    def test_failed_save_is_rolled_back(self):
+        store = self._open_store()
+        store.save({'a': 1, 'b': {1}})
+        with self.assertRaises(cPickle.PicklingError):
+            store.save({'a': 2, 'b': {1, 2}, 'c': lambda: None})   # (unpicklable)
+        self.assertEqual(self._open_store().load(), {'a': 1, 'b': {1}})
+        store.save({'a': 3, 'b': {1}})
+        self.assertEqual(self._open_store().load(), {'a': 3, 'b': {1}})
+
+    def test_retention_period(self):
+        with patch('time.time', return_value=1000.0):
+            self._open_store().save({'old': 1, 'old-set': {1}, 'changed': 1})
+        with patch('time.time', return_value=2000.0):
+            store = self._open_store()
+            store.save({'old': 1, 'old-set': {1}, 'changed': 2, 'new': {1}})
+        with patch('time.time', return_value=2500.0):
+            self.assertEqual(self._open_store(retention_period=2000).load(),
+                             {'old': 1, 'old-set': {1}, 'changed': 2, 'new': {1}})
+            store = self._open_store(retention_period=1000)
+            self.assertEqual(store.load(), {'changed': 2, 'new': {1}})
+            self.assertEqual(self._count_rows(store, 'state_set_member'), 1)
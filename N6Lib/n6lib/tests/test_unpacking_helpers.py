@@ -1,10 +1,25 @@
 # -*- coding: utf-8 -*-
 
-# Copyright (c) 2013-2018 NASK. All rights reserved.
+# Copyright (c) 2013-2020 NASK. All rights reserved.
 
+import gzip
+import os.path as osp
+import resource
+import shutil
+import tempfile
 import unittest
+import zipfile
 
-from n6lib.unpacking_helpers import gunzip_from_string, iter_unzip_from_string
+from n6lib.unpacking_helpers import (
+    UnpackedDataTooLargeError,
+    gunzip_from_string,
+    iter_gunzip_from_file,
+    iter_unzip_from_file,
+    iter_unzip_from_string,
+)
+
+
+MiB = 2 ** 20
 
 
 class Test__gunzip_from_string(unittest.TestCase):
@@ -18,6 +33,8 @@ class Test__gunzip_from_string(unittest.TestCase):
         decompressed = (
             'syntax: glob\n\n*.pyc\n.project\n.pydevproject\n.settings\n\n')
         self.assertEqual(gunzip_from_string(compressed), decompressed)
+        with self.assertRaises(UnpackedDataTooLargeError):
+            gunzip_from_string(compressed, max_size=len(decompressed) - 1)
 
 
 class Test__iter_unzip_from_string(unittest.TestCase):
@@ -73,3 +90,140 @@ class Test__iter_unzip_from_string(unittest.TestCase):
             filenames=['IGNORED-NON-EXISTENT', name, 'another ignored...'],
             yielding_with_dirs=True))
         self.assertItemsEqual(expected, real)
+
+    def test_max_sizes(self):
+        self.assertItemsEqual(
+            list(iter_unzip_from_string(self.zipped, max_member_size=54, max_total_size=58)),
+            self.file_names_and_contents)
+        for kwargs in [dict(max_member_size=53), dict(max_total_size=57)]:
+            with self.assertRaises(UnpackedDataTooLargeError):
+                list(iter_unzip_from_string(self.zipped, **kwargs))
+
+
+class _LargeArchivesTestMixin(object):
+
+    # the size of (highly compressible) files in generated archives
+    LARGE_SIZE = 64 * MiB
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def _make_large_file(self, name):
+        # (a sparse file -- so that it does not occupy any disk space)
+        path = osp.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.truncate(self.LARGE_SIZE)
+        return path
+
+    def _consume(self, file):
+        size = 0
+        while True:
+            chunk = file.read(MiB)
+            if not chunk:
+                return size
+            self.assertLessEqual(len(chunk), MiB)
+            size += len(chunk)
+
+    def _assert_memory_usage_bounded(self, func):
+        max_rss_kb_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result = func()
+        max_rss_kb_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.assertLess(max_rss_kb_after - max_rss_kb_before, 16 * 1024)
+        return result
+
+
+class Test__iter_unzip_from_file(_LargeArchivesTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(Test__iter_unzip_from_file, self).setUp()
+        self.zip_path = osp.join(self.tmp_dir, 'bomb.zip')
+        with zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_DEFLATED) as zfile:
+            zfile.write(self._make_large_file('large1'), 'dir/large1')
+            zfile.write(self._make_large_file('large2'), 'dir/large2')
+            zfile.writestr('dir/small', 'small')
+        assert osp.getsize(self.zip_path) < 2 * MiB
+
+    def _consume_all(self, **kwargs):
+        return [(name, self._consume(member_file))
+                for name, member_file in iter_unzip_from_file(self.zip_path, **kwargs)]
+
+    def test_memory_usage_bounded(self):
+        names_and_sizes = self._assert_memory_usage_bounded(self._consume_all)
+        self.assertEqual(names_and_sizes, [
+            ('large1', self.LARGE_SIZE),
+            ('large2', self.LARGE_SIZE),
+            ('small', 5),
+        ])
+
+    def test_from_file_object_with_dirs_and_filenames(self):
+        with open(self.zip_path, 'rb') as f:
+            names_and_contents = [
+                (name, member_file.read())
+                for name, member_file in iter_unzip_from_file(f,
+                                                              filenames=['small'],
+                                                              yielding_with_dirs=True)]
+        self.assertEqual(names_and_contents, [('dir/small', 'small')])
+
+    def test_max_member_size_exceeded(self):
+        read_sizes = []
+        for name, member_file in iter_unzip_from_file(self.zip_path,
+                                                      max_member_size=10 * MiB):
+            try:
+                read_sizes.append(self._consume(member_file))
+            except UnpackedDataTooLargeError:
+                read_sizes.append(None)
+        # (the large members have been rejected -- according to their
+        # declared sizes -- but it has not prevented us from getting
+        # the small one)
+        self.assertEqual(read_sizes, [None, None, 5])
+
+    def test_max_member_size_exceeded_despite_false_declared_size(self):
+        # (a ZIP bomb may lie about the sizes of its members...)
+        class LyingZipFile(zipfile.ZipFile):
+            def infolist(self):
+                infos = zipfile.ZipFile.infolist(self)
+                for info in infos:
+                    info.file_size = 5
+                return infos
+        received = []
+        for name, member_file in iter_unzip_from_file(self.zip_path,
+                                                      filenames=['large1'],
+                                                      max_member_size=10 * MiB,
+                                                      zipfile_class=LyingZipFile):
+            with self.assertRaises(UnpackedDataTooLargeError):
+                while True:
+                    received.append(member_file.read(MiB))
+        self.assertEqual(sum(map(len, received)), 10 * MiB)
+
+    def test_max_total_size_exceeded(self):
+        with self.assertRaises(UnpackedDataTooLargeError):
+            self._assert_memory_usage_bounded(
+                lambda: self._consume_all(max_total_size=self.LARGE_SIZE + 3))
+
+
+class Test__iter_gunzip_from_file(_LargeArchivesTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(Test__iter_gunzip_from_file, self).setUp()
+        self.gzip_path = osp.join(self.tmp_dir, 'bomb.gz')
+        with open(self._make_large_file('large'), 'rb') as src, \
+             gzip.GzipFile(self.gzip_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, MiB)
+        assert osp.getsize(self.gzip_path) < MiB
+
+    def test_memory_usage_bounded(self):
+        total_size = self._assert_memory_usage_bounded(
+            lambda: sum(len(chunk) for chunk in iter_gunzip_from_file(self.gzip_path,
+                                                                      chunk_size=MiB)))
+        self.assertEqual(total_size, self.LARGE_SIZE)
+
+    def test_max_size_exceeded(self):
+        received_size = [0]
+        def consume():
+            with open(self.gzip_path, 'rb') as f:
+                for chunk in iter_gunzip_from_file(f, max_size=10 * MiB):
+                    received_size[0] += len(chunk)
+        with self.assertRaises(UnpackedDataTooLargeError):
+            self._assert_memory_usage_bounded(consume)
+        self.assertLessEqual(received_size[0], 10 * MiB)
@@ -2,12 +2,14 @@
 
 # Copyright (c) 2013-2019 NASK. All rights reserved.
 
+import BaseHTTPServer
 import contextlib
 import copy
 import functools
 import json
 import importlib
 import inspect
+import SocketServer
 import sys
 import threading
 import types
@@ -1240,6 +1242,102 @@ class RequestHelperMixin(object):
         return sentinel.context
 
 
+class LocalHTTPServer(object):
+
+    """
+    A simple HTTP server running in a background thread (to be used as
+    a test fixture, e.g., for testing stuff that downloads data). Each
+    GET/POST request is handled in a separate thread.
+
+    Constructor args/kwargs:
+        `content_providers` (dict):
+            Maps URL paths (e.g., `"/data.csv"`) to either:
+            * response bodies (str), or
+            * callables that take two arguments: a dict of the request's
+              headers and the request's body (str; empty for GET
+              requests), and return a 3-tuple: `(<HTTP status code>,
+              <dict of response headers>, <response body>)`, where
+              the body is a str or an iterable of str chunks (the
+              latter makes it possible to serve large generated
+              content without keeping it in memory; then the
+              `Content-Length` header is not sent automatically).
+
+    Example use:
+
+        with LocalHTTPServer({'/foo': 'bar'}) as server:
+            content = RequestPerformer.fetch('GET', server.url('/foo'))
+
+    The `requests` attribute is a list of `(<path>, <dict of request
+    headers>, <request body>)` tuples -- recorded for all handled
+    requests.
+    """
+
+    class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    def __init__(self, content_providers):
+        self.content_providers = content_providers
+        self.requests = []
+        self._server = self._ThreadingHTTPServer(('127.0.0.1', 0),
+                                                 self._make_request_handler_class())
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def url(self, path):
+        host, port = self._server.server_address
+        return 'http://{}:{}{}'.format(host, port, path)
+
+    def _make_request_handler_class(self):
+        fixture = self
+
+        class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.0'
+
+            def do_GET(self):
+                request_headers = dict(self.headers.items())
+                request_body = self.rfile.read(int(request_headers.get('content-length', 0)))
+                fixture.requests.append((self.path, request_headers, request_body))
+                provider = fixture.content_providers.get(self.path)
+                if provider is None:
+                    status, headers, body = 404, {}, ''
+                elif callable(provider):
+                    status, headers, body = provider(request_headers, request_body)
+                else:
+                    status, headers, body = 200, {}, provider
+                if isinstance(body, basestring):
+                    headers = dict(headers)
+                    headers.setdefault('Content-Length', str(len(body)))
+                    body = [body]
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                try:
+                    for chunk in body:
+                        self.wfile.write(chunk)
+                except EnvironmentError:
+                    pass  # the client has closed the connection
+
+            do_POST = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        return RequestHandler
+
+
+
 #
 # Deprecated test helpers (to be removed)
 #
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
-# Copyright (c) 2013-2019 NASK. All rights reserved.
+# Copyright (c) 2013-2020 NASK. All rights reserved.
 
+import contextlib
 import cStringIO
 import gzip
 import os.path
@@ -9,30 +10,83 @@ import tempfile
 import zipfile
 
 
-def gunzip_from_string(gzipped):
+DEFAULT_CHUNK_SIZE = 2 ** 16
+
+
+class UnpackedDataTooLargeError(ValueError):
+    """
+    Raised when decompressed data exceed the specified size limit.
+    """
+
+
+def gunzip_from_string(gzipped, max_size=None):
     """
     Decompress GZip-compressed data.
 
     Args:
         `gzipped`: GZip-compressed data as a string.
 
+    Kwargs:
+        `max_size` (optional):
+            The maximum size of the decompressed data (in bytes).
+
     Returns:
         Decompressed data as a string.
 
     Raises:
         IOError, EOFError:
             as gzip.GzipFile can raise them for invalid input.
+        UnpackedDataTooLargeError:
+            if `max_size` is specified and has been exceeded.
     """
     with tempfile.TemporaryFile(mode='w+b') as f:
         f.write(gzipped)
         f.flush()
         f.seek(0)
-        gzfile = gzip.GzipFile(mode='rb', fileobj=f)
-        return gzfile.read()
+        return ''.join(iter_gunzip_from_file(f, max_size=max_size))
+
+
+def iter_gunzip_from_file(fileobj_or_path, max_size=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Decompress GZip-compressed data incrementally.
+
+    Args:
+        `fileobj_or_path`:
+            The path of a GZip file or a file-like object (opened in
+            binary mode) to read the compressed data from.
+
+    Kwargs:
+        `max_size` (optional):
+            The maximum size of the decompressed data (in bytes).
+        `chunk_size` (default: DEFAULT_CHUNK_SIZE):
+            The (maximum) size of yielded chunks.
+
+    Yields:
+        Consecutive chunks (strings) of the decompressed data.
+
+    Raises:
+        IOError, EOFError:
+            as gzip.GzipFile can raise them for invalid input.
+        UnpackedDataTooLargeError:
+            if `max_size` is specified and has been exceeded (note:
+            it is detected before the excessive data are yielded).
+    """
+    if isinstance(fileobj_or_path, basestring):
+        gzfile = gzip.GzipFile(filename=fileobj_or_path, mode='rb')
+    else:
+        gzfile = gzip.GzipFile(mode='rb', fileobj=fileobj_or_path)
+    with contextlib.closing(gzfile):
+        reader = _SizeLimitedReader(gzfile, 'GZip-decompressed data', max_size)
+        while True:
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
 
 
 def iter_unzip_from_string(zipped, password=None, filenames=None,
-                           yielding_with_dirs=False):
+                           yielding_with_dirs=False,
+                           max_member_size=None, max_total_size=None):
     """
     Extract files from a ZIP archive.
 
@@ -49,6 +103,10 @@ def iter_unzip_from_string(zipped, password=None, filenames=None,
             If False -- dir names will be stripped off from yielded file names.
             If True -- file names will be yielded as found in the archive
             (including dir parts).
+        `max_member_size` (optional):
+            The maximum size of a single extracted file (in bytes).
+        `max_total_size` (optional):
+            The maximum total size of all extracted files (in bytes).
 
     Yields:
         Pairs: (<file name>, <file content>).
@@ -58,10 +116,133 @@ def iter_unzip_from_string(zipped, password=None, filenames=None,
             as zipfile.ZipFile can raise it for invalid input.
         RuntimeError:
             as zipfile.ZipFile can raise it for lacking or incorrect password.
+        UnpackedDataTooLargeError:
+            if any of the size limits is specified and has been exceeded.
+    """
+    for name, member_file in iter_unzip_from_file(cStringIO.StringIO(zipped),
+                                                  password=password,
+                                                  filenames=filenames,
+                                                  yielding_with_dirs=yielding_with_dirs,
+                                                  max_member_size=max_member_size,
+                                                  max_total_size=max_total_size):
+        yield name, member_file.read()
+
+
+def iter_unzip_from_file(fileobj_or_path, password=None, filenames=None,
+                         yielding_with_dirs=False,
+                         max_member_size=None, max_total_size=None,
+                         zipfile_class=zipfile.ZipFile):
     """
-    zfile = zipfile.ZipFile(cStringIO.StringIO(zipped))
-    for fullname in zfile.namelist():
-        basename = (os.path.basename(fullname) if fullname else fullname)
-        if filenames is None or basename in filenames:
-            content = zfile.read(fullname, pwd=password)
-            yield (fullname if yielding_with_dirs else basename), content
+    Extract files from a ZIP archive, incrementally.
+
+    Unlike iter_unzip_from_string(), this function neither needs the
+    whole archive to be kept in memory nor reads whole extracted files
+    into memory: for each (selected) file from the archive, it yields
+    a file-like object that decompresses the data as they are read
+    from it (reading beyond any of the size limits causes an error --
+    so, in particular, a "ZIP bomb" is never fully decompressed).
+
+    Args:
+        `fileobj_or_path`:
+            The path of a ZIP file or a file-like object (opened in
+            binary mode; it needs to support seeking).
+
+    Kwargs:
+        `password`, `filenames`, `yielding_with_dirs`, `max_member_size`,
+        `max_total_size` -- see: iter_unzip_from_string().
+        `zipfile_class` (default: zipfile.ZipFile):
+            The ZIP file class to be used (it can be, e.g., the
+            `ZipFile` class from the `czipfile` library, which is much
+            faster when it comes to decrypting encrypted files).
+
+    Yields:
+        Pairs: (<file name>, <file-like object>) -- where the file-like
+        object (providing the `read([size])` method) is valid only until
+        the next iteration.
+
+    Raises:
+        zipfile.BadZipfile:
+            as zipfile.ZipFile can raise it for invalid input.
+        RuntimeError:
+            as zipfile.ZipFile can raise it for lacking or incorrect password.
+        UnpackedDataTooLargeError:
+            (raised by the `read()` method of a yielded file-like object)
+            if any of the size limits is specified and has been exceeded.
+    """
+    total_size_counter = _SizeCounter(max_total_size, 'all extracted data')
+    with contextlib.closing(zipfile_class(fileobj_or_path)) as zfile:
+        for info in zfile.infolist():
+            fullname = info.filename
+            basename = (os.path.basename(fullname) if fullname else fullname)
+            if filenames is None or basename in filenames:
+                with contextlib.closing(zfile.open(info, pwd=password)) as member_file:
+                    yield ((fullname if yielding_with_dirs else basename),
+                           _SizeLimitedReader(member_file,
+                                              'ZIP archive member {!r}'.format(fullname),
+                                              max_member_size,
+                                              declared_size=info.file_size,
+                                              total_size_counter=total_size_counter))
+
+
+#
+# Auxiliary classes
+
+class _SizeCounter(object):
+
+    def __init__(self, max_size, data_description):
+        self.max_size = max_size
+        self.data_description = data_description
+        self.size = 0
+
+    def add(self, size):
+        self.size += size
+        self.check(self.size)
+
+    def check(self, size, remark=''):
+        if self.max_size is not None and size > self.max_size:
+            raise UnpackedDataTooLargeError(
+                '{}{} exceed(s) the size limit: {} bytes'.format(
+                    self.data_description,
+                    remark,
+                    self.max_size))
+
+    def get_allowed_read_size(self, size):
+        self.check(self.size)
+        if self.max_size is None:
+            return size
+        # (allowing to read just 1 byte more than the limit
+        # -- to detect the excess before any excessive data
+        # are returned to the caller)
+        return min(size, self.max_size - self.size + 1)
+
+
+class _SizeLimitedReader(object):
+
+    def __init__(self, file, data_description, max_size,
+                 declared_size=None, total_size_counter=None):
+        self._file = file
+        self._counters = [_SizeCounter(max_size, data_description)]
+        if total_size_counter is not None:
+            self._counters.append(total_size_counter)
+        self._declared_size = declared_size
+
+    def read(self, size=-1):
+        if self._declared_size is not None:
+            # (fail fast if the declared size is already excessive)
+            for counter in self._counters:
+                counter.check(counter.size + self._declared_size,
+                              remark=' (according to the declared size)')
+            self._declared_size = None
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(DEFAULT_CHUNK_SIZE)
+                if not chunk:
+                    return ''.join(chunks)
+                chunks.append(chunk)
+        for counter in self._counters:
+            size = counter.get_allowed_read_size(size)
+        chunk = self._file.read(size)
+        for counter in self._counters:
+            counter.add(len(chunk))
+        return chunk